@@ -0,0 +1,134 @@
+'''
+SBCanvas per-frame cost benchmark.
+
+Fills a canvas with nodes carrying a drawable and a metadata component,
+with a fraction of them also carrying a component that updates every
+frame, and writes the time per frame to stdout or --output as one JSON
+object per node count. A frame sets every node's anchors, as the
+controller does, and runs SBCanvas.update. With --viewport only the
+given fraction of the canvas area is in view and the rest is culled, e.g.
+
+    python -m benchmarks.canvas_frame --sizes 1000 10000 100000 --pool
+    python -m benchmarks.canvas_frame --pool --viewport 0.05
+'''
+import json
+import os
+import statistics
+import sys
+import time
+from argparse import ArgumentParser
+
+os.environ.setdefault('KIVY_NO_ARGS', '1')
+
+import numpy as np
+
+from sb.component import Component
+from sb.drawable import Drawable
+from sb.image_metadata import ImageMetadata
+from sb.recttransform import TransformPool
+from sb.sbcanvas import SBCanvas
+from sb.sbobject import SBObject
+
+
+class NullDrawable(Drawable):
+    # Drawable without any graphics instructions
+    pass
+
+
+class Ticker(Component):
+    def __init__(self, _object, *args, **kwargs):
+        super(Ticker, self).__init__(_object)
+        self.ticks = 0
+
+    def update(self, dt):
+        self.ticks += 1
+
+
+def set_anchors(canvas, xforms, slots, anchors):
+    if canvas.transform_pool is not None:
+        canvas.transform_pool.set_anchors(slots, anchors)
+    else:
+        for t, a in zip(xforms, anchors):
+            t.x_anchor, t.y_anchor = a
+
+
+def run(n, frames, updating_fraction, pool, viewport=None):
+    rng = np.random.default_rng(0)
+    canvas = SBCanvas(size=(1000, 1000))
+    if pool:
+        canvas.transform_pool = TransformPool()
+    if viewport is not None:
+        # Centered square covering the fraction of the canvas area
+        half = 500 * viewport ** 0.5
+        canvas.viewport = (500 - half, 500 - half, 500 + half, 500 + half)
+    objects = [SBObject() for _ in range(n)]
+    n_updating = int(n * updating_fraction)
+    for i, _object in enumerate(objects):
+        _object.add_component(NullDrawable)
+        _object.add_component(ImageMetadata)
+        if i < n_updating:
+            _object.add_component(Ticker)
+    xforms = [o.transform for o in objects]
+    if pool:
+        canvas.add_pooled_transforms(xforms)
+    else:
+        canvas.add_root_transforms(xforms)
+    slots = np.array([xf._slot for xf in xforms])
+    # The first frame adds every drawable to the canvas
+    begin_t = time.perf_counter()
+    canvas.update(1 / 60)
+    first_frame = time.perf_counter() - begin_t
+    times = []
+    query_times = []
+    for _ in range(frames):
+        anchors = rng.random((n, 2), dtype='float32')
+        begin_t = time.perf_counter()
+        set_anchors(canvas, xforms, slots, anchors)
+        canvas.update(1 / 60)
+        times.append(time.perf_counter() - begin_t)
+        x, y = rng.random(2) * 1000
+        begin_t = time.perf_counter()
+        canvas.pick(x, y)
+        query_times.append(time.perf_counter() - begin_t)
+    return {
+        'nodes': n,
+        'pool': pool,
+        'viewport': viewport,
+        'drawn_nodes': len(canvas._active_drawables),
+        'updating_nodes': n_updating,
+        'frames': frames,
+        'first_frame_ms': 1000 * first_frame,
+        'frame_ms_median': 1000 * statistics.median(times),
+        'frame_ms_mean': 1000 * statistics.mean(times),
+        'frame_ms_max': 1000 * max(times),
+        'pick_ms_median': 1000 * statistics.median(query_times)
+    }
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark SBCanvas frames')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--frames', type=int, default=60)
+    parser.add_argument('--updating-fraction', type=float, default=0.0,
+                        help='fraction of nodes with a per-frame update')
+    parser.add_argument('--pool', action='store_true',
+                        help='keep the node transforms in a TransformPool')
+    parser.add_argument('--viewport', type=float,
+                        help='fraction of the canvas area in view')
+    parser.add_argument('--output', type=str,
+                        help='append JSON lines to this file')
+    args = parser.parse_args()
+
+    out = open(args.output, 'a') if args.output else sys.stdout
+    for n in args.sizes:
+        result = run(n, args.frames, args.updating_fraction, args.pool,
+                     args.viewport)
+        out.write(json.dumps(result) + '\n')
+        out.flush()
+    if out is not sys.stdout:
+        out.close()
+
+
+if __name__ == '__main__':
+    main()
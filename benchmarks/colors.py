@@ -0,0 +1,128 @@
+'''
+Dominant color engine benchmark.
+
+Times every color engine on the same thumbnails and reports how closely
+each one agrees with the ekstrakto peak finder, one JSON object per
+engine, e.g.
+
+    python -m benchmarks.colors --images ~/Pictures --batch-size 64
+'''
+import itertools
+import json
+import sys
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+from sb.analysis import stack_images
+from sb.colors import color_engines, get_dominant_colors_batch, peak_find_3d
+
+
+def palette_thumbnails(n, rng, size=64, n_colors=4, noise=0.03):
+    # Blocks of a few random colors plus noise
+    thumbnails = []
+    for _ in range(n):
+        palette = rng.random((n_colors, 3))
+        height, width = rng.integers(size // 2, size + 1, 2)
+        labels = rng.integers(0, n_colors, (height // 8 + 1, width // 8 + 1))
+        labels = np.kron(labels, np.ones((8, 8), dtype=int))[:height, :width]
+        pixels = palette[labels] + rng.normal(0, noise, (height, width, 3))
+        thumbnails.append(np.clip(pixels, 0, 1).astype('float32'))
+    return thumbnails
+
+
+def directory_thumbnails(dir_path, n, size=64):
+    from PIL import Image as PILImageM
+
+    from sb.files import get_image_paths
+    thumbnails = []
+    for file_path in itertools.islice(get_image_paths(dir_path), n):
+        try:
+            with PILImageM.open(file_path) as img:
+                img.thumbnail((size, size))
+                array = np.asarray(img.convert('RGB'), dtype='float32')
+        except Exception:
+            continue
+        thumbnails.append(array / 255.0)
+    return thumbnails
+
+
+def color_distances(colors, reference):
+    '''
+    :return: distance of the strongest colors, and mean distance of the
+        colors under the best matching between the two sets
+    '''
+    top = np.linalg.norm(colors[:, 0] - reference[:, 0], axis=1)
+    matched = np.min([
+        np.linalg.norm(colors[:, p] - reference, axis=2).mean(axis=1)
+        for p in itertools.permutations(range(colors.shape[1]))], axis=0)
+    return top, matched
+
+
+def run_engines(thumbnails, engines, batch_size):
+    batches = [stack_images(thumbnails[begin:begin + batch_size])
+               for begin in range(0, len(thumbnails), batch_size)]
+    outputs = {}
+    results = []
+    for engine in engines:
+        begin_t = time.perf_counter()
+        colors = [get_dominant_colors_batch(stack, mask, engine=engine)
+                  for stack, mask in batches]
+        elapsed = time.perf_counter() - begin_t
+        outputs[engine] = np.concatenate(colors)
+        results.append({
+            'engine': engine,
+            'images': len(thumbnails),
+            'batch_size': batch_size,
+            'seconds': elapsed,
+            'images_per_second': len(thumbnails) / max(elapsed, 1e-9)
+        })
+    reference = outputs.get('ekstrakto')
+    if reference is not None:
+        for result in results:
+            top, matched = color_distances(outputs[result['engine']],
+                                           reference)
+            result.update({
+                'top_color_distance_mean': float(top.mean()),
+                'top_color_distance_p95': float(np.percentile(top, 95)),
+                'matched_distance_mean': float(matched.mean()),
+                'matched_distance_p95': float(np.percentile(matched, 95))
+            })
+    return results
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark dominant color engines')
+    parser.add_argument('--images', type=str,
+                        help='directory of images, synthetic if omitted')
+    parser.add_argument('--count', type=int, default=512)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--engines', nargs='+', choices=list(color_engines),
+                        default=list(color_engines))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str,
+                        help='append JSON lines to this file')
+    args = parser.parse_args()
+
+    engines = args.engines
+    if peak_find_3d is None and 'ekstrakto' in engines:
+        print('ekstrakto is not installed, agreement is not reported',
+              file=sys.stderr)
+        engines = [e for e in engines if e != 'ekstrakto']
+    if args.images:
+        thumbnails = directory_thumbnails(args.images, args.count)
+    else:
+        rng = np.random.default_rng(args.seed)
+        thumbnails = palette_thumbnails(args.count, rng)
+
+    out = open(args.output, 'a') if args.output else sys.stdout
+    for result in run_engines(thumbnails, engines, args.batch_size):
+        result['source'] = args.images or 'synthetic'
+        out.write(json.dumps(result) + '\n')
+    if out is not sys.stdout:
+        out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+'''
+Thumbnail decode benchmark.
+
+Decodes every image with the full decode + thumbnail path and with
+sb.decode.decode_thumbnail, and writes one JSON object per image format
+with the throughput of both and how far the fast thumbnails are from the
+full ones, e.g.
+
+    python -m benchmarks.decode --images ~/Pictures --count 500
+'''
+import itertools
+import json
+import sys
+import time
+from argparse import ArgumentParser
+from collections import Counter, defaultdict
+
+import numpy as np
+from PIL import Image as PILImageM
+
+from sb.decode import MAX_DECODE_PIXELS, decode_thumbnail
+from sb.files import get_image_paths
+
+
+def full_decode(file_path, size):
+    with PILImageM.open(str(file_path)) as img:
+        img.load()
+        # Without draft mode or reducing_gap the whole image is decoded
+        img = img.convert('RGB')
+        img.thumbnail((size, size), reducing_gap=None)
+        return img
+
+
+def compare(img, reference):
+    if img.size != reference.size:
+        img = img.resize(reference.size)
+    a = np.asarray(img, dtype='float64')
+    b = np.asarray(reference, dtype='float64')
+    mse = np.mean((a - b) ** 2)
+    psnr = 10 * np.log10(255.0 ** 2 / mse) if mse > 0 else float('inf')
+    return float(np.mean(np.abs(a - b))), float(psnr)
+
+
+def run(file_paths, size, max_pixels, use_exif):
+    stats = defaultdict(lambda: defaultdict(list))
+    methods = defaultdict(Counter)
+    for file_path in file_paths:
+        try:
+            with PILImageM.open(str(file_path)) as img:
+                image_format = img.format or 'unknown'
+            begin_t = time.perf_counter()
+            reference = full_decode(file_path, size)
+            full_t = time.perf_counter() - begin_t
+            begin_t = time.perf_counter()
+            img, method = decode_thumbnail(file_path, size, max_pixels,
+                                           use_exif)
+            fast_t = time.perf_counter() - begin_t
+        except Exception as ex:
+            print('Skipping', file_path, ex, file=sys.stderr)
+            continue
+        mean_abs_error, psnr = compare(img, reference)
+        entry = stats[image_format]
+        entry['full_seconds'].append(full_t)
+        entry['fast_seconds'].append(fast_t)
+        entry['mean_abs_error'].append(mean_abs_error)
+        entry['psnr'].append(psnr)
+        methods[image_format][method] += 1
+
+    results = []
+    for image_format, entry in stats.items():
+        n = len(entry['full_seconds'])
+        full_t = sum(entry['full_seconds'])
+        fast_t = sum(entry['fast_seconds'])
+        psnr = np.array(entry['psnr'])
+        results.append({
+            'format': image_format,
+            'images': n,
+            'methods': dict(methods[image_format]),
+            'full_images_per_second': n / max(full_t, 1e-9),
+            'fast_images_per_second': n / max(fast_t, 1e-9),
+            'speedup': full_t / max(fast_t, 1e-9),
+            'mean_abs_error': float(np.mean(entry['mean_abs_error'])),
+            'max_abs_error': float(np.max(entry['mean_abs_error'])),
+            'psnr_median': float(np.median(psnr)),
+            'psnr_min': float(np.min(psnr))
+        })
+    return results
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark thumbnail decoding')
+    parser.add_argument('--images', type=str, required=True,
+                        help='directory of images')
+    parser.add_argument('--count', type=int, default=200)
+    parser.add_argument('--size', type=int, default=64)
+    parser.add_argument('--max-pixels', type=int, default=MAX_DECODE_PIXELS)
+    parser.add_argument('--no-exif', action='store_true',
+                        help='ignore embedded EXIF thumbnails')
+    parser.add_argument('--output', type=str,
+                        help='append JSON lines to this file')
+    args = parser.parse_args()
+
+    file_paths = list(itertools.islice(get_image_paths(args.images),
+                                       args.count))
+    out = open(args.output, 'a') if args.output else sys.stdout
+    for result in run(file_paths, args.size, args.max_pixels,
+                      not args.no_exif):
+        out.write(json.dumps(result) + '\n')
+    if out is not sys.stdout:
+        out.close()
+
+
+if __name__ == '__main__':
+    main()
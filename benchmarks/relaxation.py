@@ -0,0 +1,209 @@
+'''
+Headless PointRelaxer benchmark.
+
+Runs every combination of the given parameters in a fresh process and
+writes one JSON object per run to stdout or --output, e.g.
+
+    python -m benchmarks.relaxation --sizes 1000 100000 --workers 2 8
+'''
+import itertools
+import json
+import resource
+import sys
+import time
+from argparse import ArgumentParser
+from multiprocessing import Process, Queue
+from queue import Empty
+
+import numpy as np
+
+from sb.animation import PointRelaxer, relax_kernels
+from sb.layout import layout_backends, DelaunayBackend
+
+
+def uniform_cloud(n, rng):
+    return rng.random((n, 2))
+
+
+def clustered_cloud(n, rng, n_clusters=16, spread=0.02):
+    centers = rng.random((n_clusters, 2))
+    labels = rng.integers(0, n_clusters, n)
+    return centers[labels] + rng.normal(0, spread, (n, 2))
+
+
+def degenerate_cloud(n, rng):
+    # Collinear points with exact duplicates, the worst case for qhull
+    t = rng.random(n)
+    points = np.stack((t, 0.5 * t), axis=1)
+    points[n // 2:] = points[:n - n // 2]
+    return points
+
+
+clouds = {
+    'uniform': uniform_cloud,
+    'clustered': clustered_cloud,
+    'degenerate': degenerate_cloud
+}
+
+
+def max_rss_kb(who):
+    rss = resource.getrusage(who).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def run_relaxer(config, timeout, poll_interval, results):
+    rng = np.random.default_rng(config['seed'])
+    points = clouds[config['cloud']](config['n'], rng)
+
+    relaxer = PointRelaxer()
+    relaxer.n_relaxation_workers = config['workers']
+    relaxer.relax_kernel = config['kernel']
+    relaxer.alpha.value = config['alpha']
+    relaxer.beta.value = config['beta']
+    relaxer.layout_backend = config['backend']
+    relaxer.init_processes(config['n'])
+    relaxer.start_all()
+
+    begin_t = time.perf_counter()
+    relaxer.set_points(points)
+    convergence_time = None
+    error = None
+    while time.perf_counter() - begin_t < timeout:
+        time.sleep(poll_interval)
+        if relaxer.is_idle and relaxer.n_points.value == config['n']:
+            # Idles on a failed layout too, that is not convergence
+            if relaxer.backend_failed.value:
+                error = 'layout backend failed'
+            else:
+                convergence_time = time.perf_counter() - begin_t
+            break
+    elapsed = time.perf_counter() - begin_t
+    # Idle time only counts once the points arrived
+    busy_time = max(elapsed - relaxer.idle_time.value, 1e-9)
+    n_relax_steps = relaxer.n_relax_steps.value
+    n_triangulations = relaxer.n_triangulations.value
+    relaxer.stop_all()
+
+    result = dict(config)
+    result.update({
+        'elapsed': elapsed,
+        'converged': convergence_time is not None,
+        'error': error,
+        'convergence_time': convergence_time,
+        'relax_steps': n_relax_steps,
+        'triangulations': n_triangulations,
+        'relax_steps_per_second': n_relax_steps / busy_time,
+        'triangulations_per_second': n_triangulations / busy_time,
+        'peak_rss_kb': max_rss_kb(resource.RUSAGE_SELF),
+        'peak_child_rss_kb': max_rss_kb(resource.RUSAGE_CHILDREN)
+    })
+    results.put(result)
+
+
+def compare_kernels(cloud, n, alpha, beta, seed):
+    '''
+    Runs every relax kernel once over the same Delaunay graph in this
+    process and reports timings and the largest deviation from the
+    python reference kernel.
+    '''
+    rng = np.random.default_rng(seed)
+    points = clouds[cloud](n, rng).astype('float32')
+    points += 0.00001 * rng.random(points.shape)
+    backend = DelaunayBackend()
+    backend.update(points, beta, 0)
+    indices = range(n)
+    outputs = {}
+    result = {'cloud': cloud, 'n': n, 'alpha': alpha, 'beta': beta}
+    for name, kernel in relax_kernels.items():
+        relaxed = np.zeros_like(points)
+        begin_t = time.perf_counter()
+        kernel(indices, points, relaxed, backend.neighbor_divs,
+               backend.neighbors, alpha, beta)
+        result[f'{name}_seconds'] = time.perf_counter() - begin_t
+        outputs[name] = relaxed
+    reference = outputs['python']
+    for name, relaxed in outputs.items():
+        result[f'{name}_max_abs_error'] = \
+            float(np.abs(relaxed - reference).max())
+    return result
+
+
+def run_isolated(config, timeout, poll_interval):
+    # A fresh process per run keeps the peak RSS figures separate
+    results = Queue()
+    p = Process(target=run_relaxer,
+                args=(config, timeout, poll_interval, results))
+    p.start()
+    # The run times out by itself, this catches a crashed or hung child
+    deadline = time.perf_counter() + timeout + 60.0
+    result = None
+    while result is None:
+        try:
+            result = results.get(timeout=1.0)
+        except Empty:
+            if not p.is_alive() or time.perf_counter() > deadline:
+                break
+    if result is None:
+        if p.is_alive():
+            p.terminate()
+        p.join()
+        result = dict(config)
+        result.update({'converged': False,
+                       'error': f'run exited with code {p.exitcode}'})
+    else:
+        p.join()
+    return result
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark PointRelaxer headless')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000],
+                        help='point counts, e.g. 1000 up to 1000000')
+    parser.add_argument('--workers', type=int, nargs='+', default=[8])
+    parser.add_argument('--alphas', type=float, nargs='+', default=[0.2])
+    parser.add_argument('--betas', type=float, nargs='+', default=[0.04])
+    parser.add_argument('--clouds', nargs='+', choices=list(clouds),
+                        default=list(clouds))
+    parser.add_argument('--backends', nargs='+',
+                        choices=list(layout_backends), default=['delaunay'])
+    parser.add_argument('--kernels', nargs='+', choices=list(relax_kernels),
+                        default=['vectorized'])
+    parser.add_argument('--timeout', type=float, default=30.0,
+                        help='seconds to wait for convergence per run')
+    parser.add_argument('--poll-interval', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str,
+                        help='append JSON lines to this file')
+    parser.add_argument('--compare-kernels', action='store_true',
+                        help='check the kernels against each other in '
+                             'process instead of running the relaxer')
+    args = parser.parse_args()
+
+    out = open(args.output, 'a') if args.output else sys.stdout
+    if args.compare_kernels:
+        for cloud, n, alpha, beta in itertools.product(
+                args.clouds, args.sizes, args.alphas, args.betas):
+            try:
+                result = compare_kernels(cloud, n, alpha, beta, args.seed)
+            except Exception as ex:
+                result = {'cloud': cloud, 'n': n, 'error': str(ex)}
+            out.write(json.dumps(result) + '\n')
+            out.flush()
+    else:
+        keys = ('cloud', 'n', 'workers', 'alpha', 'beta', 'backend',
+                'kernel')
+        for values in itertools.product(
+                args.clouds, args.sizes, args.workers, args.alphas,
+                args.betas, args.backends, args.kernels):
+            config = dict(zip(keys, values), seed=args.seed)
+            result = run_isolated(config, args.timeout, args.poll_interval)
+            out.write(json.dumps(result) + '\n')
+            out.flush()
+    if out is not sys.stdout:
+        out.close()
+
+
+if __name__ == '__main__':
+    main()
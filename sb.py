@@ -1,9 +1,18 @@
 import multiprocessing
+import sys
 from argparse import ArgumentParser
 
 
 if __name__ == '__main__':
+    if '--headless' in sys.argv[1:]:
+        # Without Kivy, see sb.headless for the options
+        from sb.headless import main
+        multiprocessing.freeze_support()
+        main([a for a in sys.argv[1:] if a != '--headless'])
+        sys.exit()
+
     from kivy.app import App
+    from sb import metrics
     # Kv imports
     from sb.sbview import SBView
     from sb.sbscatter import SBScatter
@@ -15,6 +24,8 @@ if __name__ == '__main__':
             super(SBApp, self).__init__()
             self.initial_images_dir_path = None
             self.initial_thumbnails_dir_path = None
+            self.metrics_path = None
+            self.trace_path = None
 
         def on_start(self):
             root_view = self.root
@@ -30,17 +41,32 @@ if __name__ == '__main__':
         def on_stop(self):
             root_view = self.root
             assert (isinstance(root_view, RootView))
+            metrics.collect()
             root_view.on_stop()
+            collector = metrics.get_collector()
+            if self.metrics_path:
+                collector.export_json(self.metrics_path)
+            if self.trace_path:
+                collector.export_chrome_trace(self.trace_path)
+            metrics.disable()
 
 
     def main():
         parser = ArgumentParser()
         parser.add_argument('--images', type=str)
         parser.add_argument('--thumbnail-images', type=str)
+        parser.add_argument('--metrics', type=str,
+                            help='write per-stage metrics to this JSON file')
+        parser.add_argument('--trace', type=str,
+                            help='write a Chrome trace to this file')
         args = parser.parse_args()
         images_path = args.images
         thumbnails_path = args.thumbnail_images
         app = SBApp()
+        if args.metrics or args.trace:
+            metrics.enable()
+            app.metrics_path = args.metrics
+            app.trace_path = args.trace
         if images_path:
             app.initial_images_dir_path = images_path
         if thumbnails_path:
@@ -1,10 +1,19 @@
 from collections import deque
 
 import numpy as np
-from ekstrakto.helpers import peak_find_3d
 from PIL.Image import Image as PILImage
 from sklearn.decomposition import IncrementalPCA
 
+from sb.colors import get_color_engine, get_dominant_colors_batch
+
+
+# Columns of the per-image rows produced by the batch analysis, in the
+# order of Analysis.get_data
+ANALYSIS_MEAN = 0
+ANALYSIS_CONTRAST = 1
+ANALYSIS_COLORS = slice(2, 11)
+ANALYSIS_SIZE = 11
+
 
 class Analysis:
     def __init__(self, mean, contrast, *args, **kwargs):
@@ -12,6 +21,11 @@ class Analysis:
         self.contrast = contrast
         self.colors = kwargs.get('colors', [])
 
+    @classmethod
+    def from_data(cls, data):
+        return cls(data[ANALYSIS_MEAN], data[ANALYSIS_CONTRAST],
+                   colors=np.reshape(data[ANALYSIS_COLORS], (-1, 3)))
+
     def get_data(self):
         return [self.mean, self.contrast, *self.colors[:3].flatten()]
 
@@ -26,14 +40,59 @@ def get_basic_analysis(array):
     return Analysis(mean, contrast)
 
 
-def extend_analysis(array, analysis):
+def get_dominant_colors(pixels, n_colors=3, engine='histogram'):
+    '''
+    :param engine: name of a color engine in sb.colors.color_engines
+    :return: (n_colors, 3) colors, strongest first
+    '''
+    return get_color_engine(engine)(pixels, n_colors=n_colors)
+
+
+def extend_analysis(array, analysis, engine='histogram'):
     # Calculate dominant colors
-    colors, _ = peak_find_3d(array, 7, 2.0)
-    n_colors = 3
-    if colors.shape[0] < n_colors:
-        fill = np.repeat([colors[-1]], n_colors - colors.shape[0], axis=0)
-        colors = np.concatenate((colors, fill), 0)
-    analysis.colors = colors
+    analysis.colors = get_dominant_colors(array, engine=engine)
+
+
+def stack_images(arrays):
+    '''
+    Pads images of different sizes into one batch.
+
+    :param arrays: (height, width, channels) arrays of one dtype
+    :return: (B, H, W, channels) stack and (B, H, W) bool mask of the pixels
+        belonging to each image
+    '''
+    height = max(a.shape[0] for a in arrays)
+    width = max(a.shape[1] for a in arrays)
+    channels = arrays[0].shape[2]
+    stack = np.zeros((len(arrays), height, width, channels),
+                     dtype=arrays[0].dtype)
+    mask = np.zeros((len(arrays), height, width), dtype=bool)
+    for i, a in enumerate(arrays):
+        stack[i, :a.shape[0], :a.shape[1]] = a
+        mask[i, :a.shape[0], :a.shape[1]] = True
+    return stack, mask
+
+
+def get_basic_analysis_batch(stack, mask):
+    '''
+    Same statistics as get_basic_analysis for a whole padded batch.
+
+    :return: (B, 2) array of mean and contrast per image
+    '''
+    weights = mask[..., None]
+    n_values = np.maximum(mask.sum(axis=(1, 2)) * stack.shape[3], 1)
+    mean = np.sum(stack * weights, axis=(1, 2, 3), dtype='float64') / n_values
+    deviation = np.abs(stack - mean[:, None, None, None]) * weights
+    contrast = np.sum(deviation, axis=(1, 2, 3), dtype='float64') / n_values
+    return np.stack((mean, contrast), axis=1)
+
+
+def extend_analysis_batch(stack, mask, data, engine='histogram'):
+    '''
+    Fills the dominant colors of each image into its row of data.
+    '''
+    colors = get_dominant_colors_batch(stack, mask, 3, engine)
+    data[:, ANALYSIS_COLORS] = colors.reshape(len(stack), -1)
 
 
 def get_2d_ipca():
@@ -45,6 +104,76 @@ def incremental_batch_fit_transform(ipca, data, chunk):
     return ipca.transform(data)
 
 
+class Projection:
+    '''
+    Feature vectors of all analysed images with their 2D coordinates under
+    the latest PCA basis. Features arrive once; a new basis reprojects every
+    point with a single matrix multiply.
+    '''
+    def __init__(self, capacity=1024):
+        self.node_ids = []
+        self.features = None
+        self.capacity = capacity
+        self.version = -1
+        self.mean = None
+        self.components = None
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def add(self, node_ids, features):
+        features = np.asarray(features, dtype='float64')
+        n = len(self.node_ids)
+        if self.features is None:
+            self.features = np.zeros((self.capacity, features.shape[1]))
+        if n + len(features) > len(self.features):
+            grown = np.zeros((max(2 * len(self.features), n + len(features)),
+                              self.features.shape[1]))
+            grown[:n] = self.features[:n]
+            self.features = grown
+        self.features[n:n + len(features)] = features
+        self.node_ids.extend(node_ids)
+
+    def remove(self, node_ids):
+        '''
+        Drops the points of node_ids, moving the last points into their rows.
+        '''
+        rows = {node_id: i for i, node_id in enumerate(self.node_ids)}
+        indices = sorted((rows[node_id] for node_id in node_ids
+                          if node_id in rows), reverse=True)
+        n = len(self.node_ids)
+        for i in indices:
+            n -= 1
+            self.node_ids[i] = self.node_ids[n]
+            self.features[i] = self.features[n]
+        del self.node_ids[n:]
+
+    def reset_version(self):
+        '''
+        Accepts the bases of a new sequence of versions, as published by a
+        new producer. The current basis is kept until the first of them.
+        '''
+        self.version = -1
+
+    def set_basis(self, version, mean, components):
+        '''
+        :return: True if the basis is newer than the current one
+        '''
+        if version <= self.version:
+            return False
+        self.version = version
+        self.mean = mean
+        self.components = components
+        return True
+
+    def transform(self, begin=0, end=None):
+        '''
+        :return: (n, 2) coordinates of the points in [begin, end)
+        '''
+        end = len(self.node_ids) if end is None else end
+        return (self.features[begin:end] - self.mean) @ self.components.T
+
+
 def process_nd_to_1d(array):
     # TODO
     return IncrementalPCA(n_components=1).fit_transform(array)[:, 0]
@@ -0,0 +1,116 @@
+import sqlite3
+
+import numpy as np
+
+from sb.analysis import Analysis
+from sb.files import get_file_key
+
+# Bumped whenever the schema or the meaning of the cached values changes,
+# caches of older versions are dropped
+SCHEMA_VERSION = 2
+
+
+class AnalysisCache:
+    '''
+    On-disk cache of Analysis results in SQLite, keyed by file path, size,
+    modification time and the color engine that found the dominant colors.
+    A changed file or another engine misses and is recomputed. Each
+    process opens its own connection, so instances can be handed to
+    worker processes.
+    '''
+    def __init__(self, db_path, engine='histogram'):
+        '''
+        :param engine: name of the color engine, see sb.colors.color_engines
+        '''
+        self.db_path = str(db_path)
+        self.engine = engine
+        self._connection = None
+        self.hits = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        return state
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30)
+            # Lets many worker processes read while one writes
+            connection.execute('PRAGMA journal_mode=WAL')
+            version, = connection.execute('PRAGMA user_version').fetchone()
+            if version != SCHEMA_VERSION:
+                with connection:
+                    connection.execute('DROP TABLE IF EXISTS analysis')
+                    connection.execute(
+                        f'PRAGMA user_version = {SCHEMA_VERSION}')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS analysis ('
+                'path TEXT, engine TEXT, size INTEGER, mtime_ns INTEGER, '
+                'mean REAL, contrast REAL, colors BLOB, '
+                'PRIMARY KEY (path, engine))')
+            self._connection = connection
+        return self._connection
+
+    def get(self, file_key):
+        path, size, mtime_ns = file_key
+        row = self.connection.execute(
+            'SELECT mean, contrast, colors FROM analysis '
+            'WHERE path = ? AND engine = ? AND size = ? AND mtime_ns = ?',
+            (path, self.engine, size, mtime_ns)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        mean, contrast, colors = row
+        colors = np.frombuffer(colors, dtype='float64').reshape(-1, 3)
+        return Analysis(mean, contrast, colors=colors)
+
+    def put(self, file_key, analysis):
+        self.put_many([file_key], [analysis])
+
+    def put_many(self, file_keys, analyses):
+        rows = []
+        for (path, size, mtime_ns), analysis in zip(file_keys, analyses):
+            colors = np.asarray(analysis.colors, dtype='float64')[:3]
+            rows.append((path, self.engine, size, mtime_ns,
+                         float(analysis.mean), float(analysis.contrast),
+                         colors.tobytes()))
+        # One transaction for the whole batch
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO analysis '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def invalidate(self, file_path):
+        with self.connection:
+            self.connection.execute(
+                'DELETE FROM analysis WHERE path = ?', (str(file_path),))
+
+    def prune(self):
+        '''
+        Removes entries whose file is gone or has changed.
+
+        :return: number of removed entries
+        '''
+        rows = self.connection.execute(
+            'SELECT DISTINCT path, size, mtime_ns FROM analysis').fetchall()
+        stale = []
+        for path, size, mtime_ns in rows:
+            try:
+                if get_file_key(path) != (path, size, mtime_ns):
+                    stale.append((path, size, mtime_ns))
+            except OSError:
+                stale.append((path, size, mtime_ns))
+        n_changes = self.connection.total_changes
+        with self.connection:
+            self.connection.executemany(
+                'DELETE FROM analysis '
+                'WHERE path = ? AND size = ? AND mtime_ns = ?', stale)
+        return self.connection.total_changes - n_changes
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
@@ -1,21 +1,26 @@
 import numpy as np
-from scipy.spatial import Delaunay
 from math import exp, log
-from .math import soft_minimum
-from multiprocessing import Process, Value, Array
-from ctypes import Structure, c_long, c_float
-from sb.utilities import spin, acquire_timeout
-from copy import copy
-
-class Vector2(Structure):
-    _fields_ = [('x', c_float), ('y', c_float)]
-
-    def __iter__(self):
-        yield from (self.x, self.y)
+from .math import soft_minimum, soft_minimum_array
+import time
+import secrets
+from multiprocessing import Process, Value, Barrier, Event, RLock
+from threading import BrokenBarrierError
+from sb import metrics
+from sb.shared_arrays import SharedArray, DoubleBuffer, SparseInbox, \
+    grow_capacity
+from sb.layout import layout_backends, expand_ranges
+
+# Indices into PointRelaxer.buffer_layout, which announces the current shared
+# buffers to every process
+IO_GENERATION = 0
+IO_CAPACITY = 1
+WORK_GENERATION = 2
+WORK_CAPACITY = 3
+NEIGHBOR_CAPACITY = 4
 
 def delaunay_relax_points(
         indices, points, points_relaxed, neighbor_divs, neighbors,
-        alpha, beta):
+        alpha, beta, weights=None):
 
     def get_neighbors(point_index):
         a = neighbor_divs[point_index]
@@ -27,142 +32,364 @@ def delaunay_relax_points(
         neighbor_indices = get_neighbors(idx)
         p_neighbors = [points[i] for i in neighbor_indices]
         delta = np.zeros_like(p)
-        for neighbor in p_neighbors:
+        for k, neighbor in enumerate(p_neighbors):
+            w = 1 if weights is None else weights[neighbor_divs[idx] + k]
             n = np.frombuffer(neighbor).view('<f4') - p
             n_norm = np.linalg.norm(n)
             s = n_norm - beta
             s = soft_minimum(0, s) + log(2)
             #s = min(0, s)
             n = n / (n_norm + 0.0001)
-            delta = delta + alpha * s * n
+            delta = delta + alpha * w * s * n
         points_relaxed[idx] = tuple(p + delta)
 
+def relax_csr(points, indices, neighbor_divs, neighbors, alpha, beta,
+              weights=None):
+    '''
+    :param points: (n, 2) array of all points
+    :param indices: indices of the points to relax
+    :param neighbor_divs: CSR row offsets, as in
+        Delaunay.vertex_neighbor_vertices
+    :param neighbors: CSR column indices
+    :param weights: optional per-edge weights
+    :return: (len(indices), 2) array of relaxed points
+    '''
+    indices = np.asarray(indices, dtype=np.intp)
+    p = points[indices]
+    starts = neighbor_divs[indices]
+    counts = neighbor_divs[indices + 1] - starts
+    n_edges = int(counts.sum())
+    if not n_edges:
+        return p.copy()
+
+    # Flatten the CSR rows of all requested points into one edge list
+    vertex, positions = expand_ranges(starts, counts)
+    edges = neighbors[positions]
+
+    n = points[edges] - p[vertex]
+    n_norm = np.hypot(n[:, 0], n[:, 1])
+    s = soft_minimum_array(0, n_norm - beta) + log(2)
+    w = alpha * s / (n_norm + 0.0001)
+    if weights is not None:
+        w = w * weights[positions]
+
+    delta = np.empty(p.shape, dtype='float64')
+    delta[:, 0] = np.bincount(vertex, w * n[:, 0], minlength=indices.size)
+    delta[:, 1] = np.bincount(vertex, w * n[:, 1], minlength=indices.size)
+    return p + delta
+
+def delaunay_relax_points_vectorized(
+        indices, points, points_relaxed, neighbor_divs, neighbors,
+        alpha, beta, weights=None):
+    indices = np.asarray(indices, dtype=np.intp)
+    if not indices.size:
+        return
+    points_relaxed[indices] = relax_csr(
+        points, indices, neighbor_divs, neighbors, alpha, beta, weights)
+
+relax_kernels = {
+    'python': delaunay_relax_points,
+    'vectorized': delaunay_relax_points_vectorized
+}
+
+class RelaxationBuffers:
+    '''
+    Working buffers of one relaxation round. Owned by the Delaunay worker,
+    attached by name in the relaxation workers.
+    '''
+    def __init__(self, prefix, generation, capacity, neighbor_capacity,
+                 create):
+        name = f'{prefix}w{generation}'
+        self.generation = generation
+        self.capacity = capacity
+        self.neighbor_capacity = neighbor_capacity
+        self.points = SharedArray(
+            (capacity, 2), 'float32', name + 'p', create)
+        self.points_relaxed = SharedArray(
+            (capacity, 2), 'float32', name + 'r', create)
+        self.neighbor_divs = SharedArray(
+            (capacity + 1,), 'int32', name + 'd', create)
+        self.neighbors = SharedArray(
+            (neighbor_capacity,), 'int32', name + 'n', create)
+        self.weights = SharedArray(
+            (neighbor_capacity,), 'float32', name + 'w', create)
+
+    @classmethod
+    def attach(cls, prefix, buffer_layout):
+        return cls(prefix, int(buffer_layout[WORK_GENERATION]),
+                   int(buffer_layout[WORK_CAPACITY]),
+                   int(buffer_layout[NEIGHBOR_CAPACITY]), False)
+
+    def _arrays(self):
+        return (self.points, self.points_relaxed, self.neighbor_divs,
+                self.neighbors, self.weights)
+
+    def close(self):
+        for a in self._arrays():
+            a.close()
+
+    def release(self):
+        for a in self._arrays():
+            a.release()
+
+
+def io_buffer_name(prefix, generation):
+    return f'{prefix}io{generation}'
+
+
 def delaunay_loop(
-        n_relax_procs,
-        points_io,
-        points_io_var,
+        prefix,
+        buffer_layout,
+        io_lock,
         cancellation,
-        relax_var,
-        relax_completed_var,
+        wake_event,
+        idle,
+        idle_time,
+        tolerance,
+        rebuild_threshold,
+        n_triangulations,
+        n_relax_steps,
+        beta,
+        backend_index,
+        weighted,
+        neighbor_multiplier,
+        start_barrier,
+        done_barrier,
         n_points,
-        points,
-        points_relaxed,
-        neighbor_divs,
-        neighbors):
-    while True:
-        with cancellation.get_lock():
-            if cancellation.value:
-                return
-
-        # Wait for all relaxation workers to complete
-        skip = False
-        with relax_completed_var.get_lock():
-            skip = relax_completed_var.value > 0
-            if not skip:
-                if not n_points.value:
-                    skip = True
-                else:
-                    with points_io.get_lock():
-                        # TODO: can this be optimized?
-                        if points_io_var.value:  # Write in
-                            for idx in range(n_points.value):
-                                points[idx] = points_io[idx]
-                            points_io_var.value = 0
-                        else:
-                            for idx in range(n_points.value):
-                                r = points_relaxed[idx]
-                                points[idx] = r
-                                points_io[idx] = r
-
-
-        if skip:
-            continue
-
-        # Calculate Delaunay
-        with relax_completed_var.get_lock():
-            # Get np view from points array
-            array = np.frombuffer(
-                points,
-                dtype=Vector2,
-                count=n_points.value).view('<f4').reshape(-1, 2)
-
-            try:
-                delaunay = Delaunay(array)
-            except Exception as ex:
+        backend_failed,
+        metrics_queue=None):
+    metrics.init_worker(metrics_queue)
+    # Keep the SharedArray referenced for as long as its view is in use
+    shared_buffer_layout = buffer_layout
+    buffer_layout = shared_buffer_layout.array
+    points_in = None
+    points_out = None
+    io_generation = None
+    buffers = None
+
+    def sync_io():
+        # Must be called with io_lock held
+        nonlocal points_in, points_out, io_generation
+        if buffer_layout[IO_GENERATION] != io_generation:
+            if points_in is not None:
+                points_in.close()
+                points_out.close()
+            io_generation = int(buffer_layout[IO_GENERATION])
+            capacity = int(buffer_layout[IO_CAPACITY])
+            name = io_buffer_name(prefix, io_generation)
+            points_in = SparseInbox(capacity, (2,), 'float32', name + 'i',
+                                    False, io_lock)
+            points_out = DoubleBuffer(capacity, (2,), 'float32', name + 'o',
+                                      False)
+
+    def ensure_capacity(n, n_neighbors):
+        nonlocal buffers
+        capacity = buffers.capacity if buffers else 0
+        neighbor_capacity = buffers.neighbor_capacity if buffers else 0
+        if n <= capacity and n_neighbors <= neighbor_capacity:
+            return
+        generation = buffers.generation + 1 if buffers else 1
+        capacity = grow_capacity(capacity, n)
+        neighbor_capacity = grow_capacity(
+            neighbor_capacity,
+            max(n_neighbors, neighbor_multiplier * capacity))
+        grown = RelaxationBuffers(
+            prefix, generation, capacity, neighbor_capacity, True)
+        if buffers:
+            n_prior = n_points.value
+            grown.points.array[:n_prior] = buffers.points.array[:n_prior]
+            # Workers are parked on the barrier and reattach by name, so
+            # the old blocks can go right away
+            buffers.release()
+        buffers = grown
+        buffer_layout[WORK_CAPACITY] = capacity
+        buffer_layout[NEIGHBOR_CAPACITY] = neighbor_capacity
+        buffer_layout[WORK_GENERATION] = generation
+
+    backend_names = list(layout_backends)
+    backend = None
+    # Generation of the buffers that hold the current graph
+    graph_generation = None
+    settled = False
+    try:
+        while not cancellation.value:
+            # Anything that arrives after this wakes the wait below
+            wake_event.clear()
+            idle.value = 0
+            n = n_points.value
+            # Apply pending dense or sparse writes
+            with io_lock:
+                sync_io()
+                ensure_capacity(max(n, points_in.length), 0)
+                n_in = points_in.take(buffers.points.array)
+                if n_in is not None:
+                    n = n_in
+                    n_points.value = n
+                    points_out.publish(buffers.points.array[:n])
+                    settled = False
+
+            # Sleep until woken by new points, parameters or cancellation
+            if settled or n < 3:
+                idle.value = 1
+                idle_t = time.perf_counter()
+                wake_event.wait()
+                idle_time.value += time.perf_counter() - idle_t
+                settled = False
                 continue
 
-            # Copy neighbor data into lists
-            nds, ns = delaunay.vertex_neighbor_vertices
-            for i, nd in enumerate(nds):
-                neighbor_divs[i] = nd
-            for i, n in enumerate(ns):
-                neighbors[i] = n
-            # Set relax counter
+            # Switch layout backends on request
+            name = backend_names[backend_index.value]
+            if not isinstance(backend, layout_backends[name]):
+                backend = layout_backends[name]()
+                graph_generation = None
 
-            relax_var.value = n_relax_procs
-            relax_completed_var.value = n_relax_procs
+            # Build the neighbor graph, reusing the prior one if possible
+            with beta.get_lock():
+                _beta = beta.value
+            threshold = rebuild_threshold.value * _beta
+            try:
+                with metrics.span('delaunay'):
+                    changed = backend.update(
+                        buffers.points.array[:n], _beta, threshold)
+            except Exception:
+                # Degenerate input, wait for the points to change
+                backend_failed.value = 1
+                settled = True
+                continue
+            backend_failed.value = 0
+            n_triangulations.value += changed
+
+            # Copy neighbor data into the shared arrays
+            nds, ns = backend.neighbor_divs, backend.neighbors
+            far_points = backend.far_points
+            n_far = len(far_points) if far_points is not None else 0
+            ensure_capacity(n + n_far, len(ns))
+            if changed or graph_generation != buffers.generation:
+                buffers.neighbor_divs.array[:len(nds)] = nds
+                buffers.neighbors.array[:len(ns)] = ns
+                if backend.weights is not None:
+                    buffers.weights.array[:len(ns)] = backend.weights
+                weighted.value = backend.weights is not None
+                graph_generation = buffers.generation
+            if n_far:
+                buffers.points.array[n:n + n_far] = far_points
+
+            # Run one relaxation round on all workers
+            with metrics.span('relax'):
+                start_barrier.wait()
+                done_barrier.wait()
+            n_relax_steps.value += 1
+
+            points = buffers.points.array[:n]
+            points_relaxed = buffers.points_relaxed.array[:n]
+            displacement = np.abs(points_relaxed - points).max()
+            points[:] = points_relaxed
+            with io_lock:
+                sync_io()
+                points_out.publish(points)
+            settled = displacement < tolerance.value
+            del points, points_relaxed
+    except BrokenBarrierError:
+        pass
+    finally:
+        metrics.flush()
+        idle.value = 1
+        if buffers:
+            buffers.release()
+        if points_in is not None:
+            points_in.close()
+            points_out.close()
 
 def relax_points_loop(
         offset,
         stride,
+        kernel,
         alpha,
         beta,
-        cancellation,
-        relax_var,
-        relax_completed_var,
+        weighted,
+        prefix,
+        buffer_layout,
+        start_barrier,
+        done_barrier,
         n_points,
-        points,
-        points_relaxed,
-        neighbor_divs,
-        neighbors):
-    while True:
-        with cancellation.get_lock():
-            if cancellation.value:
-                return
-        # Wait for Delaunay worker
-        skip = False
-        with relax_var.get_lock():
-            if relax_var.value > 0:
-                relax_var.value = relax_var.value - 1
-            else:
-                skip = True
-        if skip:
-            continue
-
-        points_indices = range(offset, n_points.value, stride)
-
-        with alpha.get_lock():
-            _alpha = alpha.value
-        with beta.get_lock():
-            _beta = beta.value
-
-        delaunay_relax_points(
-            points_indices, points, points_relaxed, neighbor_divs,
-            neighbors, _alpha, _beta)
-
-        with relax_completed_var.get_lock():
-            relax_completed_var.value = relax_completed_var.value - 1
+        metrics_queue=None):
+    metrics.init_worker(metrics_queue)
+    shared_buffer_layout = buffer_layout
+    buffer_layout = shared_buffer_layout.array
+    buffers = None
+    try:
+        while True:
+            # Wait for Delaunay worker
+            start_barrier.wait()
+
+            # Follow the buffers if they were reallocated
+            if not buffers or buffers.generation != buffer_layout[WORK_GENERATION]:
+                if buffers:
+                    buffers.close()
+                buffers = RelaxationBuffers.attach(prefix, buffer_layout)
+
+            points_indices = range(offset, n_points.value, stride)
+
+            with alpha.get_lock():
+                _alpha = alpha.value
+            with beta.get_lock():
+                _beta = beta.value
+
+            with metrics.span('relax_kernel'):
+                relax_kernels[kernel](
+                    points_indices, buffers.points.array,
+                    buffers.points_relaxed.array, buffers.neighbor_divs.array,
+                    buffers.neighbors.array, _alpha, _beta,
+                    buffers.weights.array if weighted.value else None)
+            metrics.count('relaxed_points', len(points_indices))
+
+            done_barrier.wait()
+    except BrokenBarrierError:
+        pass
+    finally:
+        metrics.flush()
+        if buffers:
+            buffers.close()
 
 
 class PointRelaxer():
     def __init__(self):
         self.n_relaxation_workers = 8
-        # self.points_array = None
-        # self.work_array = None
+        # One of relax_kernels
+        self.relax_kernel = 'vectorized'
         self.cancellation = Value('i', 0, lock=True)
-        self.relax_var = Value('i', 0, lock=True)
-        self.relax_completed_var = Value('i', 0, lock=True)
+        self.wake_event = Event()
+        self.idle = Value('i', 1, lock=False)
+        self.idle_time = Value('d', 0.0, lock=False)
+        # Largest per-round displacement at which relaxation is settled
+        self.tolerance = Value('f', 1e-6, lock=False)
+        # Displacement since the last triangulation, relative to beta, at
+        # which the neighbor graph is rebuilt
+        self.rebuild_threshold = Value('f', 0.25, lock=False)
+        self.n_triangulations = Value('q', 0, lock=False)
+        self.n_relax_steps = Value('q', 0, lock=False)
+        # Index into layout_backends, may be changed while running
+        self.layout_backend_index = Value('i', 0, lock=False)
+        self.weighted = Value('i', 0, lock=False)
+        self._rates_sample = None
+        self.start_barrier = None
+        self.done_barrier = None
         self.n_points = Value('i', 0, lock=False)
-        self.points_io_var = Value('i', 0, lock=False)
-
-        self._buffer_size = None
-        self.neighors_array_buffer_multiplier = 4
-
-        self.points = None
-        self.points_relaxed = None
-        self.points_io = None
-        self.neighbor_divs = None
-        self.neighbors = None
+        # Set while the layout backend fails on the current points
+        self.backend_failed = Value('i', 0, lock=False)
+
+        # Initial neighbor capacity per point, grown on demand
+        self.neighors_array_buffer_multiplier = 6
+
+        # Shared buffers are named after this prefix and a generation, see
+        # buffer_layout
+        self._prefix = 'sb' + secrets.token_hex(4)
+        self.buffer_layout = None
+        self.io_lock = RLock()
+        # Handoff to and from the application
+        self.points_in = None
+        self.points_out = None
+        self._points_out_epoch = None
 
         self.delaunay_process = None
         self.relax_processes = []
@@ -170,57 +397,143 @@ class PointRelaxer():
         self.alpha = Value('f', 0.1, lock=True)
         self.beta = Value('f', 0.04, lock=True)
 
-    def init_processes(self, buffer_size):
-        self._buffer_size = buffer_size
-        if self.points:
-            del self.points
-        if self.points_relaxed:
-            del self.points_relaxed
-        if self.points_io:
-            del self.points_io
-        if self.neighbor_divs:
-            del self.neighbor_divs
-        if self.neighbors:
-            del self.neighbors
-
-        n_neighbors = self.neighors_array_buffer_multiplier * buffer_size
-        self.points = Array(Vector2, buffer_size, lock=False)
-        self.points_relaxed = Array(Vector2, buffer_size, lock=False)
-        self.points_io = Array(Vector2, buffer_size, lock=True)
-        self.neighbor_divs = Array(c_long, buffer_size + 1, lock=False)
-        self.neighbors = Array(c_long, n_neighbors, lock=False)
-
-
-        args_common = (self.cancellation, self.relax_var,
-                       self.relax_completed_var, self.n_points,
-                       self.points, self.points_relaxed,
-                       self.neighbor_divs, self.neighbors)
-        d_args = (self.n_relaxation_workers, self.points_io,
-                  self.points_io_var) + args_common
-        r_args_suffix = (self.n_relaxation_workers, self.alpha, self.beta) + \
-                        args_common
+    @property
+    def capacity(self):
+        return self.points_in.capacity if self.points_in else 0
+
+    def _release_buffers(self):
+        for buffer in (self.points_in, self.points_out, self.buffer_layout):
+            if buffer is not None:
+                buffer.release()
+        self.points_in = None
+        self.points_out = None
+        self.buffer_layout = None
+        self._points_out_epoch = None
+
+    def _ensure_capacity(self, n):
+        '''
+        Grows the IO buffers to hold at least n points. The Delaunay worker
+        picks the new buffers up through buffer_layout and grows its own working
+        buffers to match.
+        '''
+        if n <= self.capacity:
+            return
+        with self.io_lock:
+            buffer_layout = self.buffer_layout.array
+            capacity = grow_capacity(self.capacity, n)
+            generation = int(buffer_layout[IO_GENERATION]) + 1
+            name = io_buffer_name(self._prefix, generation)
+            points_in = SparseInbox(capacity, (2,), 'float32', name + 'i',
+                                    lock=self.io_lock)
+            points_out = DoubleBuffer(capacity, (2,), 'float32', name + 'o')
+            if self.points_in is not None:
+                points_in.copy_from(self.points_in)
+                points_out.copy_from(self.points_out)
+                self.points_in.release()
+                self.points_out.release()
+            self.points_in = points_in
+            self.points_out = points_out
+            buffer_layout[IO_CAPACITY] = capacity
+            buffer_layout[IO_GENERATION] = generation
+
+    def init_processes(self, buffer_size=1024):
+        '''
+        :param buffer_size: initial point capacity, buffers grow as needed
+        '''
+        if self.relax_kernel not in relax_kernels:
+            raise ValueError(f"Unknown relax kernel '{self.relax_kernel}'")
+        self._release_buffers()
+        self.buffer_layout = SharedArray((5,), 'int64')
+        self.buffer_layout.array[:] = 0
+        self._ensure_capacity(buffer_size)
+
+        self.start_barrier = Barrier(self.n_relaxation_workers + 1)
+        self.done_barrier = Barrier(self.n_relaxation_workers + 1)
+
+        args_common = (self._prefix, self.buffer_layout, self.start_barrier,
+                       self.done_barrier, self.n_points, metrics.get_queue())
+        d_args = (self._prefix, self.buffer_layout, self.io_lock,
+                  self.cancellation, self.wake_event, self.idle,
+                  self.idle_time, self.tolerance, self.rebuild_threshold,
+                  self.n_triangulations, self.n_relax_steps, self.beta,
+                  self.layout_backend_index, self.weighted,
+                  self.neighors_array_buffer_multiplier,
+                  self.start_barrier, self.done_barrier, self.n_points,
+                  self.backend_failed, metrics.get_queue())
+        r_args_suffix = (self.n_relaxation_workers, self.relax_kernel,
+                         self.alpha, self.beta, self.weighted) + args_common
 
         self.delaunay_process = Process(target=delaunay_loop, args=d_args)
         self.relax_processes = [
             Process(target=relax_points_loop, args=(i,) + r_args_suffix)
             for i in range(self.n_relaxation_workers)]
 
+    @staticmethod
+    def _dither(points):
+        # Dithering prevents issues with Delaunay calculation
+        points = np.asarray(points, dtype='float32').reshape(-1, 2)
+        return points + 0.00001 * np.random.rand(*points.shape)
+
+    @property
+    def layout_backend(self):
+        return list(layout_backends)[self.layout_backend_index.value]
+
+    @layout_backend.setter
+    def layout_backend(self, name):
+        if name not in layout_backends:
+            raise ValueError(f"Unknown layout backend '{name}'")
+        self.layout_backend_index.value = list(layout_backends).index(name)
+        self.wake()
+
+    @property
+    def is_idle(self):
+        return bool(self.idle.value)
+
+    def sample_rates(self):
+        '''
+        :return: (triangulations per second, relax steps per second) since
+            the previous call
+        '''
+        sample = (time.perf_counter(), self.n_triangulations.value,
+                  self.n_relax_steps.value)
+        prior, self._rates_sample = self._rates_sample, sample
+        if prior is None or sample[0] <= prior[0]:
+            return 0.0, 0.0
+        dt = sample[0] - prior[0]
+        return (sample[1] - prior[1]) / dt, (sample[2] - prior[2]) / dt
+
+    def wake(self):
+        self.wake_event.set()
+
     def set_points(self, points):
-        with self.points_io.get_lock():
-            n_points = len(points)
-            for idx in range(n_points):
-                p = points[idx]
-                # Dithering prevents issues with Delaunay calculation
-                r = 0.00001 * np.random.rand(2)
-                p = (p[0] + r[0], p[1] + r[1])
-                self.points_io[idx] = tuple(p)
-            self.n_points.value = n_points
-            self.points_io_var.value = 1
+        points = self._dither(points)
+        self._ensure_capacity(len(points))
+        self.points_in.write(points)
+        self.wake()
+
+    def update_points(self, indices, points, length=None):
+        '''
+        Sparse counterpart of set_points, only the given indices are sent
+        to the workers.
+
+        :param length: new number of points, to append or truncate
+        '''
+        indices = np.asarray(indices, dtype=np.intp)
+        required = int(indices.max()) + 1 if indices.size else 0
+        if length is not None:
+            required = max(required, length)
+        self._ensure_capacity(required)
+        self.points_in.write_sparse(indices, self._dither(points), length)
+        self.wake()
 
     def get_points(self):
-        with self.points_io.get_lock():
-            return [tuple(self.points[i]) for i in
-                    range(self.n_points.value)]
+        '''
+        :return: (n, 2) array of the most recently published points, or
+            None if nothing new was published since the last call
+        '''
+        points, self._points_out_epoch = self.points_out.read(
+            self._points_out_epoch)
+        return points
 
     def start_all(self):
         self.delaunay_process.start()
@@ -230,7 +543,13 @@ class PointRelaxer():
     def stop_all(self):
         with self.cancellation.get_lock():
             self.cancellation.value = 1
+        # Release every worker from whatever it is blocked on
+        self.wake()
+        if self.start_barrier:
+            self.start_barrier.abort()
+            self.done_barrier.abort()
 
+        metrics.collect()
         if self.delaunay_process:
             self.delaunay_process.join()
         for r in self.relax_processes:
@@ -238,3 +557,5 @@ class PointRelaxer():
 
         with self.cancellation.get_lock():
             self.cancellation.value = 0
+        self.wake_event.clear()
+        self._release_buffers()
@@ -0,0 +1,153 @@
+import numpy as np
+
+# Kivy meshes index vertices with unsigned shorts
+MAX_MESH_VERTICES = 65536
+MAX_MESH_QUADS = MAX_MESH_VERTICES // 4
+
+
+def to_uint8_image(array):
+    if array.dtype == np.uint8:
+        return array
+    return np.clip(np.round(array * 255.0), 0, 255).astype('uint8')
+
+
+class AtlasRegion:
+    def __init__(self, page, x, y, width, height, page_size):
+        self.page = page
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.uvs = (x / page_size, y / page_size,
+                    (x + width) / page_size, (y + height) / page_size)
+
+    def __repr__(self):
+        return f'<AtlasRegion page = {self.page}, x = {self.x}, ' \
+               f'y = {self.y}, size = {self.width}x{self.height}>'
+
+
+class TextureAtlas:
+    '''
+    Packs images into square cells of large uint8 RGB pages. Pixels are
+    stored bottom row first, like OpenGL textures. The cells written
+    since the last upload are listed per page in dirty_rects, as
+    (x, y, width, height) rectangles.
+    '''
+    def __init__(self, page_size=2048, cell_size=64):
+        self.page_size = page_size
+        self.cell_size = cell_size
+        self.cells_per_row = page_size // cell_size
+        self.cells_per_page = self.cells_per_row ** 2
+        self.pages = []
+        self.dirty_rects = {}
+        self._regions = {}
+        self._cells = {}
+        self._free_cells = []
+        self._next_cell = 0
+
+    def __len__(self):
+        return len(self._regions)
+
+    def __contains__(self, key):
+        return key in self._regions
+
+    def _allocate_cell(self):
+        if self._free_cells:
+            return self._free_cells.pop()
+        cell = self._next_cell
+        self._next_cell += 1
+        if cell // self.cells_per_page >= len(self.pages):
+            self.pages.append(np.zeros(
+                (self.page_size, self.page_size, 3), dtype='uint8'))
+        return cell
+
+    def add(self, key, array):
+        '''
+        :param array: (height, width, 3) image no larger than a cell, uint8
+            or float in [0, 1]
+        :return: AtlasRegion of the image
+        '''
+        height, width = array.shape[:2]
+        if height > self.cell_size or width > self.cell_size:
+            raise ValueError("Image must fit into an atlas cell")
+        if key in self._regions:
+            self.remove(key)
+        cell = self._allocate_cell()
+        page, index = divmod(cell, self.cells_per_page)
+        y, x = divmod(index, self.cells_per_row)
+        x *= self.cell_size
+        y *= self.cell_size
+        pixels = self.pages[page]
+        pixels[y:y + height, x:x + width] = np.flip(to_uint8_image(array), 0)
+        # Whole cells keep the rows of an upload 4 byte aligned
+        self.dirty_rects.setdefault(page, []).append(
+            (x, y, self.cell_size, self.cell_size))
+        region = AtlasRegion(page, x, y, width, height, self.page_size)
+        self._regions[key] = region
+        self._cells[key] = cell
+        return region
+
+    def get(self, key):
+        return self._regions.get(key)
+
+    def take_dirty_rects(self, max_rects=64):
+        '''
+        :param max_rects: more dirty rectangles on a page are merged into
+            their bounding rectangle
+        :return: dict of page -> list of (x, y, width, height) written
+            since the last call
+        '''
+        dirty = self.dirty_rects
+        self.dirty_rects = {}
+        for page, rects in dirty.items():
+            if len(rects) > max_rects:
+                x0 = min(x for x, _, _, _ in rects)
+                y0 = min(y for _, y, _, _ in rects)
+                x1 = max(x + w for x, _, w, _ in rects)
+                y1 = max(y + h for _, y, _, h in rects)
+                dirty[page] = [(x0, y0, x1 - x0, y1 - y0)]
+        return dirty
+
+    def remove(self, key):
+        del self._regions[key]
+        self._free_cells.append(self._cells.pop(key))
+
+
+def quad_indices(n_quads):
+    corners = np.array([0, 1, 2, 2, 3, 0], dtype='uint16')
+    base = 4 * np.arange(n_quads, dtype='uint16')
+    return (base[:, None] + corners).reshape(-1)
+
+
+def build_quad_vertices(rects, uvs):
+    '''
+    :param rects: (n, 4) array of x, y, width, height
+    :param uvs: (n, 4) array of u0, v0, u1, v1
+    :return: (n * 16,) float32 array of x, y, u, v per quad corner,
+        counterclockwise from the bottom left
+    '''
+    rects = np.asarray(rects, dtype='float32').reshape(-1, 4)
+    uvs = np.asarray(uvs, dtype='float32').reshape(-1, 4)
+    x0, y0 = rects[:, 0], rects[:, 1]
+    x1, y1 = x0 + rects[:, 2], y0 + rects[:, 3]
+    u0, v0, u1, v1 = uvs.T
+    vertices = np.stack((
+        x0, y0, u0, v0,
+        x1, y0, u1, v0,
+        x1, y1, u1, v1,
+        x0, y1, u0, v1), axis=1)
+    return vertices.reshape(-1)
+
+
+def build_mesh_batches(rects, uvs, max_quads=MAX_MESH_QUADS):
+    '''
+    :return: list of (vertices, indices), each within the mesh size limit
+    '''
+    vertices = build_quad_vertices(rects, uvs)
+    n_quads = len(vertices) // 16
+    batches = []
+    for begin in range(0, n_quads, max_quads):
+        end = min(begin + max_quads, n_quads)
+        batches.append((vertices[16 * begin:16 * end],
+                        quad_indices(end - begin)))
+    return batches
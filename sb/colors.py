@@ -0,0 +1,154 @@
+import itertools
+
+import numpy as np
+
+try:
+    from ekstrakto.helpers import peak_find_3d
+except ImportError:
+    peak_find_3d = None
+
+
+def fill_colors(colors, n_colors):
+    # Repeat the weakest color when there are fewer than n_colors
+    if colors.shape[0] < n_colors:
+        fill = np.repeat([colors[-1]], n_colors - colors.shape[0], axis=0)
+        colors = np.concatenate((colors, fill), 0)
+    return colors[:n_colors]
+
+
+def gaussian_matrix(bins, sigma):
+    i = np.arange(bins)
+    return np.exp(-(i[:, None] - i[None, :]) ** 2 / (2.0 * sigma ** 2))
+
+
+def local_maxima(volumes):
+    '''
+    :param volumes: (B, n, n, n) array
+    :return: bool mask of the cells no smaller than any of their 26
+        neighbors
+    '''
+    n = volumes.shape[1]
+    padded = np.pad(volumes, ((0, 0), (1, 1), (1, 1), (1, 1)),
+                    constant_values=-np.inf)
+    maxima = np.ones(volumes.shape, dtype=bool)
+    for dx, dy, dz in itertools.product((0, 1, 2), repeat=3):
+        if (dx, dy, dz) == (1, 1, 1):
+            continue
+        neighbors = padded[:, dx:dx + n, dy:dy + n, dz:dz + n]
+        maxima &= volumes >= neighbors
+    return maxima
+
+
+def histogram_colors_batch(stack, mask, n_colors=3, bins=7, sigma=2.0):
+    '''
+    Dominant colors as the highest peaks of a smoothed, quantized color
+    histogram, for a whole padded batch at once. Each peak's color is the
+    mean of the pixels in its histogram cell.
+
+    :param stack: (B, H, W, 3) pixels in [0, 1]
+    :param mask: (B, H, W) bool mask of the valid pixels
+    :return: (B, n_colors, 3) colors, strongest first
+    '''
+    n_images = stack.shape[0]
+    n_cells = bins ** 3
+    pixels = stack[mask].astype('float64')
+    images = np.nonzero(mask)[0]
+    cells = np.clip((pixels * bins).astype('int64'), 0, bins - 1)
+    cells = images * n_cells + np.ravel_multi_index(cells.T, (bins,) * 3)
+    size = n_images * n_cells
+    counts = np.bincount(cells, minlength=size)
+    sums = np.stack([np.bincount(cells, pixels[:, c], minlength=size)
+                     for c in range(3)], axis=1)
+    # Cells without pixels fall back to their center color
+    centers = (np.stack(np.unravel_index(np.arange(n_cells), (bins,) * 3),
+                        axis=1) + 0.5) / bins
+    means = np.tile(centers, (n_images, 1))
+    filled = counts > 0
+    means[filled] = sums[filled] / counts[filled, None]
+
+    g = gaussian_matrix(bins, sigma)
+    histograms = counts.reshape(n_images, bins, bins, bins).astype('float64')
+    smoothed = np.einsum('nijk,ai,bj,ck->nabc', histograms, g, g, g)
+    scores = np.where(local_maxima(smoothed), smoothed, -np.inf)
+    scores = scores.reshape(n_images, n_cells)
+
+    order = np.argsort(-scores, axis=1, kind='stable')[:, :n_colors]
+    n_peaks = np.isfinite(np.take_along_axis(scores, order, 1)).sum(axis=1)
+    ranks = np.minimum(np.arange(n_colors), np.maximum(n_peaks, 1)[:, None] - 1)
+    peaks = np.take_along_axis(order, ranks, 1)
+    peaks += np.arange(n_images)[:, None] * n_cells
+    return means[peaks]
+
+
+def histogram_colors(pixels, n_colors=3, bins=7, sigma=2.0):
+    '''
+    :param pixels: (n, 3) pixels in [0, 1]
+    '''
+    stack = np.asarray(pixels)[None, :, None, :]
+    mask = np.ones(stack.shape[:3], dtype=bool)
+    return histogram_colors_batch(stack, mask, n_colors, bins, sigma)[0]
+
+
+def kmeans_colors(pixels, n_colors=3, n_iterations=10, batch_size=256,
+                  seed=0):
+    '''
+    Mini-batch k-means over random pixel samples, clusters ordered by the
+    number of pixels they hold.
+
+    :param pixels: (n, 3) pixels
+    '''
+    pixels = np.asarray(pixels, dtype='float64')
+    rng = np.random.default_rng(seed)
+    centers = pixels[rng.choice(len(pixels), n_colors,
+                                replace=len(pixels) < n_colors)]
+    totals = np.zeros(n_colors)
+    for _ in range(n_iterations):
+        batch = pixels[rng.integers(0, len(pixels), batch_size)]
+        distances = np.sum((batch[:, None] - centers[None]) ** 2, axis=2)
+        labels = np.argmin(distances, axis=1)
+        counts = np.bincount(labels, minlength=n_colors)
+        sums = np.stack([np.bincount(labels, batch[:, c], minlength=n_colors)
+                         for c in range(3)], axis=1)
+        # Per center learning rate of one over its total count
+        totals += counts
+        moved = counts > 0
+        centers[moved] += (sums[moved] - counts[moved, None] *
+                           centers[moved]) / totals[moved, None]
+    distances = np.sum((pixels[:, None] - centers[None]) ** 2, axis=2)
+    sizes = np.bincount(np.argmin(distances, axis=1), minlength=n_colors)
+    return centers[np.argsort(-sizes, kind='stable')]
+
+
+def ekstrakto_colors(pixels, n_colors=3):
+    if peak_find_3d is None:
+        raise ValueError("The ekstrakto color engine needs ekstrakto")
+    colors, _ = peak_find_3d(pixels, 7, 2.0)
+    return fill_colors(colors, n_colors)
+
+
+color_engines = {
+    'histogram': histogram_colors,
+    'kmeans': kmeans_colors,
+    'ekstrakto': ekstrakto_colors
+}
+
+
+def get_color_engine(name):
+    try:
+        return color_engines[name]
+    except KeyError:
+        raise ValueError(f"Unknown color engine {name}, "
+                         f"expected one of {', '.join(color_engines)}")
+
+
+def get_dominant_colors_batch(stack, mask, n_colors=3, engine='histogram'):
+    '''
+    :param stack: (B, H, W, 3) pixels in [0, 1]
+    :param mask: (B, H, W) bool mask of the valid pixels
+    :return: (B, n_colors, 3) colors
+    '''
+    if engine == 'histogram':
+        return histogram_colors_batch(stack, mask, n_colors)
+    colors = get_color_engine(engine)
+    return np.stack([colors(stack[i][mask[i]], n_colors=n_colors)
+                     for i in range(len(stack))])
@@ -0,0 +1,79 @@
+from sb.component import Component
+from sb.drawable import Drawable
+
+_needs_update = {}
+
+
+def needs_update(component_type):
+    '''
+    :return: True if component_type overrides Component.update
+    '''
+    result = _needs_update.get(component_type)
+    if result is None:
+        result = component_type.update is not Component.update
+        _needs_update[component_type] = result
+    return result
+
+
+class ComponentRegistry:
+    '''
+    Canvas-wide index of the components of the objects on a canvas, by
+    type. Tracks which components need per-frame updates and which
+    drawables have to be added to or removed from the canvas, so a frame
+    only touches those. Drawables that need updates are kept apart, the
+    canvas only updates those in view.
+    '''
+    def __init__(self):
+        self._by_type = {}
+        self._query_types = {}
+        self.updatable = {}
+        self.updatable_drawables = {}
+        self.pending_drawables = {}
+        self.destroyed_objects = []
+
+    def add(self, component):
+        component_type = type(component)
+        components = self._by_type.get(component_type)
+        if components is None:
+            components = self._by_type[component_type] = {}
+            self._query_types.clear()
+        components[component] = None
+        if issubclass(component_type, Drawable):
+            if needs_update(component_type):
+                self.updatable_drawables[component] = None
+            self.pending_drawables[component] = True
+        elif needs_update(component_type):
+            self.updatable[component] = None
+
+    def remove(self, component):
+        component_type = type(component)
+        self._by_type.get(component_type, {}).pop(component, None)
+        self.updatable.pop(component, None)
+        self.updatable_drawables.pop(component, None)
+        if issubclass(component_type, Drawable):
+            self.pending_drawables[component] = False
+
+    def get_components(self, component_type):
+        types = self._query_types.get(component_type)
+        if types is None:
+            types = [t for t in self._by_type
+                     if issubclass(t, component_type)]
+            self._query_types[component_type] = types
+        for t in types:
+            yield from self._by_type[t]
+
+    def count(self, component_type):
+        return sum(1 for _ in self.get_components(component_type))
+
+    def object_destroyed(self, _object):
+        self.destroyed_objects.append(_object)
+
+    def take_pending_drawables(self):
+        pending = self.pending_drawables
+        self.pending_drawables = {}
+        return pending
+
+    def take_destroyed_objects(self):
+        destroyed = self.destroyed_objects
+        self.destroyed_objects = []
+        return destroyed
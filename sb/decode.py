@@ -0,0 +1,105 @@
+import io
+import struct
+
+from PIL import Image as PILImageM
+
+# Largest image a worker decodes, after any draft mode scaling
+MAX_DECODE_PIXELS = 64 * 1024 * 1024
+
+EXIF_HEADER = b'Exif\x00\x00'
+TAG_THUMBNAIL_OFFSET = 0x0201
+TAG_THUMBNAIL_LENGTH = 0x0202
+
+
+def get_exif_thumbnail_bytes(exif):
+    '''
+    Finds the JPEG thumbnail in IFD1 of raw EXIF data.
+
+    :return: bytes of the embedded JPEG, or None
+    '''
+    if exif.startswith(EXIF_HEADER):
+        exif = exif[len(EXIF_HEADER):]
+    if len(exif) < 8 or exif[:2] not in (b'II', b'MM'):
+        return None
+    order = '<' if exif[:2] == b'II' else '>'
+    try:
+        ifd0 = struct.unpack_from(order + 'I', exif, 4)[0]
+        n_entries = struct.unpack_from(order + 'H', exif, ifd0)[0]
+        # The offset of the next IFD follows the 12 byte entries
+        ifd1 = struct.unpack_from(
+            order + 'I', exif, ifd0 + 2 + 12 * n_entries)[0]
+        if ifd1 == 0:
+            return None
+        n_entries = struct.unpack_from(order + 'H', exif, ifd1)[0]
+        tags = {}
+        for i in range(n_entries):
+            tag, _, _, value = struct.unpack_from(
+                order + 'HHII', exif, ifd1 + 2 + 12 * i)
+            tags[tag] = value
+    except struct.error:
+        return None
+    offset = tags.get(TAG_THUMBNAIL_OFFSET)
+    length = tags.get(TAG_THUMBNAIL_LENGTH)
+    if not offset or not length or offset + length > len(exif):
+        return None
+    return exif[offset:offset + length]
+
+
+def get_exif_thumbnail(img, size, aspect_tolerance=0.02):
+    '''
+    :return: the embedded EXIF thumbnail if it is at least size pixels on
+        its longer side and has the aspect ratio of the image, or None
+    '''
+    exif = img.info.get('exif')
+    if not exif:
+        return None
+    data = get_exif_thumbnail_bytes(exif)
+    if data is None:
+        return None
+    try:
+        thumbnail = PILImageM.open(io.BytesIO(data))
+        thumbnail.load()
+    except Exception:
+        return None
+    width, height = thumbnail.size
+    if max(width, height) < size:
+        return None
+    # Letterboxed or cropped thumbnails would not match the original
+    aspect = (width / height) / (img.size[0] / img.size[1])
+    if abs(aspect - 1.0) > aspect_tolerance:
+        return None
+    return thumbnail
+
+
+def decode_thumbnail(file_path, size=64, max_pixels=MAX_DECODE_PIXELS,
+                     use_exif=True):
+    '''
+    Decodes an image at the lowest resolution that still yields a size x
+    size thumbnail: the embedded EXIF thumbnail if usable, DCT scaling in
+    draft mode for JPEG, and integer reduction for other formats.
+
+    :return: (RGB thumbnail image, name of the decode method)
+    '''
+    img = PILImageM.open(str(file_path))
+    method = 'full'
+    if img.format == 'JPEG':
+        thumbnail = get_exif_thumbnail(img, size) if use_exif else None
+        if thumbnail is not None:
+            img.close()
+            img, method = thumbnail, 'exif'
+        else:
+            # Picks the largest DCT scale still at least size x size
+            img.draft('RGB', (size, size))
+            method = 'draft'
+    width, height = img.size
+    if width * height > max_pixels:
+        img.close()
+        raise ValueError(
+            f"Image of {width}x{height} pixels exceeds the decode limit")
+    factor = min(width, height) // (2 * size)
+    if factor > 1 and method == 'full':
+        # reduce does not handle palette images
+        img = img.convert('RGB').reduce(factor)
+        method = 'reduce'
+    img.thumbnail((size, size))
+    return img.convert('RGB'), method
@@ -0,0 +1,139 @@
+from multiprocessing import Queue, Value
+from queue import Empty, Full, Queue as ThreadQueue
+from threading import Thread
+
+# Marks the end of the work for one worker, or of one producer's output
+DONE = None
+# Returned by get_blocking when cancelled, never sent through a queue
+CANCELLED = object()
+
+
+def put_blocking(q, item, cancellation, timeout=0.1):
+    '''
+    Puts into a bounded queue, waiting for space until cancelled.
+
+    :return: False if cancelled
+    '''
+    while not cancellation.value:
+        try:
+            q.put(item, timeout=timeout)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def get_blocking(q, cancellation, timeout=0.1):
+    '''
+    :return: next item, or CANCELLED
+    '''
+    while not cancellation.value:
+        try:
+            return q.get(timeout=timeout)
+        except Empty:
+            pass
+    return CANCELLED
+
+
+class Dispatcher:
+    '''
+    Hands work items out to n_workers processes in chunks. Items may be
+    submitted in any number of calls while the workers run. A feeder
+    thread keeps at most max_pending_chunks chunks queued and, once
+    close() was called, ends the work of every worker with DONE. Workers
+    report each chunk's outcome, so completion is exact rather than
+    inferred from queue sizes.
+    '''
+    def __init__(self, cancellation, n_workers, chunk_size=32,
+                 max_pending_chunks=None):
+        self.cancellation = cancellation
+        self.n_workers = n_workers
+        self.chunk_size = chunk_size
+        if max_pending_chunks is None:
+            max_pending_chunks = 2 * n_workers
+        self.chunks = Queue(maxsize=max_pending_chunks)
+        self.n_total = Value('i', 0, lock=True)
+        self.n_completed = Value('i', 0, lock=True)
+        self.n_failed = Value('i', 0, lock=True)
+        self.closed = Value('i', 0, lock=True)
+        self._submissions = None
+        self._feeder = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_submissions'] = None
+        state['_feeder'] = None
+        return state
+
+    def _feed(self):
+        while True:
+            items = get_blocking(self._submissions, self.cancellation)
+            if items is CANCELLED:
+                return
+            if items is DONE:
+                break
+            for begin in range(0, len(items), self.chunk_size):
+                chunk = items[begin:begin + self.chunk_size]
+                if not put_blocking(self.chunks, chunk, self.cancellation):
+                    return
+        for _ in range(self.n_workers):
+            if not put_blocking(self.chunks, DONE, self.cancellation):
+                return
+
+    def start(self):
+        '''
+        Starts the feeder thread. Call after the workers were forked.
+        '''
+        self._submissions = ThreadQueue()
+        self._feeder = Thread(target=self._feed, daemon=True)
+        self._feeder.start()
+
+    def submit(self, items):
+        items = list(items)
+        if self.closed.value:
+            raise ValueError("Dispatcher is closed")
+        with self.n_total.get_lock():
+            self.n_total.value += len(items)
+        if items:
+            self._submissions.put(items)
+
+    def close(self):
+        '''
+        Marks the end of the submissions.
+        '''
+        if not self.closed.value:
+            self.closed.value = 1
+            self._submissions.put(DONE)
+
+    def get_chunk(self):
+        '''
+        Blocks until a chunk is available.
+
+        :return: list of items, or None when the work is done or cancelled
+        '''
+        chunk = get_blocking(self.chunks, self.cancellation)
+        if chunk is CANCELLED:
+            return None
+        return chunk
+
+    def report(self, n_completed, n_failed=0):
+        '''
+        :param n_failed: number of items that could not be processed
+        '''
+        with self.n_completed.get_lock():
+            self.n_completed.value += n_completed
+        if n_failed:
+            with self.n_failed.get_lock():
+                self.n_failed.value += n_failed
+
+    @property
+    def n_done(self):
+        return self.n_completed.value + self.n_failed.value
+
+    @property
+    def is_complete(self):
+        return bool(self.closed.value) and self.n_done >= self.n_total.value
+
+    def join(self):
+        if self._feeder is not None:
+            self._feeder.join()
@@ -7,3 +7,14 @@ class Drawable(Component):
 
     def _remove_from_canvas(self, canvas):
         pass
+
+    def _hide(self, canvas):
+        # Culled out of the viewport, may be shown again
+        self._remove_from_canvas(canvas)
+
+    def _show(self, canvas):
+        self._add_to_canvas(canvas)
+
+    def _remove_hidden(self, canvas):
+        # Removed for good while hidden
+        pass
@@ -1,16 +1,103 @@
 import pathlib
-from os import path, walk
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from os import path, scandir, walk, stat
+
+IMAGE_SUFFIXES = {'png', 'jpg', 'gif', 'webp'}
+
+
+def is_image_file(file_name):
+    name, ext = path.splitext(file_name)
+    return ext[1:].lower() in IMAGE_SUFFIXES
 
 
 def get_image_paths(parent_path):
-    suffixes = {'png', 'jpg', 'gif', 'webp'}
     for root, dirs, files in walk(parent_path):
         for file in files:
-            name, ext = path.splitext(file)
-            if ext[1:].lower() in suffixes:
+            if is_image_file(file):
                 yield pathlib.PurePath(root, file)
 
 
+def scan_directory(dir_path):
+    '''
+    :return: file keys of the images directly in dir_path, see
+        get_file_key, and the paths of its subdirectories
+    '''
+    files = []
+    subdirs = []
+    try:
+        with scandir(dir_path) as entries:
+            for entry in entries:
+                try:
+                    # Like walk, symbolic links to directories are not followed
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif is_image_file(entry.name) and entry.is_file():
+                        file_stat = entry.stat()
+                        files.append((entry.path, file_stat.st_size,
+                                      file_stat.st_mtime_ns))
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    return files, subdirs
+
+
+def scan_image_files(parent_path, batch_size=256, n_threads=8):
+    '''
+    Recursively scans parent_path for images, directories in parallel
+    threads, and yields file keys as soon as batch_size have been found.
+    The order of the files is not defined.
+
+    :return: generator of lists of (path, size, mtime in nanoseconds)
+    '''
+    executor = ThreadPoolExecutor(n_threads)
+    try:
+        batch = []
+        pending = {executor.submit(scan_directory, str(parent_path))}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                batch.extend(files)
+                pending.update(executor.submit(scan_directory, d)
+                               for d in subdirs)
+            while len(batch) >= batch_size:
+                yield batch[:batch_size]
+                batch = batch[batch_size:]
+        if batch:
+            yield batch
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def diff_scans(previous, current):
+    '''
+    :param previous: dict of path to (size, mtime in nanoseconds)
+    :param current: dict of path to (size, mtime in nanoseconds)
+    :return: lists of the added, removed and modified paths
+    '''
+    added = [p for p in current if p not in previous]
+    removed = [p for p in previous if p not in current]
+    modified = [p for p, v in current.items()
+                if p in previous and previous[p] != v]
+    return added, removed, modified
+
+
+def rescan_image_files(parent_path, previous, n_threads=8):
+    '''
+    Scans parent_path again and compares it with an earlier scan.
+
+    :param previous: dict of path to (size, mtime in nanoseconds)
+    :return: the new scan as a dict like previous, and the added, removed
+        and modified paths
+    '''
+    current = {}
+    for batch in scan_image_files(parent_path, n_threads=n_threads):
+        for file_path, size, mtime_ns in batch:
+            current[file_path] = size, mtime_ns
+    return (current, *diff_scans(previous, current))
+
+
 def get_abs_path(path):
     assert(isinstance(path, pathlib.PurePath))
     if path.is_absolute():
@@ -21,3 +108,12 @@ def get_abs_path(path):
 def get_path_uri(path):
     assert (isinstance(path, pathlib.PurePath))
     return get_abs_path(path).as_uri()
+
+
+def get_file_key(file_path):
+    '''
+    :return: (path, size, mtime in nanoseconds) identifying a file version
+    '''
+    file_path = str(file_path)
+    file_stat = stat(file_path)
+    return file_path, file_stat.st_size, file_stat.st_mtime_ns
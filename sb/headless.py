@@ -0,0 +1,330 @@
+'''
+Batch processing of an image library without a window, see
+run_headless. Nothing in here may import Kivy.
+'''
+import csv
+import json
+import os
+import pathlib
+import sys
+import time
+from os import path
+from queue import Empty
+from threading import Event, Thread
+
+import numpy as np
+
+from sb import metrics
+from sb.analysis import ANALYSIS_SIZE, get_2d_ipca
+from sb.files import scan_image_files
+from sb.image_processing import ImageProcessor
+
+FEATURE_NAMES = ['mean', 'contrast'] + \
+    [f'color_{i}' for i in range(ANALYSIS_SIZE - 2)]
+CSV_FIELDS = ['path', 'size', 'mtime_ns', 'x', 'y', 'version'] + \
+    FEATURE_NAMES
+OUTPUT_FORMATS = ('ndjson', 'csv')
+
+
+def truncate_partial_line(file_path):
+    '''
+    Drops an incomplete last line, as left behind by an interrupted run.
+    '''
+    with open(file_path, 'rb+') as f:
+        data = f.read()
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            f.truncate(end)
+
+
+def read_records(file_path, output_format):
+    '''
+    :return: list of (path, size, mtime in ns, features) of the records
+        in a previous output
+    '''
+    records = []
+    with open(file_path, newline='') as f:
+        if output_format == 'ndjson':
+            rows = (json.loads(line) for line in f if line.strip())
+            for row in rows:
+                records.append((row['path'], row['size'], row['mtime_ns'],
+                                row['features']))
+        else:
+            for row in csv.DictReader(f):
+                records.append((row['path'], int(row['size']),
+                                int(row['mtime_ns']),
+                                [float(row[n]) for n in FEATURE_NAMES]))
+    return records
+
+
+def drop_records(file_path, output_format, file_keys):
+    '''
+    Rewrites an output without the records of file_keys.
+    '''
+    temp_path = file_path + '.tmp'
+    with open(file_path, newline='') as f, \
+            open(temp_path, 'w', newline='') as out:
+        if output_format == 'ndjson':
+            for line in f:
+                if not line.strip():
+                    continue
+                row = json.loads(line)
+                if (row['path'], row['size'], row['mtime_ns']) not in \
+                        file_keys:
+                    out.write(line)
+        else:
+            reader = csv.reader(f)
+            writer = csv.writer(out)
+            writer.writerow(next(reader))
+            for row in reader:
+                if (row[0], int(row[1]), int(row[2])) not in file_keys:
+                    writer.writerow(row)
+    os.replace(temp_path, file_path)
+
+
+class RecordWriter:
+    '''
+    Appends (path, size, mtime, 2D coordinates, basis version, features)
+    records as NDJSON or CSV, flushed after every batch.
+    '''
+    def __init__(self, file, output_format, write_header):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format '{output_format}'")
+        self.file = file
+        self.output_format = output_format
+        self._csv = None
+        if output_format == 'csv':
+            self._csv = csv.writer(file)
+            if write_header:
+                self._csv.writerow(CSV_FIELDS)
+
+    def write(self, file_keys, coordinates, version, features):
+        for (file_path, size, mtime_ns), (x, y), row in zip(
+                file_keys, coordinates.tolist(), features.tolist()):
+            if self._csv is not None:
+                self._csv.writerow(
+                    [file_path, size, mtime_ns, x, y, version] + row)
+            else:
+                self.file.write(json.dumps({
+                    'path': file_path, 'size': size, 'mtime_ns': mtime_ns,
+                    'x': x, 'y': y, 'version': version, 'features': row
+                }) + '\n')
+        self.file.flush()
+
+
+def submit_worker(images_dir_path, processor, file_keys, done_keys, cancel,
+                  scanned_keys, scanned):
+    # Scans in parallel with the processing, skipping finished files
+    for batch in scan_image_files(images_dir_path):
+        if cancel.is_set():
+            return
+        items = []
+        for file_key in batch:
+            scanned_keys.add(file_key)
+            if file_key in done_keys:
+                continue
+            node_id = len(file_keys)
+            file_keys.append(file_key)
+            items.append((node_id, file_key[0]))
+        processor.submit(items)
+    scanned.set()
+    processor.end_submissions()
+
+
+def drain(q):
+    try:
+        while True:
+            yield q.get_nowait()
+    except Empty:
+        pass
+
+
+def relax_points(points, timeout=60.0, beta=0.04):
+    '''
+    Runs the PointRelaxer on points until it settles or timeout seconds
+    passed.
+
+    :return: (n, 2) array of relaxed points
+    '''
+    from sb.animation import PointRelaxer
+    relaxer = PointRelaxer()
+    relaxer.beta.value = beta
+    relaxer.init_processes(max(len(points), 1024))
+    relaxer.start_all()
+    try:
+        relaxer.set_points(points)
+        relaxed = None
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            time.sleep(0.1)
+            published = relaxer.get_points()
+            if published is not None and len(published) == len(points):
+                relaxed = published.copy()
+            if relaxed is not None and relaxer.is_idle:
+                break
+    finally:
+        relaxer.stop_all()
+    return relaxed if relaxed is not None else np.asarray(points)
+
+
+def run_headless(images_dir_path, thumbnails_dir_path, output_path=None,
+                 output_format='ndjson', resume=False, relax=False,
+                 relax_timeout=60.0, n_workers=4, color_engine='histogram'):
+    '''
+    Scans, thumbnails, analyses and projects every image below
+    images_dir_path. Each record is written as soon as its projection is
+    known, with the coordinates in the basis of that moment. The final
+    basis is written next to the output as <output>.basis.json, it maps
+    the features of every record to its final coordinates.
+
+    :param output_path: None writes the records to stdout
+    :param resume: keeps the records in an existing output and only
+        processes files that are new or changed since
+    :param relax: also writes the final coordinates relaxed by the
+        PointRelaxer to <output stem>.layout.<format>, needs output_path
+    :return: dict of throughput statistics
+    '''
+    begin_t = time.perf_counter()
+    previous = []
+    if resume and output_path and path.exists(output_path):
+        truncate_partial_line(output_path)
+        previous = read_records(output_path, output_format)
+    done_keys = {(p, s, m) for p, s, m, _ in previous}
+
+    if output_path:
+        appending = resume and path.exists(output_path) and \
+            path.getsize(output_path) > 0
+        out = open(output_path, 'a' if appending else 'w', newline='')
+    else:
+        out, appending = sys.stdout, False
+    writer = RecordWriter(out, output_format, not appending)
+
+    thumbnails_dir_path = pathlib.Path(thumbnails_dir_path)
+    thumbnails_dir_path.mkdir(parents=True, exist_ok=True)
+    processor = ImageProcessor()
+    processor.color_engine = color_engine
+    processor.init_processes(str(thumbnails_dir_path), n_workers=n_workers)
+    processor.start_all()
+
+    file_keys = []
+    cancel = Event()
+    scanned_keys = set()
+    scanned = Event()
+    submitter = Thread(target=submit_worker, daemon=True, args=(
+        images_dir_path, processor, file_keys, done_keys, cancel,
+        scanned_keys, scanned))
+    submitter.start()
+
+    node_ids = []
+    features = []
+    basis = None
+    try:
+        pool = processor.thumbnail_pool
+        while processor.producer_2.is_alive() or \
+                not processor.results_queue.empty():
+            # Only the projection is used, the rest is drained so the
+            # workers never block
+            for _, slot in drain(processor.thumbnail_slot_queue):
+                pool.release(slot)
+            for _ in drain(processor.analysis_queue):
+                pass
+            if metrics.is_enabled():
+                processor.record_queue_depths()
+            try:
+                version, mean, components, ids, data = \
+                    processor.results_queue.get(timeout=0.1)
+            except Empty:
+                continue
+            basis = version, mean, components
+            writer.write([file_keys[i] for i in ids],
+                         (data - mean) @ components.T, version, data)
+            node_ids.extend(ids)
+            features.append(data)
+    finally:
+        cancel.set()
+        metrics.collect()
+        processor.stop_all()
+        if out is not sys.stdout:
+            out.close()
+
+    # Records of files changed or deleted since are dropped, a changed
+    # file has a new record
+    if previous and scanned.is_set():
+        stale = {(p, s, m) for p, s, m, _ in previous} - scanned_keys
+        if stale:
+            previous = [r for r in previous if r[:3] not in stale]
+            drop_records(output_path, output_format, stale)
+
+    all_keys = [(p, s, m) for p, s, m, _ in previous] + \
+        [file_keys[i] for i in node_ids]
+    all_features = np.concatenate(
+        [np.array([f for _, _, _, f in previous], dtype='float64').reshape(
+            -1, ANALYSIS_SIZE)] + features)
+    if previous and len(all_features) >= 2:
+        # The basis of the earlier runs is not kept, fit it anew
+        ipca = get_2d_ipca()
+        ipca.fit(all_features)
+        basis = 0, ipca.mean_, ipca.components_
+    if basis is not None and output_path:
+        version, mean, components = basis
+        with open(output_path + '.basis.json', 'w') as f:
+            json.dump({'version': version, 'features': FEATURE_NAMES,
+                       'mean': mean.tolist(),
+                       'components': components.tolist()}, f)
+
+    elapsed = time.perf_counter() - begin_t
+    stats = {
+        'images': len(node_ids),
+        'resumed': len(previous),
+        'failed': processor.get_progress()['failed'],
+        'seconds': elapsed,
+        'images_per_second': len(node_ids) / elapsed if elapsed > 0 else 0,
+        'cache': processor.get_cache_stats()
+    }
+
+    if relax and output_path and basis is not None and len(all_keys) >= 3:
+        _, mean, components = basis
+        relax_t = time.perf_counter()
+        points = relax_points((all_features - mean) @ components.T,
+                              relax_timeout)
+        stats['relax_seconds'] = time.perf_counter() - relax_t
+        stem, _ = path.splitext(output_path)
+        with open(f'{stem}.layout.{output_format}', 'w', newline='') as f:
+            # Version -1, the relaxed points are not in any basis
+            RecordWriter(f, output_format, True).write(
+                all_keys, points, -1, all_features)
+    return stats
+
+
+def main(argv=None):
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Process an image library '
+                                        'without a window')
+    parser.add_argument('--images', type=str, required=True)
+    parser.add_argument('--thumbnail-images', type=str, required=True)
+    parser.add_argument('--output', type=str,
+                        help='output file, stdout if not given')
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='ndjson')
+    parser.add_argument('--resume', action='store_true',
+                        help='only process files missing from the output')
+    parser.add_argument('--relax', action='store_true',
+                        help='also write the relaxed final layout')
+    parser.add_argument('--relax-timeout', type=float, default=60.0)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--color-engine', type=str, default='histogram')
+    parser.add_argument('--metrics', type=str,
+                        help='write per-stage metrics to this JSON file')
+    args = parser.parse_args(argv)
+    if args.relax and not args.output:
+        parser.error('--relax needs --output')
+
+    if args.metrics:
+        metrics.enable()
+    stats = run_headless(
+        args.images, args.thumbnail_images, args.output, args.format,
+        args.resume, args.relax, args.relax_timeout, args.workers,
+        args.color_engine)
+    if args.metrics:
+        metrics.get_collector().export_json(args.metrics)
+        metrics.disable()
+    print(json.dumps(stats), file=sys.stderr)
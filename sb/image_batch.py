@@ -0,0 +1,138 @@
+import numpy as np
+from kivy.graphics import InstructionGroup, Mesh
+from kivy.graphics.texture import Texture
+
+from sb.atlas import TextureAtlas, build_mesh_batches
+from sb.drawable import Drawable
+from sb.recttransform import get_transform_rects
+
+
+class AtlasImage(Drawable):
+    def __init__(self, _object, *args, **kwargs):
+        super(AtlasImage, self).__init__(_object)
+        self.batch = kwargs.get('batch', None)
+        self.key = None
+        self.region = None
+
+    def _add_to_canvas(self, canvas):
+        self.batch.add(self)
+
+    def _remove_from_canvas(self, canvas):
+        self.batch.remove(self)
+
+    def _hide(self, canvas):
+        # Keeps the pixels in the atlas
+        self.batch.hide(self)
+
+    def _remove_hidden(self, canvas):
+        self.batch.remove(self)
+
+
+class ImageBatch:
+    '''
+    Draws AtlasImage components through one mesh per atlas page, or more
+    for pages with more images than a mesh can index. Only the shown
+    images of a page are in its meshes, and they are rebuilt only when
+    those images or their rectangles changed.
+    '''
+    def __init__(self, atlas=None):
+        self.atlas = atlas if atlas is not None else TextureAtlas()
+        self.group = InstructionGroup()
+        self._textures = []
+        self._meshes = {}
+        self._images = {}
+        # Per page, cleared when its images change
+        self._uvs = {}
+        self._pools = {}
+        self._slots = {}
+        # Per page, the rectangles of the meshes
+        self._rects = {}
+
+    def attach(self, canvas):
+        canvas.add(self.group)
+
+    def set_image(self, image, key, array):
+        '''
+        Packs the pixels into the atlas and points the image at them.
+        '''
+        image.batch = self
+        image.key = key
+        old_region = image.region
+        image.region = self.atlas.add(key, array)
+        # A shown image moves to the meshes of its new region
+        if old_region is not None and \
+                image in self._images.get(old_region.page, {}):
+            self._hide_region(image, old_region)
+            self.add(image)
+
+    def add(self, image):
+        page = image.region.page
+        self._images.setdefault(page, {})[image] = None
+        self._uvs.pop(page, None)
+
+    def hide(self, image):
+        self._hide_region(image, image.region)
+
+    def _hide_region(self, image, region):
+        self._images.get(region.page, {}).pop(image, None)
+        self._uvs.pop(region.page, None)
+
+    def remove(self, image):
+        self.hide(image)
+        if image.key in self.atlas:
+            self.atlas.remove(image.key)
+
+    def _upload(self):
+        size = self.atlas.page_size
+        while len(self._textures) < len(self.atlas.pages):
+            texture = Texture.create(size=(size, size), colorfmt='rgb')
+            self._textures.append(texture)
+        for page, rects in self.atlas.take_dirty_rects().items():
+            pixels = self.atlas.pages[page]
+            for x, y, width, height in rects:
+                self._textures[page].blit_buffer(
+                    pixels[y:y + height, x:x + width].tobytes(),
+                    size=(width, height), pos=(x, y), colorfmt='rgb',
+                    bufferfmt='ubyte')
+
+    def _index_page(self, page, images):
+        self._uvs[page] = np.array([i.region.uvs for i in images],
+                                   dtype='float32').reshape(-1, 4)
+        pools = {i.transform._pool for i in images}
+        pool = pools.pop() if len(pools) == 1 else None
+        self._pools[page] = pool
+        if pool is not None:
+            self._slots[page] = np.array(
+                [i.transform._slot for i in images], dtype='intp')
+        self._rects.pop(page, None)
+
+    def _get_rects(self, page, images):
+        pool = self._pools[page]
+        if pool is None:
+            return get_transform_rects([i.transform for i in images])
+        models = pool.models[self._slots[page]]
+        return np.stack([models['x'], models['y'], models['width'],
+                         models['height']], axis=1)
+
+    def update(self, dt):
+        self._upload()
+        for page, images in self._images.items():
+            if page not in self._uvs:
+                self._index_page(page, images)
+            rects = self._get_rects(page, images)
+            last_rects = self._rects.get(page)
+            if last_rects is not None and np.array_equal(rects, last_rects):
+                continue
+            self._rects[page] = rects
+            batches = build_mesh_batches(rects, self._uvs[page])
+            meshes = self._meshes.setdefault(page, [])
+            while len(meshes) < len(batches):
+                mesh = Mesh(mode='triangles', texture=self._textures[page])
+                self.group.add(mesh)
+                meshes.append(mesh)
+            for mesh, (vertices, indices) in zip(meshes, batches):
+                mesh.vertices = vertices.tolist()
+                mesh.indices = indices.tolist()
+            for mesh in meshes[len(batches):]:
+                mesh.vertices = []
+                mesh.indices = []
@@ -1,7 +1,5 @@
 import pathlib
 from os import path
-from queue import Empty
-from time import sleep
 
 from PIL import Image as PILImageM
 from PIL.Image import Image as PILImage
@@ -9,17 +7,30 @@ from PIL.Image import Image as PILImage
 from multiprocessing import Process, Value, Queue
 import numpy as np
 
+from sb import metrics
 from sb.analysis import \
-    get_basic_analysis, \
-    extend_analysis, \
-    incremental_batch_fit_transform,\
-    get_2d_ipca
+    ANALYSIS_SIZE, \
+    Analysis, \
+    extend_analysis_batch, \
+    get_2d_ipca, \
+    get_basic_analysis_batch, \
+    stack_images
+from sb.analysis_cache import AnalysisCache
+from sb.decode import MAX_DECODE_PIXELS, decode_thumbnail
+from sb.dispatch import CANCELLED, DONE, Dispatcher, get_blocking, \
+    put_blocking
+from sb.shared_arrays import SlotPool
+from sb.files import get_file_key
+from sb.thumbnail_store import ThumbnailStore, get_legacy_thumbnail_path, \
+    get_rgb_array
 from sb.utilities import flush_queue
 
 
 def get_image_array(img):
     if isinstance(img, np.ndarray):
         array = img.astype('float32')
+        if img.dtype == np.uint8:
+            array /= 255.0
     elif isinstance(img, PILImage):
         array = np.array(img, dtype='float32') / 255.0
     else:
@@ -43,9 +54,8 @@ def get_thumbnail_image(image_file_path, thumbnails_directory_path):
         image_file_path = pathlib.Path(image_file_path)
     if isinstance(thumbnails_directory_path, str):
         thumbnails_directory_path = pathlib.Path(thumbnails_directory_path)
-    title, ext = path.splitext(image_file_path.name)
-    thumbnail_name = 'thumbnail-' + title + '.png'  # TODO
-    thumbnail_path = thumbnails_directory_path.joinpath(thumbnail_name)
+    thumbnail_path = get_legacy_thumbnail_path(
+        image_file_path, thumbnails_directory_path)
     if thumbnail_path.exists():
         # Load existing thumbnail image
         thumbnail_img = PILImageM.open(thumbnail_path)
@@ -68,126 +78,342 @@ def get_thumbnail_image(image_file_path, thumbnails_directory_path):
     return thumbnail_img
 
 
+def get_stored_thumbnail(image_file_path, thumbnail_store, file_key=None,
+                         max_pixels=MAX_DECODE_PIXELS):
+    '''
+    :param max_pixels: images larger than this are not decoded, see
+        sb.decode.decode_thumbnail
+    :return: (height, width, 3) uint8 thumbnail from the store, generated
+        and added to it first if missing
+    '''
+    if file_key is None:
+        try:
+            file_key = get_file_key(image_file_path)
+        except OSError:
+            print("Warning: could not open image file", image_file_path)
+            return None
+    with metrics.span('thumbnail'):
+        array = thumbnail_store.get(file_key)
+        if array is not None:
+            return array
+        size = thumbnail_store.slot_size
+        try:
+            with metrics.span('decode'):
+                img, _ = decode_thumbnail(image_file_path, size, max_pixels)
+            array = get_rgb_array(img)
+        except:
+            print("Warning: could not create thumbnail image for image",
+                  image_file_path)
+            return None
+        thumbnail_store.put(file_key, array)
+        return array
+
+
+def acquire_slot(cancellation, slot_pool):
+    # Blocks while the UI is behind, gives up on cancellation
+    while not cancellation.value:
+        slot = slot_pool.acquire(timeout=0.1)
+        if slot is not None:
+            return slot
+    return None
+
+
 # N workers
 def producer_1(cancellation,
-               file_path_queue,
-               img_array_queue,
+               dispatcher,
+               thumbnail_slot_queue,
+               thumbnail_pool,
                analysis_queue,
                extended_analysis_queue,
-               n_total,
-               thumbnails_dir_path):
-    while not cancellation.value:
-        try:
-            node_id, file_name = file_path_queue.get(False)
-        except Empty:
-            sleep(0.1)
-            continue
-        thumbnail_image = get_thumbnail_image(file_name, thumbnails_dir_path)
-        if thumbnail_image:
-            image_array = get_image_array(thumbnail_image)
-            img_array_queue.put((node_id, image_array))
-            analysis = get_basic_analysis(image_array)
-            analysis_queue.put((node_id, analysis))
-
-            # "Flatten" the image array
-            array_pixels_shape = (image_array.shape[0] * image_array.shape[1],
-                                  *image_array.shape[2:])
-            array_pixels = np.reshape(image_array, array_pixels_shape)
-
-            extend_analysis(array_pixels, analysis)
-            extended_analysis_queue.put((node_id, analysis))
-        else:
-            # Kind of hacky but this should work just fine
-            with n_total.get_lock():
-                n_total.value -= 1
+               thumbnail_store,
+               analysis_cache,
+               cache_hits,
+               cache_misses,
+               color_engine,
+               max_decode_pixels,
+               metrics_queue=None):
+    '''
+    Takes chunks of (node_id, file path) from the dispatcher and sends one
+    (node_ids, data) array per chunk to each analysis queue, with rows laid
+    out as in Analysis.get_data. The analysis queue only gets mean and
+    contrast. Ends extended_analysis_queue with DONE once out of work.
+    '''
+    metrics.init_worker(metrics_queue)
+    while True:
+        batch = dispatcher.get_chunk()
+        if batch is None:
+            break
+        failed = []
+        cached_ids, cached_data = [], []
+        node_ids, file_keys, thumbnails = [], [], []
+        for node_id, file_name in batch:
+            try:
+                file_key = get_file_key(file_name)
+            except OSError:
+                file_key = None
+            if file_key:
+                thumbnail_image = get_stored_thumbnail(
+                    file_name, thumbnail_store, file_key, max_decode_pixels)
+            else:
+                thumbnail_image = None
+            if thumbnail_image is None:
+                failed.append((node_id, file_name))
+                continue
+            # Hand the pixels over in shared memory
+            slot = acquire_slot(cancellation, thumbnail_pool)
+            if slot is None:
+                break
+            thumbnail_pool.write(slot, thumbnail_image)
+            thumbnail_slot_queue.put((node_id, slot))
+            analysis = None
+            if analysis_cache:
+                analysis = analysis_cache.get(file_key)
+                counter = cache_hits if analysis else cache_misses
+                with counter.get_lock():
+                    counter.value += 1
+            if analysis:
+                cached_ids.append(node_id)
+                cached_data.append(analysis.get_data())
+            else:
+                node_ids.append(node_id)
+                file_keys.append(file_key)
+                thumbnails.append(thumbnail_image)
+        if cached_ids:
+            data = np.array(cached_data, dtype='float64')
+            put_blocking(analysis_queue, (cached_ids, data[:, :2]),
+                         cancellation)
+            put_blocking(extended_analysis_queue, (cached_ids, data),
+                         cancellation)
+        if node_ids:
+            stack, mask = stack_images(thumbnails)
+            stack = stack.astype('float32') / 255.0
+            data = np.zeros((len(node_ids), ANALYSIS_SIZE))
+            with metrics.span('basic_analysis'):
+                data[:, :2] = get_basic_analysis_batch(stack, mask)
+            put_blocking(analysis_queue, (node_ids, data[:, :2].copy()),
+                         cancellation)
+            with metrics.span('colors'):
+                extend_analysis_batch(stack, mask, data, color_engine)
+            put_blocking(extended_analysis_queue, (node_ids, data),
+                         cancellation)
+            if analysis_cache:
+                analysis_cache.put_many(
+                    file_keys, [Analysis.from_data(d) for d in data])
+        if not cancellation.value:
+            dispatcher.report(len(cached_ids) + len(node_ids), len(failed))
+            metrics.count('images', len(cached_ids) + len(node_ids))
 
-    # Flush the queues
-    flush_queue(file_path_queue)
-    flush_queue(img_array_queue)
-    flush_queue(analysis_queue)
-    flush_queue(extended_analysis_queue)
+    metrics.flush()
+    if cancellation.value:
+        # Flush the queues
+        flush_queue(dispatcher.chunks)
+        flush_queue(thumbnail_slot_queue)
+        flush_queue(analysis_queue)
+        flush_queue(extended_analysis_queue)
+    else:
+        put_blocking(extended_analysis_queue, DONE, cancellation)
 
 # 1 worker only!!!
 def producer_2(cancellation,
                extended_analysis_queue,
                results_queue,
-               n_total,
-               chunk_size):
-    ipca = get_2d_ipca()
-    counter = 0
-    complete = False
+               n_producers,
+               chunk_size,
+               initial_data=None,
+               metrics_queue=None):
+    '''
+    Fits the 2D PCA chunk by chunk. Each chunk publishes the new basis
+    together with the features of that chunk only, the consumer keeps the
+    features and projects them itself. Finishes once all n_producers have
+    sent DONE.
 
-    prior_node_ids = []
-    prior_data = []
+    The PCA can only be fitted on at least n_components samples, smaller
+    chunks are held back. A smaller tail is published with the current
+    basis and version, or dropped if there is no basis yet.
 
-    while not cancellation.value:
-        n_pending = extended_analysis_queue.qsize()
-        with n_total.get_lock():
-            complete = counter + n_pending >= n_total.value
-        chunk_ready = n_pending >= chunk_size
+    :param initial_data: features the consumer already has, e.g. from an
+        earlier run on the same directory, the PCA is fitted on them
+        first so that every basis covers all the features
+    '''
+    metrics.init_worker(metrics_queue)
+    ipca = get_2d_ipca()
+    version = 0
+    if initial_data is not None and len(initial_data) >= ipca.n_components:
+        with metrics.span('ipca'):
+            ipca.partial_fit(initial_data)
+        # A basis exists, small chunks are published with it
+        version = 1
+    n_finished = 0
+    pending_ids = []
+    pending_data = []
+    n_pending = 0
+
+    while n_finished < n_producers:
+        message = get_blocking(extended_analysis_queue, cancellation)
+        if message is CANCELLED:
+            break
+        if message is DONE:
+            n_finished += 1
+        else:
+            node_ids, data = message
+            pending_ids.extend(node_ids)
+            pending_data.append(data)
+            n_pending += len(node_ids)
         # Finish up the rest of the queue
-        if chunk_ready or complete:
-            chunk = []
-            for _ in range(chunk_size):
-                try:
-                    index, analysis = extended_analysis_queue.get(False)
-                except Empty:
-                    sleep(0.1)
-                    break
-                e = (index, analysis.get_data())
-                chunk.append(e)
-                counter += 1
-            if chunk:
-                node_ids, chunk_data = zip(*chunk)
-                prior_node_ids.extend(node_ids)
-                prior_data.extend(chunk_data)
-                results = incremental_batch_fit_transform(
-                    ipca, prior_data, chunk_data)
-                for r in zip(prior_node_ids, results):
-                    results_queue.put(r)
-    # Flush the queues
-    flush_queue(extended_analysis_queue)
-    flush_queue(results_queue)
+        complete = n_finished == n_producers
+        min_size = max(chunk_size, ipca.n_components)
+        if n_pending >= min_size or (complete and n_pending):
+            chunk_data = np.concatenate(pending_data)
+            if n_pending >= ipca.n_components:
+                with metrics.span('ipca'):
+                    ipca.partial_fit(chunk_data)
+                version += 1
+            if version:
+                metrics.count('projected_images', n_pending)
+                results_queue.put((version, ipca.mean_, ipca.components_,
+                                   pending_ids, chunk_data))
+            pending_ids = []
+            pending_data = []
+            n_pending = 0
+
+    metrics.flush()
+    if cancellation.value:
+        # Flush the queues
+        flush_queue(extended_analysis_queue)
+        flush_queue(results_queue)
 
 class ImageProcessor:
     def __init__(self):
         self.cancellation = Value('i', 0, lock=True)
-        self.n_total = Value('i', 0, lock=True)
-        self.file_path_queue = Queue()
-        self.img_array_queue = Queue()
-        self.analysis_queue = Queue()
-        self.extended_analysis_queue = Queue()
+        self.cache_hits = Value('i', 0, lock=True)
+        self.cache_misses = Value('i', 0, lock=True)
+        # See sb.colors.color_engines
+        self.color_engine = 'histogram'
+        # Per image, bounds the memory a worker needs for decoding
+        self.max_decode_pixels = MAX_DECODE_PIXELS
+        self.analysis_cache = None
+        self.thumbnail_store = None
+        self.dispatcher = None
+        self.thumbnail_slot_queue = Queue()
+        self.thumbnail_pool = None
+        # Bounds the analysed batches waiting on each consumer
+        self.analysis_queue = Queue(maxsize=64)
+        self.extended_analysis_queue = Queue(maxsize=64)
         self.results_queue = Queue()
         self.producer_1s = []
         self.producer_2 = None
 
-    def init_processes(self, thumbnails_dir_path, n_workers=4, p2_chunk_size=16):
-        p1_args = (self.cancellation, self.file_path_queue, self.img_array_queue, self.analysis_queue, self.extended_analysis_queue, self.n_total, thumbnails_dir_path)
-        p2_args = (self.cancellation, self.extended_analysis_queue, self.results_queue, self.n_total, p2_chunk_size)
+    def init_processes(self, thumbnails_dir_path, n_workers=4, p2_chunk_size=16,
+                       analysis_cache_path=None, n_thumbnail_slots=512,
+                       chunk_size=32, initial_data=None):
+        '''
+        :param chunk_size: files a worker takes at a time
+        :param initial_data: (n, ANALYSIS_SIZE) features of the images
+            that are already projected, see producer_2
+        :param analysis_cache_path: SQLite file for cached analysis results,
+            defaults to analysis.sqlite in the thumbnails directory
+        :param n_thumbnail_slots: thumbnails that may be in flight to the UI
+        '''
+        if analysis_cache_path is None:
+            analysis_cache_path = pathlib.Path(
+                thumbnails_dir_path, 'analysis.sqlite')
+        self.analysis_cache = AnalysisCache(analysis_cache_path,
+                                            self.color_engine)
+        self.thumbnail_store = ThumbnailStore(thumbnails_dir_path)
+        self.thumbnail_pool = SlotPool(
+            n_thumbnail_slots, self.thumbnail_store.slot_shape, 'uint8')
+        self.dispatcher = Dispatcher(self.cancellation, n_workers, chunk_size)
+        metrics_queue = metrics.get_queue()
+        p1_args = (self.cancellation, self.dispatcher, self.thumbnail_slot_queue, self.thumbnail_pool, self.analysis_queue, self.extended_analysis_queue, self.thumbnail_store, self.analysis_cache, self.cache_hits, self.cache_misses, self.color_engine, self.max_decode_pixels, metrics_queue)
+        p2_args = (self.cancellation, self.extended_analysis_queue, self.results_queue, n_workers, p2_chunk_size, initial_data, metrics_queue)
 
         self.producer_1s = [Process(target=producer_1, args=p1_args)
                             for _ in range(n_workers)]
         self.producer_2 = Process(target=producer_2, args=p2_args)
 
-    def start_all(self, file_paths):
-        for node_id, file_path in file_paths:
-            self.file_path_queue.put((node_id, file_path))
-        with self.n_total.get_lock():
-            self.n_total.value = len(file_paths)
+    def needs_legacy_migration(self, thumbnails_dir_path):
+        return len(self.thumbnail_store) == 0 and \
+            any(pathlib.Path(thumbnails_dir_path).glob('thumbnail-*.png'))
+
+    def migrate_legacy_thumbnails(self, thumbnails_dir_path, file_paths):
+        '''
+        One-time import of per-file PNG thumbnails into the thumbnail store.
+        '''
+        if self.needs_legacy_migration(thumbnails_dir_path):
+            self.thumbnail_store.migrate_png_directory(
+                thumbnails_dir_path, file_paths)
+
+    def start_all(self, file_paths=None):
+        '''
+        :param file_paths: (node_id, file path) pairs, if given these are
+            all the files, otherwise pass them to submit as they come in
+        '''
+        # SQLite connections must not be shared with forked workers
+        self.thumbnail_store.close()
+        self.analysis_cache.close()
         for p1 in self.producer_1s:
             p1.start()
         self.producer_2.start()
+        # Fork before the feeder thread starts
+        self.dispatcher.start()
+        if file_paths is not None:
+            self.submit(file_paths)
+            self.end_submissions()
+
+    def submit(self, file_paths):
+        '''
+        :param file_paths: (node_id, file path) pairs
+        '''
+        self.dispatcher.submit(file_paths)
+
+    def end_submissions(self):
+        self.dispatcher.close()
 
     def stop_all(self):
         with self.cancellation.get_lock():
             self.cancellation.value = 1
 
+        metrics.collect()
         for p1 in self.producer_1s:
             p1.join()
         #print('joined p1s')
         self.producer_2.join()
         #print('joined p2')
+        self.dispatcher.join()
+        self.thumbnail_pool.close()
+        self.thumbnail_pool.unlink()
 
         #with self.cancellation.get_lock():
         #    self.cancellation.value = 0
 
+    @property
+    def is_complete(self):
+        return self.dispatcher is not None and self.dispatcher.is_complete
+
+    def get_progress(self):
+        return {'total': self.dispatcher.n_total.value,
+                'completed': self.dispatcher.n_completed.value,
+                'failed': self.dispatcher.n_failed.value}
+
+    def record_queue_depths(self):
+        '''
+        Records the number of items waiting in each queue as gauges.
+        '''
+        queues = {
+            'chunks': self.dispatcher.chunks,
+            'thumbnail_slots': self.thumbnail_slot_queue,
+            'analysis': self.analysis_queue,
+            'extended_analysis': self.extended_analysis_queue,
+            'results': self.results_queue
+        }
+        for name, q in queues.items():
+            try:
+                metrics.gauge('queue.' + name, q.qsize())
+            except NotImplementedError:
+                # Not available on macOS
+                pass
+
+    def get_cache_stats(self):
+        return {'hits': self.cache_hits.value,
+                'misses': self.cache_misses.value}
+
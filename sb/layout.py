@@ -0,0 +1,247 @@
+from abc import ABC, abstractmethod
+
+import numpy as np
+from scipy.spatial import Delaunay, QhullError, cKDTree
+
+from sb import metrics
+
+
+def expand_ranges(starts, counts):
+    '''
+    :return: (owner, position) arrays with one entry for every element of
+        the ranges [starts[i], starts[i] + counts[i])
+    '''
+    n_total = int(counts.sum())
+    owner = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.arange(n_total) - np.repeat(np.cumsum(counts) - counts,
+                                             counts)
+    return owner, np.repeat(starts, counts) + offsets
+
+
+def csr_from_pairs(n, i, j, weights=None):
+    '''
+    :return: (neighbor_divs, neighbors, weights) of the directed edges i -> j
+    '''
+    order = np.argsort(i, kind='stable')
+    divs = np.zeros(n + 1, dtype='int32')
+    np.cumsum(np.bincount(i, minlength=n), out=divs[1:])
+    if weights is not None:
+        weights = weights[order].astype('float32')
+    return divs, j[order].astype('int32'), weights
+
+
+def max_displacement(points, prior):
+    if not len(points):
+        return 0.0
+    d = points - prior
+    return np.hypot(d[:, 0], d[:, 1]).max()
+
+
+def cell_keys(cells):
+    # Pack 2D integer cell coordinates into a single int64
+    return (cells[:, 0] << 32) + cells[:, 1]
+
+
+def lookup_cells(unique_keys, keys):
+    '''
+    :return: (indices of keys found in unique_keys, their slots)
+    '''
+    slots = np.searchsorted(unique_keys, keys)
+    slots = np.minimum(slots, len(unique_keys) - 1)
+    found = np.flatnonzero(unique_keys[slots] == keys)
+    return found, slots[found]
+
+
+class LayoutBackend(ABC):
+    '''
+    Builds the neighbor graph the relaxation kernels run on.
+
+    The graph is in CSR form (neighbor_divs, neighbors). A backend may also
+    provide far_points, pseudo-points that are placed after the real points
+    and that neighbor indices can refer to, and per-edge weights.
+    '''
+    def __init__(self):
+        self.neighbor_divs = None
+        self.neighbors = None
+        self.weights = None
+        self.far_points = None
+        self.n_builds = 0
+
+    @abstractmethod
+    def update(self, points, beta, threshold):
+        '''
+        :param beta: relaxation distance
+        :param threshold: displacement since the last build below which the
+            prior graph may be reused
+        :return: True if the graph changed
+        '''
+
+
+class DelaunayBackend(LayoutBackend):
+    '''
+    Delaunay neighbors. The triangulation is only rebuilt once points have
+    moved more than threshold since it was built, points appended in
+    between are inserted incrementally.
+    '''
+    def __init__(self):
+        super(DelaunayBackend, self).__init__()
+        self._delaunay = None
+        self._built_points = None
+        # Incremental updates that fell back to a full build
+        self.n_fallbacks = 0
+
+    def _set_neighbors(self, points):
+        self._built_points = np.array(points)
+        self.neighbor_divs, self.neighbors = \
+            self._delaunay.vertex_neighbor_vertices
+        self.n_builds += 1
+
+    def update(self, points, beta, threshold):
+        n = len(points)
+        if self._delaunay is not None and n >= len(self._built_points):
+            n_built = len(self._built_points)
+            displacement = max_displacement(points[:n_built],
+                                            self._built_points)
+            if displacement < threshold:
+                if n == n_built:
+                    return False
+                try:
+                    self._delaunay.add_points(points[n_built:])
+                except QhullError:
+                    self.n_fallbacks += 1
+                    metrics.count('delaunay_fallback')
+                else:
+                    self._set_neighbors(np.concatenate(
+                        (self._built_points, points[n_built:])))
+                    return True
+
+        self._delaunay = None
+        self._delaunay = Delaunay(points, incremental=True)
+        self._set_neighbors(points)
+        return True
+
+
+class KDTreeBackend(LayoutBackend):
+    '''
+    All points within radius * beta of each other. The search radius is
+    padded by twice the threshold so the graph stays valid until some point
+    has moved more than threshold.
+    '''
+    def __init__(self, radius=1.0):
+        super(KDTreeBackend, self).__init__()
+        self.radius = radius
+        self._built_points = None
+
+    def update(self, points, beta, threshold):
+        if self._built_points is not None and \
+                len(points) == len(self._built_points) and \
+                max_displacement(points, self._built_points) < threshold:
+            return False
+        r = self.radius * beta + 2 * threshold
+        pairs = cKDTree(points).query_pairs(r, output_type='ndarray')
+        i = np.concatenate((pairs[:, 0], pairs[:, 1]))
+        j = np.concatenate((pairs[:, 1], pairs[:, 0]))
+        self.neighbor_divs, self.neighbors, _ = csr_from_pairs(
+            len(points), i, j)
+        self._built_points = np.array(points)
+        self.n_builds += 1
+        return True
+
+
+class GridBackend(LayoutBackend):
+    '''
+    Uniform grid with a Barnes-Hut style far field.
+
+    Near field: exact neighbors within radius * beta, found in the 3 x 3
+    surrounding grid cells. At most max_cell_points points of each cell are
+    considered, which bounds the work in crowded regions.
+
+    Far field: the points are also binned in a coarser grid, far_cell_scale
+    times larger. Each occupied coarse cell within far_cells of a point's
+    own coarse cell becomes one pseudo-point at its centroid. It repels the
+    point with a negative weight proportional to its point count over the
+    squared distance to the centroid, in units of the near field radius.
+    The repulsion of each point sums to at most far_weight, which keeps the
+    relaxation stable in dense regions. This spreads neighboring clusters
+    apart rather than only resolving overlaps within the near field.
+    '''
+    def __init__(self, radius=1.0, max_cell_points=16, far_cell_scale=4,
+                 far_cells=2, far_weight=1.0):
+        super(GridBackend, self).__init__()
+        self.radius = radius
+        self.max_cell_points = max_cell_points
+        self.far_cell_scale = far_cell_scale
+        self.far_cells = far_cells
+        self.far_weight = far_weight
+
+    def _near_pairs(self, points, h):
+        cells = np.floor(points / h).astype('int64')
+        keys = cell_keys(cells)
+        order = np.argsort(keys, kind='stable')
+        unique_keys, starts, counts = np.unique(
+            keys[order], return_index=True, return_counts=True)
+        counts = np.minimum(counts, self.max_cell_points)
+        ii, jj = [], []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                found, slots = lookup_cells(
+                    unique_keys, cell_keys(cells + (dx, dy)))
+                owner, positions = expand_ranges(starts[slots],
+                                                 counts[slots])
+                i = found[owner]
+                j = order[positions]
+                d = points[j] - points[i]
+                keep = (i != j) & (np.hypot(d[:, 0], d[:, 1]) < h)
+                ii.append(i[keep])
+                jj.append(j[keep])
+        return np.concatenate(ii), np.concatenate(jj)
+
+    def _far_pairs(self, points, h):
+        n = len(points)
+        cells = np.floor(points / (h * self.far_cell_scale)).astype('int64')
+        unique_keys, inverse, counts = np.unique(
+            cell_keys(cells), return_inverse=True, return_counts=True)
+        inverse = inverse.reshape(-1)
+        centroids = np.stack((np.bincount(inverse, points[:, 0]),
+                              np.bincount(inverse, points[:, 1])), axis=1)
+        centroids /= counts[:, None]
+
+        ii, jj, ww = [], [], []
+        r = self.far_cells
+        for dx in range(-r, r + 1):
+            for dy in range(-r, r + 1):
+                if not dx and not dy:
+                    continue
+                found, slots = lookup_cells(
+                    unique_keys, cell_keys(cells + (dx, dy)))
+                d = centroids[slots] - points[found]
+                distance = np.maximum(np.hypot(d[:, 0], d[:, 1]), h)
+                ii.append(found)
+                jj.append(n + slots)
+                ww.append(counts[slots] * (h / distance) ** 2)
+        i = np.concatenate(ii)
+        w = np.concatenate(ww)
+        total = np.bincount(i, w, minlength=n)
+        w = -self.far_weight * w / np.maximum(total[i], 1.0)
+        return i, np.concatenate(jj), w, centroids.astype('float32')
+
+    def update(self, points, beta, threshold):
+        # Centroids move with the points, so this rebuilds every round
+        h = self.radius * beta
+        near_i, near_j = self._near_pairs(points, h)
+        far_i, far_j, far_w, far_points = self._far_pairs(points, h)
+        i = np.concatenate((near_i, far_i))
+        j = np.concatenate((near_j, far_j))
+        w = np.concatenate((np.ones(len(near_i)), far_w))
+        self.neighbor_divs, self.neighbors, self.weights = csr_from_pairs(
+            len(points), i, j, w)
+        self.far_points = far_points
+        self.n_builds += 1
+        return True
+
+
+layout_backends = {
+    'delaunay': DelaunayBackend,
+    'kdtree': KDTreeBackend,
+    'grid': GridBackend
+}
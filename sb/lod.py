@@ -0,0 +1,237 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from sb.decode import MAX_DECODE_PIXELS, decode_thumbnail
+
+
+def decode_array(file_path, size, max_pixels=MAX_DECODE_PIXELS):
+    '''
+    :return: (height, width, 3) uint8 array no larger than size x size
+    '''
+    img, _ = decode_thumbnail(file_path, size, max_pixels)
+    return np.asarray(img)
+
+
+class LRUCache:
+    '''
+    Least recently used cache with a hard limit on the summed size of its
+    values in bytes.
+    '''
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.n_evictions = 0
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def get(self, key, default=None):
+        '''
+        Looks up key and marks it as most recently used.
+        '''
+        item = self._items.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._items.move_to_end(key)
+        return item[0]
+
+    def put(self, key, value, n_bytes):
+        '''
+        :return: list of (key, value) evicted to stay within the budget,
+            including the new value if it alone exceeds the budget
+        '''
+        if n_bytes > self.budget_bytes:
+            return [(key, value)]
+        evicted = []
+        if key in self._items:
+            evicted.append((key, self.pop(key)))
+        while self.n_bytes + n_bytes > self.budget_bytes:
+            old_key, (old_value, old_bytes) = self._items.popitem(last=False)
+            self.n_bytes -= old_bytes
+            self.n_evictions += 1
+            evicted.append((old_key, old_value))
+        self._items[key] = value, n_bytes
+        self.n_bytes += n_bytes
+        return evicted
+
+    def pop(self, key):
+        value, n_bytes = self._items.pop(key)
+        self.n_bytes -= n_bytes
+        return value
+
+    @property
+    def hit_rate(self):
+        n = self.hits + self.misses
+        return self.hits / n if n else 0.0
+
+
+class LodCache:
+    '''
+    Higher resolution versions of the thumbnails of nodes in view, for
+    nodes drawn larger than min_screen_size pixels. Each version is decoded
+    from the original by a background thread at the smallest of levels
+    that covers the node's size on screen, and is kept in an LRU cache
+    with a hard byte budget. Versions are dropped as soon as their node
+    leaves the view. A node that needs another level keeps showing its
+    version until the new one arrives.
+
+    The cache statistics count one lookup per change of a node's level,
+    not one per frame.
+
+    New decodes are only started while the cached and pending versions fit
+    into the budget, so versions in view do not evict each other.
+    '''
+    def __init__(self, budget_bytes=256 * 1024 * 1024, levels=(256, 512),
+                 min_screen_size=96, n_workers=2, to_value=None,
+                 max_pixels=MAX_DECODE_PIXELS):
+        '''
+        :param to_value: called on the decoded array in update(), e.g. to
+            create a texture, the array is cached as is if None
+        '''
+        self.cache = LRUCache(budget_bytes)
+        self.levels = sorted(levels)
+        self.min_screen_size = min_screen_size
+        self.to_value = to_value
+        self.max_pixels = max_pixels
+        self.n_decoded = 0
+        self.n_failed = 0
+        self.n_over_budget = 0
+        self._executor = ThreadPoolExecutor(n_workers)
+        self._pending = {}
+        self._failed = set()
+        # Node key -> version shown, and wanted as of the last update
+        self._shown = {}
+        self._wanted = {}
+
+    def get_level(self, screen_size):
+        '''
+        :return: decode size for a node screen_size pixels large, or None
+            if the regular thumbnail is enough
+        '''
+        if screen_size < self.min_screen_size:
+            return None
+        for level in self.levels:
+            if level >= screen_size:
+                return level
+        return self.levels[-1]
+
+    def _pending_bytes(self):
+        return sum(3 * level * level for _, level in self._pending)
+
+    def _collect(self, loaded, evicted):
+        for version, future in list(self._pending.items()):
+            if not future.done():
+                continue
+            del self._pending[version]
+            try:
+                array = future.result()
+            except Exception:
+                self.n_failed += 1
+                self._failed.add(version)
+                continue
+            self.n_decoded += 1
+            value = array if self.to_value is None else self.to_value(array)
+            for old_version, old_value in self.cache.put(
+                    version, value, array.nbytes):
+                if old_version == version:
+                    continue
+                if self._shown.get(old_version[0]) == old_version:
+                    del self._shown[old_version[0]]
+                evicted.append((old_version, old_value))
+            if version in self.cache:
+                # Replaces the other level of the node, if any
+                key = version[0]
+                old_version = self._shown.get(key)
+                if old_version is not None and old_version in self.cache:
+                    evicted.append((old_version, self.cache.pop(old_version)))
+                self._shown[key] = version
+                loaded.append((version, value))
+
+    def update(self, visible):
+        '''
+        Call once per frame.
+
+        :param visible: dict of node key -> (file path, size on screen in
+            pixels) of the nodes in view
+        :return: (loaded, evicted), lists of ((node key, level), value) of
+            versions to show and to stop showing
+        '''
+        wanted = {}
+        for key, (file_path, screen_size) in visible.items():
+            level = self.get_level(screen_size)
+            if level is not None:
+                wanted[key] = (key, level), file_path
+
+        evicted = []
+        for version in list(self.cache):
+            key = version[0]
+            if key in wanted and (version == wanted[key][0] or
+                                  version == self._shown.get(key)):
+                continue
+            if self._shown.get(key) == version:
+                del self._shown[key]
+            evicted.append((version, self.cache.pop(version)))
+        for version in [v for v in self._pending
+                        if v[0] not in wanted or v != wanted[v[0]][0]]:
+            self._pending.pop(version).cancel()
+
+        loaded = []
+        self._collect(loaded, evicted)
+
+        pending_bytes = self._pending_bytes()
+        last_wanted = self._wanted
+        self._wanted = {}
+        for key, (version, file_path) in wanted.items():
+            self._wanted[key] = version
+            if last_wanted.get(key) != version:
+                cached = self.cache.get(version) is not None
+            else:
+                cached = version in self.cache
+            if cached or version in self._pending or version in self._failed:
+                continue
+            n_bytes = 3 * version[1] * version[1]
+            if self.cache.n_bytes + pending_bytes + n_bytes > \
+                    self.cache.budget_bytes:
+                self.n_over_budget += 1
+                continue
+            pending_bytes += n_bytes
+            self._pending[version] = self._executor.submit(
+                decode_array, file_path, version[1], self.max_pixels)
+        return loaded, evicted
+
+    def get_stats(self):
+        cache = self.cache
+        return {
+            'hits': cache.hits,
+            'misses': cache.misses,
+            'hit_rate': cache.hit_rate,
+            'bytes': cache.n_bytes,
+            'budget_bytes': cache.budget_bytes,
+            'budget_used': cache.n_bytes / cache.budget_bytes,
+            'versions': len(cache),
+            'pending': len(self._pending),
+            'evictions': cache.n_evictions,
+            'decoded': self.n_decoded,
+            'failed': self.n_failed,
+            'over_budget': self.n_over_budget
+        }
+
+    def close(self):
+        for future in self._pending.values():
+            future.cancel()
+        self._pending = {}
+        self._shown = {}
+        self._executor.shutdown(wait=False)
@@ -1,5 +1,7 @@
 from math import exp, log
 
+import numpy as np
+
 
 def soft_maximum(a, b):
     return log(1 + exp(b - a)) + a
@@ -8,3 +10,10 @@ def soft_maximum(a, b):
 def soft_minimum(a, b):
     return b - log(1 + exp(b - a))
 
+
+def soft_maximum_array(a, b):
+    return np.logaddexp(0, b - a) + a
+
+
+def soft_minimum_array(a, b):
+    return b - np.logaddexp(0, b - a)
@@ -0,0 +1,362 @@
+'''
+Per-stage latencies, counters and gauges, collected across processes.
+
+Disabled by default, in which case span() returns a shared no-op context
+manager and count() and gauge() return right away. enable() in the main
+process before the workers are started, and call init_worker() with
+get_queue() at the start of every worker process. enable() also starts a
+thread that takes in the batches of the workers while they run, a worker
+blocks on exit until everything it put on the queue was read.
+
+    collector = metrics.enable()
+    ...
+    with metrics.span('decode'):
+        ...
+    collector.export_json('metrics.json')
+    collector.export_chrome_trace('trace.json')
+
+Timestamps come from time.perf_counter_ns, a monotonic clock that is
+shared by the processes on Linux.
+'''
+import json
+import os
+import threading
+import time
+from collections import deque
+from multiprocessing import Queue, current_process
+from queue import Empty
+
+# Lower bounds of the latency histogram buckets, in microseconds
+BUCKETS_US = tuple(2 ** i for i in range(32))
+
+_recorder = None
+_collector = None
+
+
+class Histogram:
+    '''
+    Latency histogram with power of two buckets in microseconds.
+    '''
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS_US)
+        self.n = 0
+        self.total_us = 0
+        self.min_us = None
+        self.max_us = 0
+
+    def add(self, duration_us):
+        index = min(max(int(duration_us), 1).bit_length() - 1,
+                    len(BUCKETS_US) - 1)
+        self.counts[index] += 1
+        self.n += 1
+        self.total_us += duration_us
+        if self.min_us is None or duration_us < self.min_us:
+            self.min_us = duration_us
+        self.max_us = max(self.max_us, duration_us)
+
+    def quantile(self, q):
+        '''
+        :return: upper bound of the bucket holding the q quantile, in
+            microseconds
+        '''
+        rank = q * self.n
+        n = 0
+        for count, lower in zip(self.counts, BUCKETS_US):
+            n += count
+            if n >= rank and count:
+                return 2 * lower
+        return 0
+
+    def to_dict(self):
+        return {
+            'count': self.n,
+            'total_ms': self.total_us / 1000,
+            'mean_ms': self.total_us / self.n / 1000 if self.n else 0.0,
+            'min_ms': (self.min_us or 0) / 1000,
+            'max_ms': self.max_us / 1000,
+            'p50_ms': self.quantile(0.5) / 1000,
+            'p90_ms': self.quantile(0.9) / 1000,
+            'p99_ms': self.quantile(0.99) / 1000,
+            # Keyed by upper bound
+            'buckets_us': {2 * lower: count for lower, count
+                           in zip(BUCKETS_US, self.counts) if count}
+        }
+
+
+class Recorder:
+    '''
+    Buffers the records of one process and hands them to sink in batches
+    of (pid, worker name, records), at most every flush_interval seconds.
+    '''
+    def __init__(self, sink, flush_interval=0.5):
+        self.sink = sink
+        self.flush_interval = flush_interval
+        self.pid = os.getpid()
+        self.worker = current_process().name
+        self._records = []
+        self._last_flush = time.perf_counter()
+
+    def add(self, record):
+        self._records.append(record)
+        if time.perf_counter() - self._last_flush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.perf_counter()
+        if self._records:
+            records = self._records
+            self._records = []
+            self.sink((self.pid, self.worker, records))
+
+
+class MetricsCollector:
+    '''
+    Aggregates the records of every process into latency histograms per
+    stage, counters per worker and the last value of each gauge, and keeps
+    the most recent max_events for trace export.
+    '''
+    def __init__(self, max_events=200000):
+        self.queue = Queue()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.workers = {}
+        self.events = deque(maxlen=max_events)
+        self._lock = threading.RLock()
+        # Held by whoever reads the queue, so that collect() returns
+        # only after a batch taken by the thread was added
+        self._queue_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add_batch(self, batch):
+        with self._lock:
+            self._add_batch(batch)
+
+    def _add_batch(self, batch):
+        pid, worker, records = batch
+        self.workers[pid] = worker
+        for record in records:
+            kind, name, ts, value, tid = record
+            if kind == 'X':
+                histogram = self.histograms.get(name)
+                if histogram is None:
+                    histogram = self.histograms[name] = Histogram()
+                histogram.add(value)
+            elif kind == 'C':
+                self.gauges[name] = value
+            else:
+                key = (worker, name)
+                counter = self.counters.get(key)
+                if counter is None:
+                    counter = self.counters[key] = [0, ts, ts]
+                counter[0] += value
+                counter[2] = ts
+                continue
+            self.events.append((pid, tid) + record[:4])
+
+    def collect(self):
+        '''
+        Takes in the batches sent by worker processes.
+        '''
+        if _recorder is not None and _recorder.sink == self.add_batch:
+            _recorder.flush()
+        with self._queue_lock:
+            while True:
+                try:
+                    batch = self.queue.get_nowait()
+                except Empty:
+                    break
+                self.add_batch(batch)
+
+    def _run(self, interval):
+        while not self._stop.is_set():
+            with self._queue_lock:
+                try:
+                    batch = self.queue.get(timeout=interval)
+                except Empty:
+                    continue
+                self.add_batch(batch)
+
+    def start(self, interval=0.1):
+        '''
+        Takes in the batches of worker processes on a daemon thread until
+        stop().
+        '''
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, args=(interval,), daemon=True,
+                name='metrics collector')
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.collect()
+
+    def snapshot(self):
+        self.collect()
+        workers = {}
+        with self._lock:
+            for (worker, name), (total, first, last) in \
+                    self.counters.items():
+                elapsed = (last - first) / 1e6
+                workers.setdefault(worker, {})[name] = {
+                    'total': total,
+                    'per_second': total / elapsed if elapsed > 0 else None
+                }
+            return {
+                'stages': {name: h.to_dict()
+                           for name, h in sorted(self.histograms.items())},
+                'gauges': dict(sorted(self.gauges.items())),
+                'workers': workers
+            }
+
+    def export_json(self, file_path):
+        with open(file_path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+    def export_chrome_trace(self, file_path):
+        '''
+        Writes the recorded spans and gauges in the Chrome trace event
+        format, for chrome://tracing or Perfetto.
+        '''
+        self.collect()
+        with self._lock:
+            workers = list(self.workers.items())
+            recorded = list(self.events)
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': pid,
+                   'args': {'name': worker}}
+                  for pid, worker in workers]
+        for pid, tid, kind, name, ts, value in recorded:
+            if kind == 'X':
+                events.append({'name': name, 'ph': 'X', 'pid': pid,
+                               'tid': tid, 'ts': ts, 'dur': value})
+            else:
+                events.append({'name': name, 'ph': 'C', 'pid': pid,
+                               'ts': ts, 'args': {'value': value}})
+        with open(file_path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+class _Span:
+    __slots__ = ('name', 'begin')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.begin = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *args):
+        end = time.perf_counter_ns()
+        if _recorder is not None:
+            _recorder.add(('X', self.name, self.begin // 1000,
+                           (end - self.begin) / 1000,
+                           threading.get_ident() & 0xffffffff))
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def _now_us():
+    return time.perf_counter_ns() // 1000
+
+
+def span(name):
+    '''
+    :return: context manager that records the time spent in it under name
+    '''
+    if _recorder is None:
+        return _NULL_SPAN
+    return _Span(name)
+
+
+def count(name, n=1):
+    '''
+    Adds n to the counter of name for the current worker, its rate is the
+    worker's throughput.
+    '''
+    if _recorder is not None:
+        _recorder.add(('I', name, _now_us(), n, 0))
+
+
+def gauge(name, value):
+    if _recorder is not None:
+        _recorder.add(('C', name, _now_us(), value, 0))
+
+
+def is_enabled():
+    return _recorder is not None
+
+
+def enable(max_events=200000):
+    '''
+    Starts recording in this process.
+
+    :return: the MetricsCollector
+    '''
+    global _recorder, _collector
+    if _collector is None:
+        _collector = MetricsCollector(max_events)
+    _recorder = Recorder(_collector.add_batch)
+    _collector.start()
+    return _collector
+
+
+def disable():
+    global _recorder
+    if _recorder is not None:
+        _recorder.flush()
+    _recorder = None
+    if _collector is not None:
+        _collector.stop()
+
+
+def get_collector():
+    return _collector
+
+
+def collect():
+    '''
+    Takes in the pending batches of the workers, call it before joining
+    them.
+    '''
+    if _collector is not None and _recorder is not None:
+        _collector.collect()
+
+
+def get_queue():
+    '''
+    :return: queue to pass to init_worker, None while disabled
+    '''
+    return _collector.queue if _recorder is not None else None
+
+
+def init_worker(queue):
+    '''
+    Records to queue in a worker process, or disables recording if queue
+    is None.
+    '''
+    global _recorder, _collector
+    _collector = None
+    _recorder = Recorder(queue.put) if queue is not None else None
+
+
+def flush():
+    if _recorder is not None:
+        _recorder.flush()
@@ -1,5 +1,7 @@
 from cython.parallel import prange
+from libc.stdint cimport uintptr_t
 from libc.stdlib cimport malloc, free
+import numpy as np
 from sb.transform_base cimport TransformBase
 
 
@@ -19,105 +21,134 @@ cdef struct RectTransformModel:
     int x_is_set, y_is_set
 
 
+# Same layout as RectTransformModel
+MODEL_DTYPE = np.dtype([
+    ('x_delta', 'f4'), ('y_delta', 'f4'), ('width', 'f4'), ('height', 'f4'),
+    ('x_anchor', 'f4'), ('y_anchor', 'f4'), ('x_pivot', 'f4'),
+    ('y_pivot', 'f4'), ('x', 'f4'), ('y', 'f4'),
+    ('x_is_set', 'i4'), ('y_is_set', 'i4')])
+assert MODEL_DTYPE.itemsize == sizeof(RectTransformModel)
+
+
 cdef class RectTransform(TransformBase):
     cdef RectTransformModel _model
+    # Points at _model, or at this transform's row of a TransformPool
+    cdef RectTransformModel* _m
+    cdef public object _pool
+    cdef public int _slot
     def __init__(self, _object, *args, **kwargs):
         super(RectTransform, self).__init__(_object, *args, **kwargs)
-        self._model.x_delta = kwargs.get('x_delta', 0)
-        self._model.y_delta = kwargs.get('y_delta', 0)
-        self._model.width = kwargs.get('width', 100)
-        self._model.height = kwargs.get('height', 100)
-        self._model.x_anchor = kwargs.get('x_anchor', 0.0)
-        self._model.y_anchor = kwargs.get('y_anchor', 0.0)
-        self._model.x_pivot = kwargs.get('x_pivot', 0.5)
-        self._model.y_pivot = kwargs.get('y_pivot', 0.5)
-        self._model.x = 0
-        self._model.y = 0
-        self._model.x_is_set = 0
-        self._model.y_is_set = 0
+        self._m = &self._model
+        self._pool = None
+        self._slot = -1
+        self._m.x_delta = kwargs.get('x_delta', 0)
+        self._m.y_delta = kwargs.get('y_delta', 0)
+        self._m.width = kwargs.get('width', 100)
+        self._m.height = kwargs.get('height', 100)
+        self._m.x_anchor = kwargs.get('x_anchor', 0.0)
+        self._m.y_anchor = kwargs.get('y_anchor', 0.0)
+        self._m.x_pivot = kwargs.get('x_pivot', 0.5)
+        self._m.y_pivot = kwargs.get('y_pivot', 0.5)
+        self._m.x = 0
+        self._m.y = 0
+        self._m.x_is_set = 0
+        self._m.y_is_set = 0
 
     def _clear_x(self):
-        self._model.x_is_set = 0
+        self._m.x_is_set = 0
         for child in self._children:
             child._clear_x()
 
     def _clear_y(self):
-        self._model.y_is_set = 0
+        self._m.y_is_set = 0
         for child in self._children:
             child._clear_y()
 
     def _clear_xy(self):
-        self._model.x_is_set = 0
-        self._model.y_is_set = 0
+        self._m.x_is_set = 0
+        self._m.y_is_set = 0
         for child in self._children:
             child._clear_xy()
 
     def _clear_model(self):
         self._clear_xy()
 
+    def _mark_dirty(self):
+        if self._pool is not None:
+            self._pool.n_writes += 1
+        TransformBase._mark_dirty(self)
+
     @property
-    def x_delta(self): return self._model.x_delta
+    def x_delta(self): return self._m.x_delta
 
     @x_delta.setter
     def x_delta(self, value):
-        self._model.x_delta = value
+        self._m.x_delta = value
         self._clear_x()
+        self._mark_dirty()
 
     @property
-    def y_delta(self): return self._model.y_delta
+    def y_delta(self): return self._m.y_delta
 
     @y_delta.setter
     def y_delta(self, value):
-        self._model.y_delta = value
+        self._m.y_delta = value
         self._clear_y()
+        self._mark_dirty()
 
     @property
-    def width(self): return self._model.width
+    def width(self): return self._m.width
 
     @width.setter
     def width(self, value):
-        self._model.width = value
+        self._m.width = value
         self._clear_x()
+        self._mark_dirty()
 
     @property
-    def height(self): return self._model.height
+    def height(self): return self._m.height
 
     @height.setter
     def height(self, value):
-        self._model.height = value
+        self._m.height = value
         self._clear_y()
+        self._mark_dirty()
 
     @property
-    def x_anchor(self): return self._model.x_anchor
+    def x_anchor(self): return self._m.x_anchor
 
     @x_anchor.setter
     def x_anchor(self, value):
-        self._model.x_anchor = value
+        self._m.x_anchor = value
         self._clear_x()
+        self._mark_dirty()
 
     @property
-    def y_anchor(self): return self._model.y_anchor
+    def y_anchor(self): return self._m.y_anchor
 
     @y_anchor.setter
     def y_anchor(self, value):
-        self._model.y_anchor = value
+        self._m.y_anchor = value
         self._clear_y()
+        self._mark_dirty()
 
     @property
-    def x_pivot(self): return self._model.x_pivot
+    def x_pivot(self): return self._m.x_pivot
 
     @x_pivot.setter
     def x_pivot(self, value):
-        self._model.x_pivot = value
+        self._m.x_pivot = value
         self._clear_x()
+        self._mark_dirty()
 
     @property
-    def y_pivot(self): return self._model.y_pivot
+    def y_pivot(self): return self._m.y_pivot
 
     @y_pivot.setter
     def y_pivot(self, value):
-        self._model.y_pivot = value
+        self._m.y_pivot = value
         self._clear_y()
+        self._mark_dirty()
 
     @property
     def _parent_x(self):
@@ -137,65 +168,84 @@ cdef class RectTransform(TransformBase):
 
     @property
     def x(self):
-        if not self._model.x_is_set:
-            self._model.x = calculate_dimension(
+        if not self._m.x_is_set:
+            self._m.x = calculate_dimension(
                 self._parent_x,
                 self._parent_width,
-                self._model.x_anchor,
-                self._model.x_pivot,
-                self._model.width,
-                self._model.x_delta)
-            self._model.x_is_set = 1
-            return self._model.x
+                self._m.x_anchor,
+                self._m.x_pivot,
+                self._m.width,
+                self._m.x_delta)
+            self._m.x_is_set = 1
+            return self._m.x
         else:
-            return self._model.x
+            return self._m.x
 
     @property
     def y(self):
-        if not self._model.y_is_set:
-            self._model.y = calculate_dimension(
+        if not self._m.y_is_set:
+            self._m.y = calculate_dimension(
                 self._parent_y,
                 self._parent_height,
-                self._model.y_anchor,
-                self._model.y_pivot,
-                self._model.height,
-                self._model.y_delta)
-            self._model.y_is_set = 1
-            return self._model.y
+                self._m.y_anchor,
+                self._m.y_pivot,
+                self._m.height,
+                self._m.y_delta)
+            self._m.y_is_set = 1
+            return self._m.y
         else:
-            return self._model.y
+            return self._m.y
 
 
 cdef inline RectTransformModel* get_transform_model_pointer(
         RectTransform transform):
-    return &transform._model
+    return transform._m
 
 
-cpdef void transform_model_calc(list transforms, int[:] lut):
+cpdef void transform_model_calc(list transforms, int[:] lut,
+                                int begin=0, int end=-1):
     '''
+    Lays out transforms[begin:end], whose parents are either in the range
+    or already laid out.
+
     :param transforms: must be a preorder traversal
+    :param lut: index of the parent of each transform, or -1
     '''
 
     cdef RectTransformModel** models
+    cdef RectTransformModel** parents
     cdef int n_models
     cdef RectTransformModel* model
     cdef RectTransformModel* parent
     cdef int parent_idx
     cdef int i
 
-    n_models = len(transforms)
+    if end < 0:
+        end = len(transforms)
+    n_models = end - begin
+    if n_models <= 0:
+        return
     models = <RectTransformModel**>malloc(
         n_models * sizeof(RectTransformModel*))
+    parents = <RectTransformModel**>malloc(
+        n_models * sizeof(RectTransformModel*))
 
     for i in range(n_models):
-        models[i] = get_transform_model_pointer(transforms[i])
+        models[i] = get_transform_model_pointer(transforms[begin + i])
+    for i in range(n_models):
+        parent_idx = lut[begin + i]
+        if parent_idx >= begin:
+            parents[i] = models[parent_idx - begin]
+        elif parent_idx >= 0:
+            parents[i] = get_transform_model_pointer(transforms[parent_idx])
+        else:
+            parents[i] = NULL
 
     with nogil:
         for i in range(n_models):
             model = models[i]
-            parent_idx = lut[i]
-            if parent_idx >= 0:
-                parent = models[parent_idx]
+            parent = parents[i]
+            if parent != NULL:
                 model.x = calculate_dimension(
                     parent.x,
                     parent.width,
@@ -228,3 +278,164 @@ cpdef void transform_model_calc(list transforms, int[:] lut):
             model.x_is_set = 1
             model.y_is_set = 1
     free(models)
+    free(parents)
+
+
+def get_transform_rects(list transforms):
+    '''
+    :return: (len(transforms), 4) float32 array of the x, y, width and
+        height of transforms as last laid out
+    '''
+    cdef int n = len(transforms)
+    cdef RectTransformModel* model
+    cdef int i
+    rects = np.empty((n, 4), dtype='float32')
+    cdef float[:, ::1] out = rects
+    for i in range(n):
+        model = get_transform_model_pointer(transforms[i])
+        out[i, 0] = model.x
+        out[i, 1] = model.y
+        out[i, 2] = model.width
+        out[i, 3] = model.height
+    return rects
+
+
+cdef class TransformPool:
+    '''
+    Stores the models of many RectTransforms in one contiguous structured
+    array with the fields of MODEL_DTYPE, so they can be read and written
+    as NumPy columns. A pooled transform keeps its slot until removed, and
+    freed slots are reused.
+
+    Pooled transforms are laid out by calc() as leaves of a single parent,
+    they are not among its children and transform_model_calc skips them.
+    n_writes counts the changes to the pool, it is unchanged as long as
+    calc() gives the same result for the same parent.
+    '''
+    cdef public object models
+    cdef public object active
+    cdef public list transforms
+    cdef public list free_slots
+    cdef public int n_slots
+    cdef public int n_writes
+
+    def __init__(self, capacity=1024):
+        self.models = np.zeros(capacity, dtype=MODEL_DTYPE)
+        self.active = np.zeros(capacity, dtype=bool)
+        self.transforms = [None] * capacity
+        self.free_slots = []
+        self.n_slots = 0
+        self.n_writes = 0
+
+    def __len__(self):
+        return self.n_slots - len(self.free_slots)
+
+    cdef RectTransformModel* _base(self):
+        return <RectTransformModel*><uintptr_t>self.models.ctypes.data
+
+    def _grow(self, int capacity):
+        cdef RectTransformModel* base
+        cdef RectTransform transform
+        models = np.zeros(capacity, dtype=MODEL_DTYPE)
+        models[:self.n_slots] = self.models[:self.n_slots]
+        active = np.zeros(capacity, dtype=bool)
+        active[:self.n_slots] = self.active[:self.n_slots]
+        self.models = models
+        self.active = active
+        self.transforms.extend([None] * (capacity - len(self.transforms)))
+        # Point the pooled transforms at the new rows
+        base = self._base()
+        for slot in range(self.n_slots):
+            if self.transforms[slot] is not None:
+                transform = self.transforms[slot]
+                transform._m = &base[slot]
+
+    def add(self, RectTransform transform):
+        '''
+        Moves the model of transform into the pool.
+
+        :return: slot of the transform
+        '''
+        cdef RectTransformModel* base
+        cdef int slot
+        if transform._pool is not None:
+            raise ValueError("Transform is already pooled")
+        if self.free_slots:
+            slot = self.free_slots.pop()
+        else:
+            if self.n_slots == len(self.models):
+                self._grow(max(1024, len(self.models) * 3 // 2))
+            slot = self.n_slots
+            self.n_slots += 1
+        base = self._base()
+        base[slot] = transform._m[0]
+        transform._m = &base[slot]
+        transform._pool = self
+        transform._slot = slot
+        self.transforms[slot] = transform
+        self.active[slot] = True
+        self.n_writes += 1
+        return slot
+
+    def remove(self, RectTransform transform):
+        '''
+        Moves the model of transform back into the transform.
+        '''
+        cdef int slot = transform._slot
+        if transform._pool is not self:
+            raise ValueError("Transform is not in this pool")
+        transform._model = transform._m[0]
+        transform._m = &transform._model
+        transform._pool = None
+        transform._slot = -1
+        self.transforms[slot] = None
+        self.active[slot] = False
+        self.free_slots.append(slot)
+        self.n_writes += 1
+
+    def set_anchors(self, slots, anchors):
+        '''
+        Vectorized counterpart of setting x_anchor and y_anchor. Lazily
+        computed positions of the slots are invalidated; those of their
+        children are refreshed by the next layout pass.
+
+        :param anchors: (len(slots), 2) array
+        '''
+        anchors = np.asarray(anchors, dtype='float32').reshape(-1, 2)
+        models = self.models
+        models['x_anchor'][slots] = anchors[:, 0]
+        models['y_anchor'][slots] = anchors[:, 1]
+        models['x_is_set'][slots] = 0
+        models['y_is_set'][slots] = 0
+        self.n_writes += 1
+
+    cpdef void calc(self, RectTransform parent):
+        '''
+        Lays out every slot relative to parent in one pass. The model of
+        parent must be up to date.
+        '''
+        cdef RectTransformModel* base = self._base()
+        cdef RectTransformModel* parent_model = parent._m
+        cdef RectTransformModel* model
+        cdef int n_slots = self.n_slots
+        cdef int i
+
+        with nogil:
+            for i in range(n_slots):
+                model = &base[i]
+                model.x = calculate_dimension(
+                    parent_model.x,
+                    parent_model.width,
+                    model.x_anchor,
+                    model.x_pivot,
+                    model.width,
+                    model.x_delta)
+                model.y = calculate_dimension(
+                    parent_model.y,
+                    parent_model.height,
+                    model.y_anchor,
+                    model.y_pivot,
+                    model.width,
+                    model.y_delta)
+                model.x_is_set = 1
+                model.y_is_set = 1
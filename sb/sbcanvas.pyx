@@ -1,9 +1,13 @@
 from kivy.uix.widget import Widget
 import numpy as np
 
-from sb.sbobject import SBObject
+from sb import metrics
+from sb.component_registry import ComponentRegistry
 from sb.drawable import Drawable
-from sb.recttransform import transform_model_calc
+from sb.sbobject import SBObject
+from sb.recttransform import get_transform_rects, transform_model_calc
+from sb.spatial import SpatialGrid
+from sb.transform_base import TransformHierarchy, walk_transforms
 
 
 class SBCanvas(Widget):
@@ -11,69 +15,218 @@ class SBCanvas(Widget):
         super(SBCanvas, self).__init__(*args, **kwargs)
         self._root_object = SBObject()
         self._root_transform = self._root_object.transform
+        self.hierarchy = TransformHierarchy(self._root_transform)
         self._active_drawables = set()
+        self._hidden_drawables = set()
+        self._batches = []
+        # Optional TransformPool for leaf transforms under the root
+        self.transform_pool = None
+        # Pooled transforms if there is a pool, otherwise the hierarchy
+        self.spatial_index = SpatialGrid()
+        self._indexed_transforms = []
+        self._index_stale = True
+        # n_writes of the pool as of the last layout
+        self._pool_writes = -1
+        # (x0, y0, x1, y1) in canvas coordinates, None draws everything
+        self.viewport = None
+        self.registry = ComponentRegistry()
+        self._root_object.registry = self.registry
 
     def get_root_transforms(self):
         return self._root_transform.children
 
+    def _register(self, xform):
+        for xf in walk_transforms(xform):
+            xf.get_object().registry = self.registry
+
     def add_root_transform(self, xform):
+        # Setting the parent registers the components of the subtree
         xform.parent = self._root_transform
 
+    def add_root_transforms(self, xforms):
+        hierarchy = self.hierarchy
+        hierarchy.defer_inserts()
+        try:
+            for xform in xforms:
+                xform.parent = self._root_transform
+        finally:
+            hierarchy.insert_deferred()
+
+    def add_pooled_transforms(self, xforms):
+        '''
+        Adds leaf transforms under the root whose models live in the
+        transform pool. They are laid out by the pool, not through the
+        children of the root.
+        '''
+        for xform in xforms:
+            xform._parent = self._root_transform
+            self.transform_pool.add(xform)
+            self._register(xform)
+
+    def add_batch(self, batch):
+        batch.attach(self.canvas)
+        self._batches.append(batch)
+
     def find_components(self, component_type):
-        for xf in self._root_transform.descendants:
-            yield from xf.get_object().get_components(component_type)
-
-    def _get_mst_set(self, transforms):
-        visited = set()
-        for xf in transforms:
-            t = xf
-            while t and t not in visited:
-                visited.add(t)
-                t = t.parent
-        return visited
+        return self.registry.get_components(component_type)
+
+    def _remove_destroyed(self):
+        # Removed from the hierarchy in one pass, then detached
+        removed = []
+        for _object in self.registry.take_destroyed_objects():
+            xform = _object.transform
+            # Already removed
+            if xform.parent is None:
+                continue
+            self._index_stale = True
+            for xf in walk_transforms(xform):
+                xf.get_object().registry = None
+            if xform._pool is not None:
+                xform._pool.remove(xform)
+                xform._parent = None
+                continue
+            removed.append(xform)
+        if not removed:
+            return
+        self.hierarchy.remove_many(removed)
+        by_parent = {}
+        for xform in removed:
+            by_parent.setdefault(xform._parent, set()).add(xform)
+        for parent, children in by_parent.items():
+            parent._children = [c for c in parent._children
+                                if c not in children]
+            parent._clear_ancestor_descendants()
+        for xform in removed:
+            xform._clear_descendants()
+            xform._parent = None
+
+    def _update_drawables(self):
+        pending = self.registry.take_pending_drawables()
+        for drawable, add in pending.items():
+            if add:
+                if drawable not in self._active_drawables and \
+                        drawable not in self._hidden_drawables:
+                    drawable._add_to_canvas(self.canvas)
+                    self._active_drawables.add(drawable)
+            elif drawable in self._active_drawables:
+                drawable._remove_from_canvas(self.canvas)
+                self._active_drawables.remove(drawable)
+            elif drawable in self._hidden_drawables:
+                drawable._remove_hidden(self.canvas)
+                self._hidden_drawables.remove(drawable)
+
+    def _refresh_index(self):
+        if not self._index_stale:
+            return
+        pool = self.transform_pool
+        if pool is not None:
+            n = pool.n_slots
+            models = pool.models[:n]
+            rects = np.stack([models['x'], models['y'], models['width'],
+                              models['height']], axis=1)
+            valid = pool.active[:n]
+            self._indexed_transforms = pool.transforms[:n]
+        else:
+            transforms = self.hierarchy.transforms
+            rects = get_transform_rects(transforms)
+            # Not the root
+            valid = np.arange(len(transforms)) > 0
+            self._indexed_transforms = list(transforms)
+        self.spatial_index.update(rects, valid)
+        self._index_stale = False
+
+    def _is_indexed(self, xform):
+        if self.transform_pool is not None:
+            return xform._pool is self.transform_pool
+        return xform._hierarchy is self.hierarchy
+
+    def query_rect(self, x0, y0, x1, y1):
+        '''
+        :return: transforms overlapping the rectangle, in canvas
+            coordinates
+        '''
+        self._refresh_index()
+        transforms = self._indexed_transforms
+        return [transforms[i]
+                for i in self.spatial_index.query_rect(x0, y0, x1, y1)]
+
+    def query_point(self, x, y):
+        return self.query_rect(x, y, x, y)
+
+    def pick(self, x, y):
+        '''
+        :return: the topmost transform at (x, y), or None
+        '''
+        transforms = self.query_point(x, y)
+        return transforms[-1] if transforms else None
+
+    def set_viewport_from_window(self, x0, y0, x1, y1):
+        '''
+        Sets the viewport from a rectangle in window coordinates, such as
+        the bounds of the view showing this canvas.
+        '''
+        ax, ay = self.to_widget(x0, y0)
+        bx, by = self.to_widget(x1, y1)
+        self.viewport = (min(ax, bx), min(ay, by), max(ax, bx), max(ay, by))
+
+    def _cull(self):
+        if self.viewport is None:
+            for drawable in self._hidden_drawables:
+                drawable._show(self.canvas)
+            self._active_drawables |= self._hidden_drawables
+            self._hidden_drawables = set()
+            return
+        visible = set()
+        for xform in self.query_rect(*self.viewport):
+            visible.update(xform.get_object().get_components(Drawable))
+        for drawable in visible & self._hidden_drawables:
+            drawable._show(self.canvas)
+            self._hidden_drawables.remove(drawable)
+            self._active_drawables.add(drawable)
+        hidden = [d for d in self._active_drawables
+                  if d not in visible and self._is_indexed(d.transform)]
+        for drawable in hidden:
+            drawable._hide(self.canvas)
+            self._active_drawables.remove(drawable)
+            self._hidden_drawables.add(drawable)
 
     def update(self, dt):
-        self._root_transform.width = self.width
-        self._root_transform.height = self.height
-
-        transforms = self._root_transform.descendants
-
-        lut = self._root_transform.descendant_hierarchy
-        data = np.empty((len(transforms), 2), dtype='float32')
-        transform_model_calc(transforms, lut)
-
-
-        all_removed = set()
-        removal = list()
-        removal_parents = list()
-
-        for xf in transforms:
-            _object = xf.get_object()
-            if not xf.parent in all_removed:
-                drawables = _object.get_components(Drawable)
-                if _object.alive:
-                    for drawable in drawables:
-                        if drawable not in self._active_drawables:
-                            drawable._add_to_canvas(self.canvas)
-                            self._active_drawables.add(drawable)
-                    _object.update_components(dt)
-                else:
-                    removal.append(xf)
-                    removal_parents.append(xf.parent)
-                    all_removed.add(xf)
-                    for drawable in drawables:
-                        if drawable in self._active_drawables:
-                            drawable._remove_from_canvas(self.canvas)
-                            self._active_drawables.remove(drawable)
-            else:
-                all_removed.add(xf)
-
-        clear = self._get_mst_set(removal_parents)
-
-        for xf in clear:
-            xf._clear_descendants()
-
-        for xf in removal:
-            xf._parent._children.remove(xf)
-            xf._clear_descendants()
-            xf._parent = None
\ No newline at end of file
+        root = self._root_transform
+        # Resizing the root makes the whole tree dirty
+        if root.width != np.float32(self.width):
+            root.width = self.width
+        if root.height != np.float32(self.height):
+            root.height = self.height
+
+        self._remove_destroyed()
+
+        # Only the subtrees of transforms that changed are laid out, and
+        # the pool only if it or the root changed
+        with metrics.span('transform_calc'):
+            hierarchy = self.hierarchy
+            changed = False
+            for begin, end in hierarchy.take_dirty_ranges():
+                transform_model_calc(hierarchy.transforms, hierarchy.lut,
+                                     begin, end)
+                changed = True
+            pool = self.transform_pool
+            if pool is not None and (
+                    changed or pool.n_writes != self._pool_writes):
+                pool.calc(self._root_transform)
+                self._pool_writes = pool.n_writes
+                changed = True
+        if changed:
+            self._index_stale = True
+
+        self._update_drawables()
+        self._cull()
+        # Only components that override update, and drawables in view
+        for component in self.registry.updatable:
+            component.update(dt)
+        updatable_drawables = self.registry.updatable_drawables
+        for drawable in self._active_drawables:
+            if drawable in updatable_drawables:
+                drawable.update(dt)
+
+        for batch in self._batches:
+            batch.update(dt)
@@ -1,20 +1,30 @@
 import numpy as np
 import time
 from kivy.clock import Clock
+from sb import metrics
 from sb.animation import PointRelaxer
+from sb.recttransform import TransformPool
 from sb.sbcanvas import SBCanvas
 from sb.sbobject import SBObject
+from sb.shared_arrays import grow_capacity
 
 
 class SBController:
     def __init__(self, sb_canvas, *args, **kwargs):
         self._sb_canvas = sb_canvas
-
-        # Anchors
-        self._target_anchors = None
-        self._prior_anchors = None
+        # Node transforms in one TransformPool, anchors set in one go
+        if kwargs.get('use_transform_pool', True):
+            sb_canvas.transform_pool = TransformPool()
+        self._transform_pool = sb_canvas.transform_pool
+
+        # Anchors, row i belongs to self._xforms[i]
+        self._n_nodes = 0
+        self._target_buffer = np.zeros((0, 2), dtype='float32')
+        self._prior_buffer = np.zeros((0, 2), dtype='float32')
+        self._slot_buffer = np.zeros(0, dtype='intp')
+        self._xforms = []
+        self._node_anchors = {}
         self._point_relaxer = PointRelaxer()
-        self._node_anchors = None
 
         # Debugging
         self._update_time_accumulator = 0
@@ -30,7 +40,11 @@ class SBController:
     @pr_alpha.setter
     def pr_alpha(self, value):
         with self._point_relaxer.alpha.get_lock():
+            prior = self._point_relaxer.alpha.value
             self._point_relaxer.alpha.value = value
+            changed = self._point_relaxer.alpha.value != prior
+        if changed:
+            self._point_relaxer.wake()
 
     @property
     def pr_beta(self):
@@ -39,103 +53,165 @@ class SBController:
     @pr_beta.setter
     def pr_beta(self, value):
         with self._point_relaxer.beta.get_lock():
+            prior = self._point_relaxer.beta.value
             self._point_relaxer.beta.value = value
+            changed = self._point_relaxer.beta.value != prior
+        if changed:
+            self._point_relaxer.wake()
+
+    @property
+    def layout_backend(self):
+        return self._point_relaxer.layout_backend
+
+    @layout_backend.setter
+    def layout_backend(self, name):
+        self._point_relaxer.layout_backend = name
 
     def _get_transform_anchors(self, xforms):
         anchors = [(t.x_anchor, t.y_anchor) for t in xforms]
         return np.array(anchors)
 
     def _set_transform_anchors(self, xforms, anchors):
+        if self._transform_pool is not None:
+            slots = self._slot_buffer[:self._n_nodes]
+            self._transform_pool.set_anchors(slots, anchors)
+            return
         for t, a in zip(xforms, anchors):
             t.x_anchor, t.y_anchor = a
 
-    def _validate_cached_anchors(self):
-        if self._target_anchors is None:
-            xforms = self._sb_canvas.get_root_transforms()
-            anchors = self._get_transform_anchors(xforms)
-            self._node_anchors = {id(xf.get_object()): i
-                                  for i, xf in enumerate(xforms)}
-            self._set_target_anchors(anchors)
-        elif self._prior_anchors is None:
-            self._prior_anchors = self._target_anchors.copy()
-
-    def _clear_cached_anchors(self):
-        self._target_anchors = None
-        self._prior_anchors = None
-        self._node_anchors = None
-
-    def _set_target_anchors(self, anchors):
-        anchors = np.array(anchors)
-        self._target_anchors = anchors
-        self._prior_anchors = anchors.copy()
-        self._point_relaxer.set_points(anchors)
+    @property
+    def _target_anchors(self):
+        return self._target_buffer[:self._n_nodes]
+
+    @property
+    def _prior_anchors(self):
+        return self._prior_buffer[:self._n_nodes]
+
+    def _reserve_anchors(self, n):
+        capacity = len(self._target_buffer)
+        if n <= capacity:
+            return
+        capacity = grow_capacity(capacity, n)
+        for name in ('_target_buffer', '_prior_buffer', '_slot_buffer'):
+            buffer = getattr(self, name)
+            grown = np.zeros((capacity,) + buffer.shape[1:], buffer.dtype)
+            grown[:self._n_nodes] = buffer[:self._n_nodes]
+            setattr(self, name, grown)
 
     def get_target_anchors(self):
-        self._validate_cached_anchors()
         return self._target_anchors
 
+    def get_root_transforms(self):
+        return list(self._xforms)
+
     def on_app_start(self):
         Clock.schedule_interval(self.update, 1/60)
         # Clock.schedule_interval(self.debug_info_update, 1)
-        self._point_relaxer.init_processes(16000)
+        self._point_relaxer.init_processes()
         self._point_relaxer.start_all()
-        self._validate_cached_anchors()
         self._point_relaxer.set_points(self._target_anchors)
 
     def on_app_stop(self):
         self._point_relaxer.stop_all()
 
     def set_node_target_anchor(self, node_id, anchor):
-        self._validate_cached_anchors()
-        node_anchor_index = self._node_anchors[node_id]
-        self._target_anchors[node_anchor_index] = anchor
-        self._point_relaxer.set_points(self._target_anchors)
+        self.set_node_target_anchors([node_id], [anchor])
 
     def set_node_target_anchors(self, node_ids, anchors):
-        self._validate_cached_anchors()
-        for node_id, anchor in zip(node_ids, anchors):
-            node_anchor_index = self._node_anchors[node_id]
-            self._target_anchors[node_anchor_index] = anchor
-        self._point_relaxer.set_points(self._target_anchors)
+        indices = [self._node_anchors[node_id] for node_id in node_ids]
+        self._target_anchors[indices] = anchors
+        self._point_relaxer.update_points(indices, anchors)
 
     def add_node(self):
+        return self.add_nodes(1)[0]
+
+    def add_nodes(self, n):
+        '''
+        Creates n nodes at once. Their anchors are appended to the anchor
+        arrays and sent to the point relaxer as one sparse update.
+
+        :return: list of the new SBObjects, id() of each is its node id
+        '''
         assert(isinstance(self._sb_canvas, SBCanvas))
-        # Create object
-        _object = SBObject()
-        self._sb_canvas.add_root_transform(_object.transform)
-        self._clear_cached_anchors()
-        return _object
+        objects = [SBObject() for _ in range(n)]
+        xforms = [o.transform for o in objects]
+        begin = self._n_nodes
+        end = begin + n
+        self._reserve_anchors(end)
+        if self._transform_pool is not None:
+            self._sb_canvas.add_pooled_transforms(xforms)
+            self._slot_buffer[begin:end] = [xf._slot for xf in xforms]
+        else:
+            self._sb_canvas.add_root_transforms(xforms)
+        anchors = self._get_transform_anchors(xforms).reshape(-1, 2)
+        self._target_buffer[begin:end] = anchors
+        self._prior_buffer[begin:end] = anchors
+        for i, o in enumerate(objects, begin):
+            self._node_anchors[id(o)] = i
+        self._xforms.extend(xforms)
+        self._n_nodes = end
+        self._point_relaxer.update_points(
+            range(begin, end), self._target_anchors[begin:end], length=end)
+        return objects
+
+    def remove_node(self, node_id):
+        self.remove_nodes([node_id])
+
+    def remove_nodes(self, node_ids):
+        '''
+        Destroys the nodes. The last nodes are moved into the freed rows,
+        so only the moved rows are sent to the point relaxer.
+        '''
+        indices = sorted((self._node_anchors.pop(node_id)
+                          for node_id in node_ids), reverse=True)
+        n = self._n_nodes
+        moved = []
+        for i in indices:
+            self._xforms[i].destroy()
+            last = n - 1
+            if i != last:
+                xf = self._xforms[last]
+                self._xforms[i] = xf
+                self._target_buffer[i] = self._target_buffer[last]
+                self._prior_buffer[i] = self._prior_buffer[last]
+                self._slot_buffer[i] = self._slot_buffer[last]
+                self._node_anchors[id(xf.get_object())] = i
+                moved.append(i)
+            n = last
+        del self._xforms[n:]
+        self._n_nodes = n
+        moved = [i for i in moved if i < n]
+        self._point_relaxer.update_points(
+            moved, self._target_anchors[moved], length=n)
 
     def clear_nodes(self):
-        for xf in self._sb_canvas.get_root_transforms():
+        for xf in self._xforms:
             xf.destroy()
-        self._clear_cached_anchors()
-
-    def remove_node(self):
-        print('todo')
-        pass
+        self._xforms = []
+        self._node_anchors = {}
+        self._n_nodes = 0
+        self._point_relaxer.set_points(self._target_anchors)
 
     def update(self, dt):
         begin_t = time.process_time()
 
-        self._validate_cached_anchors()
         points = self._point_relaxer.get_points()
-        if points:
-            self._target_anchors = points
+        # The relaxer may lag behind nodes that were just added or removed
+        if points is not None and len(points) == self._n_nodes:
+            self._target_anchors[:] = points
             a = self._prior_anchors
             b = self._target_anchors
-            self._prior_anchors = a + (b - a) * min(2 * dt, 1)
+            a += (b - a) * min(2 * dt, 1)
 
         self._update_anchors_accumulator += time.process_time() - begin_t
 
         xform_t = time.process_time()
-        xforms = self._sb_canvas.get_root_transforms()
-        anchors = self._prior_anchors
-        self._set_transform_anchors(xforms, anchors)
+        self._set_transform_anchors(self._xforms, self._prior_anchors)
         self._update_transforms_accumulator += time.process_time() - xform_t
 
         sb_canvas_t = time.process_time()
-        self._sb_canvas.update(dt)
+        with metrics.span('canvas_update'):
+            self._sb_canvas.update(dt)
         self._update_sb_canvas_accumulator += time.process_time() - sb_canvas_t
 
         self._update_time_accumulator += time.process_time() - begin_t
@@ -157,6 +233,10 @@ class SBController:
             print(f'{"transforms":<20s} {average_xform_time:<0.6f}')
             print(f'{"sb canvas":<20s} {average_sb_canvas_time:<0.6f}')
             print(f'{"all":<20s} {average_update_time:<0.6f}')
+            tri_rate, relax_rate = self._point_relaxer.sample_rates()
+            print(f'Relaxation (per second):')
+            print(f'{"triangulations":<20s} {tri_rate:<0.2f}')
+            print(f'{"relax steps":<20s} {relax_rate:<0.2f}')
             self._update_anchors_accumulator = 0
             self._update_transforms_accumulator = 0
             self._update_sb_canvas_accumulator = 0
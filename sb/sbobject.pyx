@@ -1,3 +1,4 @@
+from sb.component_registry import needs_update
 from sb.recttransform import RectTransform
 
 
@@ -6,6 +7,9 @@ class SBObject:
         # TODO: different transform types?
         self._transform = RectTransform(self)
         self._components = []
+        # Query type -> matching components, rebuilt after any change
+        self._type_index = {}
+        self._registry = None
         self._alive = True
 
     @property
@@ -16,28 +20,58 @@ class SBObject:
     def transform(self):
         return self._transform
 
+    @property
+    def registry(self):
+        return self._registry
+
+    @registry.setter
+    def registry(self, registry):
+        if registry is self._registry:
+            return
+        if self._registry is not None:
+            for component in self._components:
+                self._registry.remove(component)
+        self._registry = registry
+        if registry is not None:
+            for component in self._components:
+                registry.add(component)
+
     def add_component(self, component_type):
         component = component_type(self)
         self._components.append(component)
+        self._type_index.clear()
+        if self._registry is not None:
+            self._registry.add(component)
         return component
 
+    def _get_matching(self, component_type):
+        match = self._type_index.get(component_type)
+        if match is None:
+            match = [c for c in self._components
+                     if issubclass(type(c), component_type)]
+            self._type_index[component_type] = match
+        return match
+
     def get_component(self, component_type):
-        match = [c for c in self._components
-                 if issubclass(type(c), component_type)]
+        match = self._get_matching(component_type)
         return match[0] if match else None
 
     def get_components(self, component_type):
-        match = [c for c in self._components
-                 if issubclass(type(c), component_type)]
-        return match
+        return list(self._get_matching(component_type))
 
     def remove_component(self, component):
         self._components.remove(component)
+        self._type_index.clear()
+        if self._registry is not None:
+            self._registry.remove(component)
 
     def update_components(self, dt):
         for component in self._components:
-            component.update(dt)
+            if needs_update(type(component)):
+                component.update(dt)
 
     def destroy(self):
         # Mark for removal
-        self._alive = False
\ No newline at end of file
+        self._alive = False
+        if self._registry is not None:
+            self._registry.object_destroyed(self)
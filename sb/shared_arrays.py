@@ -0,0 +1,257 @@
+from multiprocessing import Lock, Queue, shared_memory
+from queue import Empty
+
+import numpy as np
+
+
+def attach_shared_array(name, shape, dtype):
+    return SharedArray(shape, dtype, name=name, create=False)
+
+
+def _sub_name(name, suffix):
+    return name + suffix if name else None
+
+
+def grow_capacity(capacity, required, factor=1.5, minimum=1024):
+    '''
+    :return: a capacity of at least required, growing geometrically so
+        that repeated growth stays amortized O(1) per item
+    '''
+    if required <= capacity:
+        return capacity
+    return max(required, int(capacity * factor), minimum)
+
+
+class SharedArray:
+    '''
+    NumPy array backed by a named shared memory block. Pickling only sends
+    the name, so an instance can be handed to any process, which then maps
+    the same memory.
+    '''
+    def __init__(self, shape, dtype, name=None, create=True):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        size = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+        self._shm = shared_memory.SharedMemory(
+            name=name, create=create, size=size)
+        self._owner = create
+        self.array = np.ndarray(
+            self.shape, dtype=self.dtype, buffer=self._shm.buf)
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def __reduce__(self):
+        return attach_shared_array, (self.name, self.shape, self.dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def close(self):
+        self.array = None
+        self._shm.close()
+
+    def unlink(self):
+        if self._owner:
+            self._shm.unlink()
+
+    def release(self):
+        self.close()
+        self.unlink()
+
+
+class DoubleBuffer:
+    '''
+    Single writer, multiple reader handoff of variable-length arrays.
+
+    The writer fills the back slot and then bumps the epoch, which flips it
+    to the front. Readers copy the front slot and retry if the epoch moved
+    while they were copying (seqlock).
+    '''
+    def __init__(self, capacity, item_shape=(), dtype='float32', name=None,
+                 create=True):
+        self.capacity = capacity
+        self.slots = SharedArray(
+            (2, capacity) + tuple(item_shape), dtype,
+            _sub_name(name, 's'), create)
+        # epoch, slot 0 length, slot 1 length
+        self.header = SharedArray((3,), 'int64', _sub_name(name, 'h'), create)
+        if create:
+            self.header.array[:] = 0
+
+    @property
+    def epoch(self):
+        return int(self.header.array[0])
+
+    def publish(self, array):
+        header = self.header.array
+        epoch = int(header[0])
+        slot = (epoch + 1) % 2
+        n = len(array)
+        self.slots.array[slot, :n] = array
+        header[1 + slot] = n
+        header[0] = epoch + 1
+
+    def read(self, last_epoch=None):
+        '''
+        :return: (copy of the front slot, epoch), or (None, epoch) if
+            nothing was published since last_epoch
+        '''
+        header = self.header.array
+        while True:
+            epoch = int(header[0])
+            if epoch == last_epoch or epoch == 0:
+                return None, epoch
+            slot = epoch % 2
+            n = int(header[1 + slot])
+            array = self.slots.array[slot, :n].copy()
+            if int(header[0]) == epoch:
+                return array, epoch
+
+    def copy_from(self, other):
+        n = min(self.capacity, other.capacity)
+        self.slots.array[:, :n] = other.slots.array[:, :n]
+        self.header.array[:] = other.header.array
+
+    def close(self):
+        self.slots.close()
+        self.header.close()
+
+    def release(self):
+        self.slots.release()
+        self.header.release()
+
+
+class SparseInbox:
+    '''
+    Multiple writer, single reader staging area for dense or sparse updates.
+    Writers mark the items they touched, the reader applies only those.
+    '''
+    def __init__(self, capacity, item_shape=(), dtype='float32', name=None,
+                 create=True, lock=None):
+        self.capacity = capacity
+        self.values = SharedArray(
+            (capacity,) + tuple(item_shape), dtype,
+            _sub_name(name, 'v'), create)
+        self.mask = SharedArray((capacity,), 'bool',
+                                _sub_name(name, 'm'), create)
+        # length, pending
+        self.header = SharedArray((2,), 'int64', _sub_name(name, 'h'), create)
+        if create:
+            self.mask.array[:] = False
+            self.header.array[:] = 0
+        self.lock = lock if lock is not None else Lock()
+
+    @property
+    def length(self):
+        return int(self.header.array[0])
+
+    def _set_length(self, n):
+        header = self.header.array
+        old_n = int(header[0])
+        if n < old_n:
+            self.mask.array[n:old_n] = False
+        header[0] = n
+        header[1] = 1
+
+    def write(self, array):
+        with self.lock:
+            n = len(array)
+            self.values.array[:n] = array
+            self.mask.array[:n] = True
+            self._set_length(n)
+
+    def write_sparse(self, indices, array, length=None):
+        with self.lock:
+            if length is not None:
+                self._set_length(length)
+            self.values.array[indices] = array
+            self.mask.array[indices] = True
+            self.header.array[1] = 1
+
+    def resize(self, n):
+        with self.lock:
+            self._set_length(n)
+
+    def take(self, out):
+        '''
+        Copies the pending items into out.
+
+        :return: the current length, or None if nothing is pending
+        '''
+        with self.lock:
+            header = self.header.array
+            if not header[1]:
+                return None
+            n = int(header[0])
+            indices = np.flatnonzero(self.mask.array[:n])
+            out[indices] = self.values.array[indices]
+            self.mask.array[indices] = False
+            header[1] = 0
+            return n
+
+    def copy_from(self, other):
+        n = min(self.capacity, other.capacity)
+        self.values.array[:n] = other.values.array[:n]
+        self.mask.array[:n] = other.mask.array[:n]
+        self.header.array[:] = other.header.array
+
+    def close(self):
+        self.values.close()
+        self.mask.close()
+        self.header.close()
+
+    def release(self):
+        self.values.release()
+        self.mask.release()
+        self.header.release()
+
+
+class SlotPool:
+    '''
+    Fixed set of shared memory slots for arrays of up to item_shape, whose
+    first two dimensions may be smaller. Writers acquire a free slot and
+    pass only its index on; the reader releases it once the data has been
+    consumed. Since acquire blocks while every slot is taken, the pool
+    bounds the data in flight.
+    '''
+    def __init__(self, n_slots, item_shape, dtype='uint8'):
+        self.n_slots = n_slots
+        self.slots = SharedArray((n_slots,) + tuple(item_shape), dtype)
+        self.shapes = SharedArray((n_slots, 2), 'int32')
+        self.free_slots = Queue()
+        for slot in range(n_slots):
+            self.free_slots.put(slot)
+
+    def acquire(self, timeout=None):
+        '''
+        :return: a free slot, or None if none became free within timeout
+        '''
+        try:
+            return self.free_slots.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def write(self, slot, array):
+        height, width = array.shape[:2]
+        self.slots.array[slot, :height, :width] = array
+        self.shapes.array[slot] = (height, width)
+
+    def read(self, slot):
+        '''
+        :return: view of the slot data, valid until the slot is released
+        '''
+        height, width = self.shapes.array[slot]
+        return self.slots.array[slot, :height, :width]
+
+    def release(self, slot):
+        self.free_slots.put(slot)
+
+    def close(self):
+        self.slots.close()
+        self.shapes.close()
+
+    def unlink(self):
+        self.slots.unlink()
+        self.shapes.unlink()
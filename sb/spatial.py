@@ -0,0 +1,127 @@
+import numpy as np
+
+# Cell key of items without a valid rectangle, sorts before every cell
+NO_CELL = np.iinfo('int64').min
+
+
+class SpatialGrid:
+    '''
+    Uniform grid over axis-aligned rectangles (x, y, width, height) for
+    rectangle and point queries. Items are the row indices of the
+    rectangles passed to update(). Each item is filed under the cell of its
+    center and queries are widened by the largest half extent, so cells of
+    about twice the typical rectangle size work best.
+
+    The cell table is a list of items sorted by cell. It is only rebuilt
+    when an item moved to another cell, otherwise an update just replaces
+    the rectangles.
+    '''
+    def __init__(self, cell_size=None):
+        '''
+        :param cell_size: None picks twice the median rectangle size on
+            every rebuild
+        '''
+        self.cell_size = cell_size
+        self.rects = np.zeros((0, 4), dtype='float32')
+        self.valid = np.zeros(0, dtype=bool)
+        self.n_rebuilds = 0
+        self._cell = 1.0
+        self._origin = np.zeros(2, dtype='float64')
+        self._n_cols = 1
+        self._row_range = (0, -1)
+        self._extent = np.zeros(2, dtype='float64')
+        self._cells = np.zeros(0, dtype='int64')
+        self._order = np.zeros(0, dtype='intp')
+        self._sorted_cells = np.zeros(0, dtype='int64')
+
+    def __len__(self):
+        return len(self.rects)
+
+    def _get_cells(self, rects, valid):
+        centers = rects[:, :2] + rects[:, 2:] / 2
+        cells = np.floor((centers - self._origin) / self._cell)
+        cells[~valid] = 0
+        cx = np.clip(cells[:, 0], 0, self._n_cols - 1).astype('int64')
+        cy = cells[:, 1].astype('int64')
+        keys = cy * self._n_cols + cx
+        keys[~valid] = NO_CELL
+        return keys
+
+    def _rebuild(self, rects, valid):
+        if valid.any():
+            sizes = rects[valid, 2:].max(axis=1)
+            cell = self.cell_size
+            if cell is None:
+                cell = 2 * float(np.median(sizes))
+            self._cell = max(cell, 1e-6)
+            centers = rects[valid, :2] + rects[valid, 2:] / 2
+            self._origin = centers.min(axis=0).astype('float64')
+            span = centers[:, 0].max() - self._origin[0]
+            self._n_cols = int(span // self._cell) + 1
+            rows = np.floor((centers[:, 1] - self._origin[1]) / self._cell)
+            self._row_range = (int(rows.min()), int(rows.max()))
+        else:
+            self._row_range = (0, -1)
+        self._cells = self._get_cells(rects, valid)
+        self._order = np.argsort(self._cells, kind='stable')
+        self._sorted_cells = self._cells[self._order]
+        self.n_rebuilds += 1
+
+    def update(self, rects, valid=None):
+        '''
+        :param rects: (n, 4) array of x, y, width, height
+        :param valid: optional (n,) bool array, False rows are never found
+        '''
+        rects = np.asarray(rects, dtype='float32').reshape(-1, 4)
+        finite = np.isfinite(rects).all(axis=1)
+        valid = finite if valid is None else finite & valid
+        self.rects = rects
+        self.valid = valid
+        if valid.any():
+            self._extent = np.abs(rects[valid, 2:]).max(axis=0) / 2
+        if len(rects) != len(self._cells):
+            self._rebuild(rects, valid)
+            return
+        cells = self._get_cells(rects, valid)
+        if np.any(cells != self._cells):
+            self._rebuild(rects, valid)
+
+    def _get_candidates(self, x0, y0, x1, y1):
+        ex, ey = self._extent
+        ox, oy = self._origin
+        cell = self._cell
+        # Items beyond the span of the last rebuild are filed under the
+        # first or last column, which must be searched for any query
+        # beyond it
+        last_col = self._n_cols - 1
+        col_0 = min(max(int(np.floor((x0 - ex - ox) / cell)), 0), last_col)
+        col_1 = max(min(int(np.floor((x1 + ex - ox) / cell)), last_col), 0)
+        row_0 = max(int(np.floor((y0 - ey - oy) / cell)), self._row_range[0])
+        row_1 = min(int(np.floor((y1 + ey - oy) / cell)), self._row_range[1])
+        if col_0 > col_1 or row_0 > row_1:
+            return np.zeros(0, dtype='intp')
+        # Cells of one row are contiguous in the sorted cell table
+        rows = np.arange(row_0, row_1 + 1, dtype='int64') * self._n_cols
+        begins = np.searchsorted(self._sorted_cells, rows + col_0, 'left')
+        ends = np.searchsorted(self._sorted_cells, rows + col_1, 'right')
+        return np.concatenate(
+            [self._order[b:e] for b, e in zip(begins, ends)])
+
+    def query_rect(self, x0, y0, x1, y1):
+        '''
+        :return: sorted indices of the rectangles overlapping the
+            rectangle from (x0, y0) to (x1, y1)
+        '''
+        if not self.valid.any():
+            return np.zeros(0, dtype='intp')
+        candidates = self._get_candidates(x0, y0, x1, y1)
+        r = self.rects[candidates]
+        overlapping = (r[:, 0] <= x1) & (r[:, 0] + r[:, 2] >= x0) & \
+                      (r[:, 1] <= y1) & (r[:, 1] + r[:, 3] >= y0)
+        return np.sort(candidates[overlapping])
+
+    def query_point(self, x, y):
+        '''
+        :return: sorted indices of the rectangles containing (x, y)
+        '''
+        return self.query_rect(x, y, x, y)
@@ -0,0 +1,207 @@
+import os
+import pathlib
+import sqlite3
+from collections import Counter
+
+import numpy as np
+from PIL import Image as PILImageM
+
+from sb.files import get_file_key
+
+
+def get_legacy_thumbnail_path(image_file_path, thumbnails_directory_path):
+    title = pathlib.PurePath(image_file_path).stem
+    return pathlib.Path(thumbnails_directory_path).joinpath(
+        'thumbnail-' + title + '.png')
+
+
+def get_rgb_array(img):
+    return np.asarray(img.convert('RGB'), dtype='uint8')
+
+
+class ThumbnailStore:
+    '''
+    Thumbnails packed into fixed-size uint8 slots of one memory-mapped file,
+    with an SQLite index keyed by source path. Thumbnails are returned as
+    views into the mapping, so reading them never copies.
+
+    Entries are keyed by (path, size, mtime in nanoseconds), see
+    sb.files.get_file_key. Any number of processes may read and append at
+    the same time; compact() must run while no other process is using the
+    store.
+    '''
+    def __init__(self, directory, slot_size=64, grow_slots=1024):
+        self.directory = pathlib.Path(directory)
+        self.slot_size = slot_size
+        self.grow_slots = grow_slots
+        self.data_path = self.directory.joinpath('thumbnails.bin')
+        self.index_path = self.directory.joinpath('thumbnails.sqlite')
+        self._connection = None
+        self._map = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        state['_map'] = None
+        return state
+
+    @property
+    def slot_shape(self):
+        return self.slot_size, self.slot_size, 3
+
+    @property
+    def slot_bytes(self):
+        return int(np.prod(self.slot_shape))
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            # Autocommit, transactions are explicit
+            connection = sqlite3.connect(
+                str(self.index_path), timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS thumbnails ('
+                'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+                'slot INTEGER, width INTEGER, height INTEGER)')
+            self.data_path.touch(exist_ok=True)
+            self._connection = connection
+        return self._connection
+
+    def _get_map(self, slot):
+        # Remap when another process has grown the file past our mapping
+        if self._map is None or slot >= self._map.shape[0]:
+            n_slots = os.path.getsize(self.data_path) // self.slot_bytes
+            if slot >= n_slots:
+                return None
+            self._map = np.memmap(self.data_path, dtype='uint8', mode='r+',
+                                  shape=(n_slots,) + self.slot_shape)
+        return self._map
+
+    def _reserve(self, slot):
+        n_slots = os.path.getsize(self.data_path) // self.slot_bytes
+        if slot >= n_slots:
+            n_slots = max(slot + 1, n_slots + self.grow_slots)
+            os.truncate(self.data_path, n_slots * self.slot_bytes)
+
+    def __len__(self):
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM thumbnails').fetchone()[0]
+
+    def get(self, file_key):
+        '''
+        :return: (height, width, 3) uint8 view of the thumbnail, or None
+        '''
+        path, size, mtime_ns = file_key
+        row = self.connection.execute(
+            'SELECT slot, width, height FROM thumbnails '
+            'WHERE path = ? AND size = ? AND mtime_ns = ?',
+            (path, size, mtime_ns)).fetchone()
+        if row is None:
+            return None
+        slot, width, height = row
+        thumbnails = self._get_map(slot)
+        if thumbnails is None:
+            return None
+        return thumbnails[slot, :height, :width]
+
+    def put(self, file_key, array):
+        '''
+        :param array: (height, width, 3) uint8 array no larger than a slot
+        :return: the slot the thumbnail was written to
+        '''
+        path, size, mtime_ns = file_key
+        height, width = array.shape[:2]
+        connection = self.connection
+        # The write lock serializes slot allocation across processes
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                'SELECT slot FROM thumbnails WHERE path = ?',
+                (path,)).fetchone()
+            if row is None:
+                row = connection.execute(
+                    'SELECT COALESCE(MAX(slot) + 1, 0) FROM thumbnails'
+                ).fetchone()
+            slot = row[0]
+            self._reserve(slot)
+            # Pixels are written before the index row becomes visible
+            thumbnails = self._get_map(slot)
+            thumbnails[slot] = 0
+            thumbnails[slot, :height, :width] = array
+            connection.execute(
+                'INSERT OR REPLACE INTO thumbnails VALUES (?, ?, ?, ?, ?, ?)',
+                (path, size, mtime_ns, slot, width, height))
+            connection.execute('COMMIT')
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        return slot
+
+    def remove(self, file_path):
+        # The slot is reclaimed by compact()
+        self.connection.execute(
+            'DELETE FROM thumbnails WHERE path = ?', (str(file_path),))
+
+    def compact(self):
+        '''
+        Moves all live thumbnails to the front of the file and truncates it.
+        '''
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = connection.execute(
+                'SELECT path, slot FROM thumbnails ORDER BY slot').fetchall()
+            thumbnails = self._get_map(rows[-1][1]) if rows else None
+            for new_slot, (path, slot) in enumerate(rows):
+                if new_slot != slot:
+                    thumbnails[new_slot] = thumbnails[slot]
+                    connection.execute(
+                        'UPDATE thumbnails SET slot = ? WHERE path = ?',
+                        (new_slot, path))
+            if thumbnails is not None:
+                thumbnails.flush()
+            self._map = None
+            del thumbnails
+            os.truncate(self.data_path, len(rows) * self.slot_bytes)
+            connection.execute('COMMIT')
+        except:
+            connection.execute('ROLLBACK')
+            raise
+
+    def migrate_png_directory(self, thumbnails_dir_path, image_paths):
+        '''
+        Imports thumbnail-<name>.png files written by get_thumbnail_image.
+        Names shared by several images are skipped, since it is unknown
+        which image such a thumbnail belongs to.
+
+        :return: number of imported thumbnails
+        '''
+        image_paths = [pathlib.Path(p) for p in image_paths]
+        stems = Counter(p.stem for p in image_paths)
+        n_imported = 0
+        for image_path in image_paths:
+            if stems[image_path.stem] > 1:
+                continue
+            png_path = get_legacy_thumbnail_path(
+                image_path, thumbnails_dir_path)
+            if not png_path.exists():
+                continue
+            try:
+                file_key = get_file_key(image_path)
+                if self.get(file_key) is not None:
+                    continue
+                with PILImageM.open(png_path) as img:
+                    img.thumbnail((self.slot_size, self.slot_size))
+                    array = get_rgb_array(img)
+            except Exception:
+                continue
+            self.put(file_key, array)
+            n_imported += 1
+        return n_imported
+
+    def close(self):
+        self._map = None
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
@@ -4,4 +4,7 @@ cdef class TransformBase(Component):
     cdef public object _parent
     cdef public list _children
     cdef public list _descendants
-    cdef public int[:] _descendant_hierarchy
\ No newline at end of file
+    cdef public int[:] _descendant_hierarchy
+    cdef public object _hierarchy
+    cdef public int _index
+    cdef public int _subtree_size
@@ -3,14 +3,222 @@ import numpy as np
 
 def walk_transforms(transform):
     yield transform
-    for t in transform.children:
+    for t in transform._children:
         yield from walk_transforms(t)
 
-def get_model_hierarchy(transform, index=0, parent_index=-1):
-        next_index = index + len(transform.children) + 1
-        yield transform, parent_index
-        for t in transform.children:
-            yield from get_model_hierarchy(t, next_index, index)
+def get_model_hierarchy(transform):
+    '''
+    :return: generator of (transform, index of its parent) in preorder,
+        the parent index of transform itself is -1
+    '''
+    stack = [(transform, -1)]
+    index = 0
+    while stack:
+        t, parent_index = stack.pop()
+        yield t, parent_index
+        for child in reversed(t._children):
+            stack.append((child, index))
+        index += 1
+
+
+class TransformHierarchy:
+    '''
+    Preorder of the transforms under root, with the preorder index of each
+    transform's parent, maintained incrementally as subtrees are attached
+    and detached. Every member knows its index and the size of its
+    subtree, so a subtree is the range [index, index + subtree size).
+
+    Transforms mark themselves dirty when their model changes, and
+    take_dirty_ranges() returns only the ranges that have to be laid out
+    again.
+    '''
+    def __init__(self, root, capacity=1024):
+        self.root = root
+        self.transforms = []
+        self.parents = np.empty(capacity, dtype='intc')
+        self.dirty = set()
+        self._invalid = True
+        # Transforms passed to insert() since defer_inserts(), or None
+        self._deferred = None
+        root._hierarchy = self
+
+    def __len__(self):
+        return len(self.transforms)
+
+    @property
+    def lut(self):
+        return self.parents[:len(self.transforms)]
+
+    def invalidate(self):
+        '''
+        Rebuilds the whole preorder on the next take_dirty_ranges().
+        '''
+        self._invalid = True
+
+    def _reserve(self, n, n_used):
+        if n > len(self.parents):
+            parents = np.empty(max(n, len(self.parents) * 3 // 2),
+                               dtype='intc')
+            parents[:n_used] = self.parents[:n_used]
+            self.parents = parents
+
+    def _index_subtree(self, transform, begin, parent_index):
+        items = list(get_model_hierarchy(transform))
+        transforms = [t for t, _ in items]
+        parents = np.array([p for _, p in items], dtype='intc') + begin
+        parents[0] = parent_index
+        for i, t in enumerate(transforms):
+            t._index = begin + i
+            t._subtree_size = 1
+            t._hierarchy = self
+        # Descendants come after their ancestors in preorder
+        for t in reversed(transforms[1:]):
+            t._parent._subtree_size += t._subtree_size
+        return transforms, parents
+
+    def rebuild(self):
+        transforms, parents = self._index_subtree(self.root, 0, -1)
+        self._reserve(len(transforms), 0)
+        self.transforms = transforms
+        self.parents[:len(transforms)] = parents
+        self.dirty = {self.root}
+        self._invalid = False
+
+    def insert(self, transform):
+        '''
+        Adds the subtree of transform, which was just appended to the
+        children of a member of this hierarchy.
+        '''
+        if self._invalid:
+            return
+        if self._deferred is not None:
+            self._deferred.append(transform)
+            return
+        self.insert_many([transform])
+
+    def insert_many(self, transforms):
+        '''
+        Adds the subtrees of transforms, which were just appended in order
+        to the children of the same member of this hierarchy, in one pass.
+        '''
+        if self._invalid or not transforms:
+            return
+        parent = transforms[0]._parent
+        begin = parent._index + parent._subtree_size
+        added = []
+        added_parents = []
+        for transform in transforms:
+            subtree, parents = self._index_subtree(
+                transform, begin + len(added), parent._index)
+            added.extend(subtree)
+            added_parents.append(parents)
+        k = len(added)
+        n = len(self.transforms)
+        self._reserve(n + k, n)
+        # Appending, e.g. under the root, moves nothing
+        if begin < n:
+            for i in range(begin, n):
+                self.transforms[i]._index += k
+            lut = self.parents[:n]
+            lut[lut >= begin] += k
+            self.parents[begin + k:n + k] = self.parents[begin:n]
+        self.parents[begin:begin + k] = np.concatenate(added_parents)
+        self.transforms[begin:begin] = added
+        for xf in parent.path():
+            xf._subtree_size += k
+        self.dirty.update(transforms)
+
+    def defer_inserts(self):
+        '''
+        Collects the transforms passed to insert() until insert_deferred()
+        adds them, a batch per parent.
+        '''
+        if self._deferred is None:
+            self._deferred = []
+
+    def insert_deferred(self):
+        deferred = self._deferred
+        self._deferred = None
+        if not deferred or self._invalid:
+            return
+        batch = []
+        for transform in dict.fromkeys(deferred):
+            parent = transform._parent
+            # Detached again in the meantime
+            if parent is None or parent._hierarchy is not self:
+                continue
+            if batch and parent is not batch[0]._parent:
+                self.insert_many(batch)
+                batch = []
+            batch.append(transform)
+        self.insert_many(batch)
+
+    def remove(self, transform):
+        '''
+        Drops the subtree of transform, which must still be attached to
+        its parent.
+        '''
+        self.remove_many([transform])
+
+    def remove_many(self, transforms):
+        '''
+        Drops the subtrees of transforms, which must still be attached to
+        their parents, and reindexes the rest in one pass.
+        '''
+        if self._invalid:
+            for transform in transforms:
+                for xf in walk_transforms(transform):
+                    xf._hierarchy = None
+            return
+        n = len(self.transforms)
+        keep = np.ones(n, dtype=bool)
+        first = n
+        end = 0
+        for transform in sorted(
+                [t for t in transforms if t._hierarchy is self],
+                key=lambda t: t._index):
+            begin = transform._index
+            # Within a subtree that is already dropped
+            if begin < end:
+                continue
+            k = transform._subtree_size
+            end = begin + k
+            first = min(first, begin)
+            keep[begin:end] = False
+            for xf in self.transforms[begin:end]:
+                xf._hierarchy = None
+                xf._index = -1
+            for xf in transform._parent.path():
+                xf._subtree_size -= k
+        if first == n:
+            return
+        new_index = np.cumsum(keep, dtype='intc') - 1
+        lut = self.parents[:n][keep]
+        has_parent = lut >= 0
+        lut[has_parent] = new_index[lut[has_parent]]
+        self.transforms = [xf for xf, kept in
+                           zip(self.transforms, keep.tolist()) if kept]
+        self.parents[:len(lut)] = lut
+        for i in range(first, len(self.transforms)):
+            self.transforms[i]._index = i
+
+    def take_dirty_ranges(self):
+        '''
+        :return: disjoint [begin, end) preorder ranges covering the
+            subtrees of the dirty transforms, in order
+        '''
+        if self._invalid:
+            self.rebuild()
+        dirty = sorted((xf._index, xf._index + xf._subtree_size)
+                       for xf in self.dirty if xf._hierarchy is self)
+        self.dirty = set()
+        ranges = []
+        for begin, end in dirty:
+            # Subtrees are either nested or disjoint
+            if ranges and begin < ranges[-1][1]:
+                continue
+            ranges.append((begin, end))
+        return ranges
 
 cdef class TransformBase(Component):
     def __init__(self, _object):
@@ -19,6 +227,9 @@ cdef class TransformBase(Component):
         self._children = []
         self._descendants = None
         self._descendant_hierarchy = None
+        self._hierarchy = None
+        self._index = -1
+        self._subtree_size = 1
 
     def path(self):
         transform = self
@@ -34,6 +245,10 @@ cdef class TransformBase(Component):
         self._descendants = None
         self._descendant_hierarchy = None
 
+    def _mark_dirty(self):
+        if self._hierarchy is not None:
+            self._hierarchy.dirty.add(self)
+
     def _clear_model(self):
         # Implemented in subclasses
         pass
@@ -48,6 +263,13 @@ cdef class TransformBase(Component):
         assert(new_parent != self)  # Cannot be own parent
         # If new_parent not (already) parent
         if new_parent is not self._parent:
+            rotate = new_parent is not None and self in new_parent.path()
+            hierarchy = self._hierarchy
+            if hierarchy is not None:
+                if rotate or self is hierarchy.root:
+                    hierarchy.invalidate()
+                else:
+                    hierarchy.remove(self)
             # If current parent is set
             if self._parent:
                 # Remove this transform from parent
@@ -57,7 +279,7 @@ cdef class TransformBase(Component):
             if new_parent is not None:
                 # If new parent is a descendant of this transform,
                 # then rotate the new parent with this transform
-                if self in new_parent.path():
+                if rotate:
                     # If the new parent has a parent
                     if new_parent.parent is not None:
                         new_parent._parent._children.remove(new_parent)
@@ -77,16 +299,35 @@ cdef class TransformBase(Component):
                     new_parent._clear_ancestor_descendants()
                     self._clear_model()
             self._parent = new_parent
+            if not rotate and new_parent is not None \
+                    and new_parent._hierarchy is not None:
+                new_parent._hierarchy.insert(self)
+            self._join_registry()
+
+    def _join_registry(self):
+        '''
+        Moves the components of the subtree to the registry of the
+        parent's object, none if the parent has none.
+        '''
+        registry = None
+        if self._parent is not None:
+            registry = self._parent.get_object().registry
+        if self.get_object().registry is registry:
+            return
+        for xf in walk_transforms(self):
+            xf.get_object().registry = registry
 
     @property
     def children(self):
-        return [child for child in self._children]
+        '''
+        The list of children itself, set parent to change it.
+        '''
+        return self._children
 
     def _calculate_descendants_and_hierarchy(self):
         descendants, hierarchy = zip(*get_model_hierarchy(self))
         self._descendants = list(descendants)
-        self._descendant_hierarchy = np.array(hierarchy, dtype='int')
-
+        self._descendant_hierarchy = np.array(hierarchy, dtype='intc')
 
     @property
     def descendants(self):
@@ -1,7 +1,8 @@
 import json
 import pathlib
 from os import path
-from queue import Empty
+from queue import Empty, Queue
+from threading import Event, Thread
 
 import numpy as np
 
@@ -13,24 +14,49 @@ from kivy.uix.popup import Popup
 
 from kivy.clock import Clock
 
-from sb import analysis
-from sb.files import get_image_paths
+from sb import analysis, metrics
+from sb.files import rescan_image_files, scan_image_files
+from sb.image import Image
 from sb.image_metadata import ImageMetadata
-from sb.image import Image as SBImage
+from sb.image_batch import AtlasImage, ImageBatch
 from sb.image_processing import ImageProcessor
+from sb.lod import LodCache
 from sb.sbmetadata import SBMetadata
 from sb.sbcontroller import SBController
 
 
-MAX_IMAGES = 3000
-
 def get_texture_from_array(array):
     h, w, _ = array.shape
     texture = Texture.create(size=(w, h))
-    texture.blit_buffer(np.flip(array, 0).flatten(), colorfmt='rgb', bufferfmt='float')
+    bufferfmt = 'ubyte' if array.dtype == np.uint8 else 'float'
+    texture.blit_buffer(np.flip(array, 0).flatten(), colorfmt='rgb', bufferfmt=bufferfmt)
     return texture
 
 
+def scan_worker(dir_path, batches, messages, cancel):
+    if batches is None:
+        batches = scan_image_files(dir_path)
+    for batch in batches:
+        if cancel.is_set():
+            return
+        messages.put(('add', batch))
+    messages.put(None)
+
+
+def rescan_worker(dir_path, scan_index, messages, cancel):
+    scan_index, added, removed, modified = rescan_image_files(
+        dir_path, scan_index)
+    if cancel.is_set():
+        return
+    # Modified files are processed as new ones
+    messages.put(('remove', removed + modified))
+    changed = added + modified
+    for begin in range(0, len(changed), 256):
+        messages.put(('add', [(p, *scan_index[p])
+                              for p in changed[begin:begin + 256]]))
+    messages.put(None)
+
+
 class LoadDirectoryDialog(FloatLayout):
     choose = ObjectProperty(None)
     cancel = ObjectProperty(None)
@@ -46,9 +72,18 @@ class RootView(FloatLayout):
         self.popup = None
         self.images_dir_path = None
         self.thumbnails_dir_path = None
+        self.scan_index = {}
         self.image_processor = None
         self.nodes = {}
+        self.node_paths = {}
+        self.scan_batch_limit = 8
+        self._scan_messages = None
+        self._scan_cancel = None
+        self.projection = analysis.Projection()
         self.update_batch_size = 400
+        self.image_batch = None
+        self.lod = None
+        self.lod_images = {}
 
     def on_start(self):
         # Set up controller
@@ -59,63 +94,181 @@ class RootView(FloatLayout):
         controller.pr_beta = 0.04
         controller.on_app_start()
         self.controller = controller
+        self.image_batch = ImageBatch()
+        sb_canvas.add_batch(self.image_batch)
+        self.lod = LodCache(to_value=get_texture_from_array)
         Clock.schedule_interval(self.image_loader_update, 1 / 60)
 
+    def scan_update(self):
+        # Nodes are created as the scanner finds files
+        for _ in range(self.scan_batch_limit):
+            try:
+                message = self._scan_messages.get_nowait()
+            except Empty:
+                break
+            if message is None:
+                self.image_processor.end_submissions()
+                self._scan_messages = None
+                break
+            action, items = message
+            if action == 'add':
+                self.add_files(items)
+            else:
+                self.remove_files(items)
+
+    def add_files(self, file_keys):
+        '''
+        :param file_keys: (path, size, mtime in ns) of the files to process
+        '''
+        nodes = self.controller.add_nodes(len(file_keys))
+        items = []
+        for node, (file_path, size, mtime_ns) in zip(nodes, file_keys):
+            node_id = id(node)
+            self.nodes[node_id] = node
+            # Keyed by path as found by the scanner, for rescans
+            self.node_paths[file_path] = node_id
+            self.scan_index[file_path] = size, mtime_ns
+            file_path = pathlib.PurePath(file_path)
+            sb_md = node.add_component(SBMetadata)
+            sb_md.value = ImageMetadata(thumbnail_file_path=file_path)
+            items.append((node_id, file_path))
+        self.image_processor.submit(items)
+
+    def remove_files(self, file_paths):
+        node_ids = [self.node_paths.pop(p) for p in file_paths]
+        for file_path, node_id in zip(file_paths, node_ids):
+            del self.nodes[node_id]
+            self.lod_images.pop(node_id, None)
+            del self.scan_index[file_path]
+        self.controller.remove_nodes(node_ids)
+        self.projection.remove(node_ids)
+
+    def update_viewport(self):
+        # Nodes outside of the view are culled
+        sb_view = self.ids.sb_view
+        x, y = sb_view.to_window(*sb_view.pos)
+        sb_view.ids.sb_canvas.set_viewport_from_window(
+            x, y, x + sb_view.width, y + sb_view.height)
+
+    def lod_update(self):
+        # Nodes large on screen get higher resolution versions
+        sb_view = self.ids.sb_view
+        sb_canvas = sb_view.ids.sb_canvas
+        if sb_canvas.viewport is None:
+            return
+        scale = sb_view.ids.sb_scatter.scale
+        visible = {}
+        for xform in sb_canvas.query_rect(*sb_canvas.viewport):
+            node_id = id(xform.get_object())
+            if node_id not in self.nodes:
+                continue
+            sb_md = self.nodes[node_id].get_component(SBMetadata)
+            visible[node_id] = (sb_md.value.thumbnail_file_path,
+                                scale * max(xform.width, xform.height))
+        loaded, evicted = self.lod.update(visible)
+        if metrics.is_enabled():
+            stats = self.lod.get_stats()
+            metrics.gauge('lod.hit_rate', stats['hit_rate'])
+            metrics.gauge('lod.bytes', stats['bytes'])
+        for (node_id, _), _ in evicted:
+            sb_img = self.lod_images.pop(node_id, None)
+            if sb_img is not None:
+                sb_img.destroy()
+        for (node_id, _), texture in loaded:
+            node = self.nodes.get(node_id)
+            if node is None:
+                continue
+            # Drawn over the atlas thumbnail
+            sb_img = node.add_component(Image)
+            sb_img.texture = texture
+            self.lod_images[node_id] = sb_img
+
     def image_loader_update(self, dt):
+        self.update_viewport()
+        self.lod_update()
         if self.image_processor:
             assert(isinstance(self.image_processor, ImageProcessor))
+            if metrics.is_enabled():
+                self.image_processor.record_queue_depths()
+            if self._scan_messages is not None:
+                self.scan_update()
+            pool = self.image_processor.thumbnail_pool
             for _ in range(self.update_batch_size):
                 try:
-                    node_id, img_array = self.image_processor.img_array_queue.get_nowait()
+                    node_id, slot = self.image_processor.thumbnail_slot_queue.get_nowait()
                 except Empty:
                     break
-                node = self.nodes[node_id]
+                node = self.nodes.get(node_id)
+                if node is None:
+                    # Removed while being processed
+                    pool.release(slot)
+                    continue
                 self.controller.pr_alpha = 0.0
-                # Add image component
-                sb_img = node.add_component(SBImage)
-
-                # TODO
-                texture = get_texture_from_array(img_array)
-                sb_img.texture = texture
+                # Add image component, its pixels are copied into the atlas
+                img_array = pool.read(slot)
+                sb_img = node.add_component(AtlasImage)
+                self.image_batch.set_image(sb_img, node_id, img_array)
+                h, w = img_array.shape[:2]
+                del img_array
+                pool.release(slot)
                 sb_img.transform.width, sb_img.transform.height = \
-                    tuple(0.1 * i for i in texture.size)
-
-            node_ids = []
-            anchors = []
+                    0.1 * w, 0.1 * h
 
             for _ in range(self.update_batch_size):
                 try:
-                    node_id, analysis = self.image_processor.analysis_queue.get_nowait()
+                    node_ids, data = self.image_processor.analysis_queue.get_nowait()
                 except Empty:
                     break
-                node = self.nodes[node_id]
-                md = node.add_component(ImageMetadata)
-                md.analysis = analysis
-                anchor = (analysis.mean, analysis.contrast)
-                node_ids.append(node_id)
-                anchors.append(anchor)
-            if node_ids:
-                self.controller.set_node_target_anchors(node_ids, anchors)
-
-            node_ids = []
-            anchors = []
+                kept = []
+                for i, node_id in enumerate(node_ids):
+                    node = self.nodes.get(node_id)
+                    if node is None:
+                        # Removed while being processed
+                        continue
+                    mean, contrast = data[i]
+                    md = node.add_component(ImageMetadata)
+                    md.analysis = analysis.Analysis(mean, contrast)
+                    kept.append(i)
+                # Mean and contrast are the initial anchors
+                if kept:
+                    self.controller.set_node_target_anchors(
+                        [node_ids[i] for i in kept], data[kept])
+
             if self.image_processor.results_queue.empty():
                 self.controller.pr_alpha = 0.2
 
+            projection = self.projection
+            n_projected = len(projection)
+            basis_changed = False
             for _ in range(self.update_batch_size):
                 try:
-                    node_id, result = self.image_processor.results_queue.get_nowait()
+                    version, mean, components, node_ids, features = \
+                        self.image_processor.results_queue.get_nowait()
                 except Empty:
                     break
-                anchor = result
-                node_ids.append(node_id)
-                anchors.append(anchor)
-            if node_ids:
-                self.controller.set_node_target_anchors(node_ids, anchors)
+                kept = [i for i, node_id in enumerate(node_ids)
+                        if node_id in self.nodes]
+                projection.add([node_ids[i] for i in kept], features[kept])
+                basis_changed |= projection.set_basis(version, mean, components)
+            # A new basis moves every point, otherwise only new points move
+            if basis_changed:
+                n_projected = 0
+            if projection.mean is not None and n_projected < len(projection):
+                self.controller.set_node_target_anchors(
+                    projection.node_ids[n_projected:],
+                    projection.transform(n_projected))
 
     def on_stop(self):
         self.controller.on_app_stop()
-        self.image_processor.stop_all()
+        self.stop_loading()
+        self.lod.close()
+
+    def stop_loading(self):
+        if self._scan_cancel is not None:
+            self._scan_cancel.set()
+        self._scan_messages = None
+        if self.image_processor:
+            self.image_processor.stop_all()
 
     def dismiss_popup(self):
         self.popup.dismiss()
@@ -141,33 +294,60 @@ class RootView(FloatLayout):
     def cancel_choose_directory(self):
         self.dismiss_popup()
 
-    def load_directory(self, dir_path, thumbnails_dir_path=None):
-        if self.image_processor:
-            self.image_processor.stop_all()
-
-        self.images_dir_path = dir_path
-        if thumbnails_dir_path:
-            self.thumbnails_dir_path = thumbnails_dir_path
-        else:
-            thumbnails_dir_path = self.thumbnails_dir_path
-
-        thumbnails_dir_path = pathlib.Path(thumbnails_dir_path)
+    def start_processor(self, initial_data=None):
+        thumbnails_dir_path = pathlib.Path(self.thumbnails_dir_path)
+        thumbnails_dir_path.mkdir(parents=True, exist_ok=True)
         image_processor = ImageProcessor()
-        image_processor.init_processes(str(thumbnails_dir_path), n_workers=8)
+        image_processor.init_processes(str(thumbnails_dir_path), n_workers=8,
+                                       initial_data=initial_data)
         self.image_processor = image_processor
 
-        thumbnails_dir_path.mkdir(parents=True, exist_ok=True)
-        file_paths = list(get_image_paths(dir_path))
-
-        nodes = [self.controller.add_node() for _ in range(len(file_paths))]
-
-        self.nodes = {id(n): n for n in nodes}
+    def start_scan(self, target, *args):
+        self._scan_messages = Queue()
+        self._scan_cancel = Event()
+        Thread(target=target,
+               args=(*args, self._scan_messages, self._scan_cancel),
+               daemon=True).start()
 
-        for node, file_path in zip(nodes, file_paths):
-            sb_md = node.add_component(SBMetadata)
-            sb_md.value = ImageMetadata(thumbnail_file_path=file_path)
+    def load_directory(self, dir_path, thumbnails_dir_path=None):
+        if thumbnails_dir_path:
+            self.thumbnails_dir_path = thumbnails_dir_path
+        # Reloading a completely processed directory only processes changes
+        if dir_path == self.images_dir_path and self.image_processor and \
+                self.image_processor.is_complete:
+            self.reload_directory()
+            return
+        self.stop_loading()
+        self.controller.clear_nodes()
+        self.nodes = {}
+        self.node_paths = {}
+        self.lod_images = {}
+        self.scan_index = {}
+        self.projection = analysis.Projection()
+        self.images_dir_path = dir_path
 
-        image_processor.start_all(list(zip(self.nodes.keys(), file_paths)))
+        self.start_processor()
+        thumbnails_dir_path = pathlib.Path(self.thumbnails_dir_path)
+        batches = None
+        if self.image_processor.needs_legacy_migration(thumbnails_dir_path):
+            # The one-time import needs to see every path at once
+            batches = list(scan_image_files(dir_path))
+            self.image_processor.migrate_legacy_thumbnails(
+                thumbnails_dir_path, [p for b in batches for p, _, _ in b])
+        self.image_processor.start_all()
+        self.start_scan(scan_worker, dir_path, batches)
+
+    def reload_directory(self):
+        self.stop_loading()
+        # The new producer numbers its bases from 1 again, and fits them
+        # on the features of the unchanged images as well as the changes
+        projection = self.projection
+        projection.reset_version()
+        self.start_processor(projection.features[:len(projection)]
+                             if len(projection) else None)
+        self.image_processor.start_all()
+        self.start_scan(rescan_worker, self.images_dir_path,
+                        dict(self.scan_index))
 
     def export_1d(self):
         transforms = self.controller.get_root_transforms()
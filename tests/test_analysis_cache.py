@@ -0,0 +1,59 @@
+import sqlite3
+
+import numpy as np
+
+from sb.analysis import Analysis
+from sb.analysis_cache import AnalysisCache
+
+FILE_KEY = ('/images/a.jpg', 1000, 123456789)
+
+
+def make_analysis():
+    colors = np.arange(9, dtype='float64').reshape(3, 3) / 10
+    return Analysis(0.5, 0.25, colors=colors)
+
+
+def test_round_trip(tmp_path):
+    cache = AnalysisCache(tmp_path / 'analysis.sqlite')
+    assert cache.get(FILE_KEY) is None
+    cache.put(FILE_KEY, make_analysis())
+    analysis = cache.get(FILE_KEY)
+    assert (analysis.mean, analysis.contrast) == (0.5, 0.25)
+    assert np.array_equal(analysis.colors, make_analysis().colors)
+    assert (cache.hits, cache.misses) == (1, 1)
+    # A changed file misses
+    assert cache.get(FILE_KEY[:2] + (0,)) is None
+
+
+def test_other_engine_misses(tmp_path):
+    db_path = tmp_path / 'analysis.sqlite'
+    cache = AnalysisCache(db_path, 'histogram')
+    cache.put(FILE_KEY, make_analysis())
+    cache.close()
+
+    other = AnalysisCache(db_path, 'kmeans')
+    assert other.get(FILE_KEY) is None
+    other.put(FILE_KEY, Analysis(0.5, 0.25, colors=np.zeros((3, 3))))
+    other.close()
+
+    # Both engines keep their own colors
+    cache = AnalysisCache(db_path, 'histogram')
+    assert np.array_equal(cache.get(FILE_KEY).colors,
+                          make_analysis().colors)
+
+
+def test_older_schema_is_dropped(tmp_path):
+    db_path = tmp_path / 'analysis.sqlite'
+    connection = sqlite3.connect(db_path)
+    connection.execute(
+        'CREATE TABLE analysis (path TEXT PRIMARY KEY, size INTEGER, '
+        'mtime_ns INTEGER, mean REAL, contrast REAL, colors BLOB)')
+    connection.execute('INSERT INTO analysis VALUES (?, ?, ?, ?, ?, ?)',
+                       FILE_KEY + (0.5, 0.25, b''))
+    connection.commit()
+    connection.close()
+
+    cache = AnalysisCache(db_path)
+    assert cache.get(FILE_KEY) is None
+    cache.put(FILE_KEY, make_analysis())
+    assert cache.get(FILE_KEY) is not None
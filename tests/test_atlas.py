@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from sb.atlas import TextureAtlas, build_mesh_batches, build_quad_vertices, \
+    quad_indices
+
+
+def test_quad_vertices():
+    vertices = build_quad_vertices([[1, 2, 10, 20]], [[0.0, 0.25, 0.5, 1.0]])
+    assert vertices.dtype == np.float32
+    assert vertices.reshape(4, 4).tolist() == [
+        [1, 2, 0.0, 0.25],
+        [11, 2, 0.5, 0.25],
+        [11, 22, 0.5, 1.0],
+        [1, 22, 0.0, 1.0]]
+
+
+def test_quad_indices():
+    assert quad_indices(2).tolist() == [0, 1, 2, 2, 3, 0,
+                                        4, 5, 6, 6, 7, 4]
+
+
+def test_mesh_batches_split():
+    rects = np.arange(5 * 4, dtype='float32').reshape(5, 4)
+    uvs = np.zeros((5, 4), dtype='float32')
+    batches = build_mesh_batches(rects, uvs, max_quads=2)
+    assert [len(v) // 16 for v, _ in batches] == [2, 2, 1]
+    assert [len(i) for _, i in batches] == [12, 12, 6]
+    # Every batch indexes its own vertices from 0
+    assert all(i.max() == len(v) // 4 - 1 for v, i in batches)
+    vertices = np.concatenate([v for v, _ in batches])
+    assert np.array_equal(vertices, build_quad_vertices(rects, uvs))
+    assert build_mesh_batches(np.zeros((0, 4)), np.zeros((0, 4))) == []
+
+
+def test_atlas_regions():
+    atlas = TextureAtlas(page_size=128, cell_size=64)
+    image = np.zeros((32, 48, 3), dtype='uint8')
+    image[0] = 255
+    regions = [atlas.add(i, image) for i in range(5)]
+    assert [r.page for r in regions] == [0, 0, 0, 0, 1]
+    assert [(r.x, r.y) for r in regions[:4]] == \
+        [(0, 0), (64, 0), (0, 64), (64, 64)]
+    assert regions[1].uvs == (0.5, 0.0, 0.875, 0.25)
+    # Stored bottom row first
+    assert atlas.pages[0][31, 64:112].min() == 255
+    assert atlas.pages[0][0].max() == 0
+    with pytest.raises(ValueError):
+        atlas.add('large', np.zeros((65, 1, 3), dtype='uint8'))
+
+
+def test_dirty_rects():
+    atlas = TextureAtlas(page_size=256, cell_size=64)
+    image = np.zeros((10, 10, 3), dtype='uint8')
+    for i in range(3):
+        atlas.add(i, image)
+    assert atlas.take_dirty_rects() == {
+        0: [(0, 0, 64, 64), (64, 0, 64, 64), (128, 0, 64, 64)]}
+    assert atlas.take_dirty_rects() == {}
+    for i in range(3, 9):
+        atlas.add(i, image)
+    # Merged into the bounding rectangle of the cells
+    assert atlas.take_dirty_rects(max_rects=4) == {0: [(0, 0, 256, 192)]}
@@ -0,0 +1,49 @@
+from sb.component_registry import ComponentRegistry
+from sb.drawable import Drawable
+from sb.sbobject import SBObject
+
+
+def make_root():
+    root = SBObject()
+    root.registry = ComponentRegistry()
+    return root
+
+
+def test_reparented_drawable_joins_registry():
+    root = make_root()
+    registry = root.registry
+    node = SBObject()
+    drawable = node.add_component(Drawable)
+    child = SBObject()
+    child_drawable = child.add_component(Drawable)
+    child.transform.parent = node.transform
+    assert node.registry is None and child.registry is None
+
+    node.transform.parent = root.transform
+    assert child.registry is registry
+    assert registry.take_pending_drawables() == {
+        drawable: True, child_drawable: True}
+
+    # Attached below a registered node later on
+    late = SBObject()
+    late_drawable = late.add_component(Drawable)
+    late.transform.parent = child.transform
+    assert late.registry is registry
+    assert registry.take_pending_drawables() == {late_drawable: True}
+    assert set(registry.get_components(Drawable)) == {
+        drawable, child_drawable, late_drawable}
+
+
+def test_reparented_drawable_leaves_registry():
+    root = make_root()
+    registry = root.registry
+    node = SBObject()
+    drawable = node.add_component(Drawable)
+    node.transform.parent = root.transform
+    registry.take_pending_drawables()
+
+    other = SBObject()
+    node.transform.parent = other.transform
+    assert node.registry is None
+    assert registry.take_pending_drawables() == {drawable: False}
+    assert list(registry.get_components(Drawable)) == []
@@ -0,0 +1,45 @@
+import numpy as np
+
+from sb.spatial import SpatialGrid
+
+
+def make_grid():
+    grid = SpatialGrid()
+    grid.update([[0, 0, 4, 4], [10, 0, 4, 4], [20, 0, 4, 4]])
+    return grid
+
+
+def test_query_rect():
+    grid = make_grid()
+    assert grid.query_rect(-1, -1, 5, 5).tolist() == [0]
+    assert grid.query_rect(3, 1, 11, 2).tolist() == [0, 1]
+    assert grid.query_rect(-10, -10, 30, 30).tolist() == [0, 1, 2]
+    assert grid.query_rect(5, 0, 9, 4).tolist() == []
+    assert grid.query_point(12, 2).tolist() == [1]
+
+
+def test_invalid_rows_are_not_found():
+    grid = SpatialGrid()
+    grid.update([[0, 0, 4, 4], [np.nan, 0, 4, 4], [10, 0, 4, 4]],
+                valid=np.array([True, True, False]))
+    assert grid.query_rect(-100, -100, 100, 100).tolist() == [0]
+
+
+def test_query_beyond_the_span():
+    grid = make_grid()
+    # Both stay in the edge columns, so the cell table is kept
+    grid.update([[-100, 0, 4, 4], [10, 0, 4, 4], [100, 0, 4, 4]])
+    assert grid.n_rebuilds == 1
+    assert grid.query_rect(95, 0, 110, 4).tolist() == [2]
+    assert grid.query_rect(-105, 0, -90, 4).tolist() == [0]
+    assert grid.query_point(102, 2).tolist() == [2]
+    assert grid.query_rect(200, 0, 300, 4).tolist() == []
+    assert grid.query_rect(-300, 0, -200, 4).tolist() == []
+
+
+def test_rebuild_after_moving_rows():
+    grid = make_grid()
+    grid.update([[0, 0, 4, 4], [10, 50, 4, 4], [20, 0, 4, 4]])
+    assert grid.n_rebuilds == 2
+    assert grid.query_rect(9, 49, 15, 55).tolist() == [1]
+    assert grid.query_rect(9, 0, 15, 4).tolist() == []